@@ -53,6 +53,9 @@ setup(
         "orjson>=3.0.0",
         "networkx[default]"
     ],
+    extras_require={
+        "zstd": ["zstandard"],
+    },
     entry_points={
         'console_scripts': [
             'wsyntree-collector=wsyntree_collector.__main__:__main__',
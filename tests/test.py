@@ -4,10 +4,10 @@ import argparse
 
 from wsyntree import log
 from wsyntree.utils import node_as_sexp
-from wsyntree.wrap_tree_sitter import TreeSitterAutoBuiltLanguage, TreeSitterCursorIterator
+from wsyntree.wrap_tree_sitter import TreeSitterAutoBuiltLanguage, flatten_tree
 
-def str_tsnode(n):
-    return f"tsnode<'{n.type}', {n.start_point}>"
+def str_flatnode(ft, preorder):
+    return f"tsnode<'{ft.type(preorder)}', ({ft.start_row[preorder]}, {ft.start_col[preorder]})>"
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -36,14 +36,9 @@ if __name__ == '__main__':
 
     tree = lang.parse_file(args.file_path)
 
-    cur = tree.walk()
-    cur = TreeSitterCursorIterator(cur)
+    ft = flatten_tree(tree)
 
-    log.debug(cur)
+    log.debug(ft)
 
-    root = cur.peek()
-    log.info(f"{cur.preorder:5d}:{' ' * cur.depth}{str_tsnode(root)}")
-
-    for node in cur:
-        # print(node)
-        log.info(f"{cur.preorder:5d}:{' ' * cur.depth}{str_tsnode(node)}")
+    for preorder in ft.preorder:
+        log.info(f"{preorder:5d}:{' ' * ft.depth[preorder]}{str_flatnode(ft, preorder)}")
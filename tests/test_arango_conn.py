@@ -0,0 +1,13 @@
+from wsyntree.arango_conn import parse_db_uri, with_default_pool_size
+
+
+def test_default_pool_size_is_added():
+    uri = with_default_pool_size("http://u:p@h1,h2:8529/db?hosts=affinity", 32)
+    conn = parse_db_uri(uri)
+    assert conn.pool_size == 32
+    assert conn.hosts == ["http://h1:8529", "http://h2:8529"]
+    assert (conn.username, conn.password, conn.database, conn.hosts_strategy) == ("u", "p", "db", "affinity")
+
+def test_pool_size_of_the_uri_is_kept():
+    uri = "http://localhost/wst?pool_size=3"
+    assert with_default_pool_size(uri, 32) == uri
@@ -0,0 +1,25 @@
+import pytest
+
+from wsyntree_collector.db_writer import BulkWriter
+
+
+def fail(msg):
+    raise ValueError(msg)
+
+def test_drain_does_not_raise_failures_handled_by_on_error():
+    writer = BulkWriter(max_in_flight=2)
+    handled, completed = [], []
+    for name in ("a", "b", "c"):
+        written = [writer.submit(fail if name == "b" else str, name)]
+        writer.then(written, lambda name=name: completed.append(name), on_error=handled.append)
+    writer.drain()
+    assert completed == ["a", "c"]
+    assert [str(e) for e in handled] == ["b"]
+
+def test_drain_raises_unhandled_failures_once():
+    writer = BulkWriter(max_in_flight=2)
+    writer.submit(fail, "x")
+    writer.then([writer.submit(str, "y")], lambda: None, on_error=lambda e: None)
+    with pytest.raises(ValueError, match="x"):
+        writer.drain()
+    writer.drain()
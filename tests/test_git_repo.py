@@ -0,0 +1,40 @@
+import pygit2 as git
+import pytest
+
+from wsyntree_collector.git_repo import GitRepoSource
+
+
+class Source(GitRepoSource):
+    def __init__(self, repo_url, use_odb):
+        self.repo_url = repo_url
+        self._url_path = "example/repo"
+        self._target_commit = None
+        self._use_odb = use_odb
+
+@pytest.fixture
+def origin(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    repo = git.init_repository(str(tmp_path / "origin"))
+    (tmp_path / "origin" / "a.py").write_text("x = 1\n")
+    repo.index.add("a.py")
+    repo.index.write()
+    sig = git.Signature("wst", "wst@example.com")
+    repo.create_commit("HEAD", sig, sig, "init", repo.index.write_tree(), [])
+    return str(tmp_path / "origin")
+
+@pytest.mark.parametrize("use_odb", [False, True])
+def test_iter_files(origin, use_odb):
+    src = Source(origin, use_odb)
+    assert src._get_git_repo().is_bare == use_odb
+    assert [(f.path, f.size) for f in src._iter_files()] == [("a.py", 6)]
+
+def test_bare_clone_falls_back_to_the_object_database(origin):
+    Source(origin, True)._get_git_repo()
+    src = Source(origin, False)
+    assert src._get_git_repo().is_bare
+    assert src._use_odb
+    assert [f.path for f in src._iter_files()] == ["a.py"]
+
+def test_current_commit_hash(origin):
+    src = Source(origin, False)
+    assert src._current_commit_hash == str(git.Repository(origin).head.target)
@@ -0,0 +1,89 @@
+import pytest
+
+from wsyntree.wrap_tree_sitter import _common_prefix_length, content_edit
+from wsyntree_collector.jsonl_worker import reused_text_key
+
+
+@pytest.mark.parametrize("step", [1, 3, 4096])
+@pytest.mark.parametrize("a, b, n", [
+    (b"", b"", 0),
+    (b"abc", b"abc", 3),
+    (b"abc", b"abd", 2),
+    (b"abc", b"ab", 2),
+    (b"xbc", b"abc", 0),
+    (b"a" * 10000 + b"x", b"a" * 10000 + b"y", 10000),
+])
+def test_common_prefix_length(a, b, n, step):
+    assert _common_prefix_length(a, b, step) == n
+
+def test_content_edit_identical():
+    assert content_edit(b"int a;\n", b"int a;\n") is None
+
+@pytest.mark.parametrize("old, new, start, old_end, new_end", [
+    (b"int a;\nint b;\n", b"int a;\nint bc;\n", 12, 12, 13), # insertion
+    (b"int a;\nint bc;\n", b"int a;\nint b;\n", 12, 13, 12), # deletion
+    (b"int a;\n", b"int x;\n", 4, 5, 5), # replacement
+    (b"aaa", b"aaaa", 3, 3, 4), # prefix and suffix overlap
+    (b"", b"ab", 0, 0, 2),
+])
+def test_content_edit(old, new, start, old_end, new_end):
+    edit = content_edit(old, new)
+    assert (edit["start_byte"], edit["old_end_byte"], edit["new_end_byte"]) == (start, old_end, new_end)
+    assert old[:start] + new[start:new_end] + old[old_end:] == new
+
+def test_content_edit_points():
+    edit = content_edit(b"a\nbc\nd\n", b"a\nbXc\nd\n")
+    assert edit["start_point"] == (1, 1)
+    assert edit["old_end_point"] == (1, 1)
+    assert edit["new_end_point"] == (1, 2)
+
+def _spans(content: bytes):
+    return [(sb, eb) for sb in range(len(content) + 1) for eb in range(sb, len(content) + 1)]
+
+def _reuse(old: bytes, new: bytes):
+    """Reused keys of every span of new, the text keys being the texts themselves"""
+    text_keys = {span: old[span[0]:span[1]] for span in _spans(old)}
+    edit = content_edit(old, new)
+    if edit is None:
+        bounds = (len(new), len(new), 0)
+    else:
+        bounds = (edit["start_byte"], edit["new_end_byte"], edit["new_end_byte"] - edit["old_end_byte"])
+    return {span: reused_text_key(text_keys, *span, *bounds) for span in _spans(new)}
+
+@pytest.mark.parametrize("old, new", [
+    (b"int a;\nint b;\n", b"int a;\nint bc;\n"),
+    (b"int a;\nint bc;\n", b"int a;\nint b;\n"),
+    (b"f(x, y)", b"f(x, z, y)"),
+    (b"aaa", b"aaaa"),
+    (b"abc", b"abc"),
+])
+def test_reused_text_keys_are_the_same_texts(old, new):
+    for (sb, eb), key in _reuse(old, new).items():
+        if key is not None:
+            assert key == new[sb:eb]
+
+def test_reused_text_keys_around_an_edit():
+    old, new = b"int a;\nint b;\n", b"int a;\nint bc;\n"
+    reused = _reuse(old, new)
+    # ends exactly at the edit start
+    assert reused[(7, 12)] == b"int b"
+    # starts at the edit's new end, shifted back
+    assert reused[(13, 14)] == b";"
+    # spans the edit
+    assert reused[(11, 13)] is None
+    assert reused[(12, 13)] is None
+
+def test_reused_text_keys_without_edit():
+    reused = _reuse(b"abc", b"abc")
+    assert all(reused[span] == b"abc"[span[0]:span[1]] for span in _spans(b"abc"))
+
+def test_reused_text_keys_of_a_deletion():
+    old, new = b"f(x, z, y)", b"f(x, y)"
+    edit = content_edit(old, new)
+    # the edit is empty in the new content
+    assert edit["start_byte"] == edit["new_end_byte"]
+    reused = _reuse(old, new)
+    assert reused[(0, 5)] == b"f(x, "
+    assert reused[(5, 7)] == b"y)"
+    # around the deleted bytes
+    assert reused[(4, 7)] is None
@@ -0,0 +1,89 @@
+import pytest
+
+from wsyntree.tree_models import WSTFile
+from wsyntree_collector.journal import CollectionJournal
+from wsyntree_collector.jsonl_frames import (
+    FrameWriter, iter_documents, read_frame_index, truncate_file,
+)
+from wsyntree_collector.jsonl_writer import WST_FileExporter, serialize_documents
+from wsyntree_collector.parse_cache import ParseCacheEntry, get_parse_cache
+
+
+def _lines(n, start=0):
+    return b"".join(b'{"_key":"%d"}\n' % i for i in range(start, start + n))
+
+@pytest.mark.parametrize("compression", [None, "gzip", "zstd"])
+def test_truncate_file_at_frame_boundary(tmp_path, compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    path = tmp_path / "wst_nodes.vert.jsonl"
+    if compression is not None:
+        path = path.with_name(path.name + {"gzip": ".gz", "zstd": ".zst"}[compression])
+    w = FrameWriter(path, compression)
+    w.write(_lines(10))
+    w.flush()
+    size = w.size
+    w.write(_lines(10, 10))
+    w.close()
+    assert len(list(iter_documents(path))) == 20
+
+    truncate_file(path, size)
+    assert [d["_key"] for d in iter_documents(path)] == [str(i) for i in range(10)]
+    if compression is not None:
+        assert len(read_frame_index(path)) == 1
+    # appending continues after the kept frames
+    w = FrameWriter(path, compression)
+    w.write(_lines(1, 99))
+    w.close()
+    assert [d["_key"] for d in iter_documents(path)][-1] == "99"
+
+def test_restore_rolls_back_to_last_checkpoint(tmp_path):
+    path = tmp_path / "wst_nodes.vert.jsonl"
+    w = FrameWriter(path)
+    w.write(_lines(5))
+    w.flush()
+    journal = CollectionJournal(tmp_path)
+    journal.file_completed(WSTFile(path="a.py", mode=0o100644, git_oid="aa", content_hash="x"))
+    journal.checkpoint({path.name: w.size})
+    # not checkpointed: a file completed, more output, a new output file
+    journal.file_completed(WSTFile(path="b.py", mode=0o100644, git_oid="bb", content_hash="y"))
+    w.write(_lines(5, 5))
+    w.close()
+    (tmp_path / "wst_texts.vert.jsonl").write_bytes(_lines(1))
+    journal.close()
+    # a checkpoint line cut short by the crash
+    with journal.path.open('ab') as f:
+        f.write(b'{"time": 1, "files"')
+
+    completed = CollectionJournal(tmp_path).restore()
+    assert completed == {("a.py", 0o100644, "aa")}
+    assert len(list(iter_documents(path))) == 5
+    assert not (tmp_path / "wst_texts.vert.jsonl").exists()
+    assert journal.path.read_bytes().endswith(b"\n")
+
+def test_parse_cache_entries_wait_for_checkpoint(tmp_path):
+    cache_path = str(tmp_path / "cache.sqlite3")
+    out = tmp_path / "out"
+    exporter = WST_FileExporter(out, journal=True)
+    exporter._open_all_append()
+    entry = ParseCacheEntry(cache_path, "python", "v1", "abc", "python-abc", "full/full")
+    exporter.write_incoming(entry)
+    assert get_parse_cache(cache_path).get("python", "v1", "abc", "full/full") is None
+    exporter.write_incoming([WSTFile(path="a.py", mode=0o100644, git_oid="aa", content_hash="abc")])
+    exporter.checkpoint()
+    assert get_parse_cache(cache_path).get("python", "v1", "abc", "full/full") == "python-abc"
+    exporter._close_all()
+
+def test_parse_cache_entries_without_journal_wait_for_persist(tmp_path):
+    cache_path = str(tmp_path / "cache.sqlite3")
+    exporter = WST_FileExporter(tmp_path / "out")
+    exporter._open_all_append()
+    exporter.write_incoming(ParseCacheEntry(cache_path, "c", "v1", "def", "c-def", "full/full"))
+    assert get_parse_cache(cache_path).get("c", "v1", "def", "full/full") is None
+    exporter.sync()
+    assert get_parse_cache(cache_path).get("c", "v1", "def", "full/full") is None
+    exporter.persist()
+    assert get_parse_cache(cache_path).get("c", "v1", "def", "full/full") == "c-def"
+    exporter.write_incoming(ParseCacheEntry(cache_path, "c", "v1", "fed", "c-fed", "full/full"))
+    exporter._close_all()
+    assert get_parse_cache(cache_path).get("c", "v1", "fed", "full/full") == "c-fed"
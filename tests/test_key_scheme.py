@@ -0,0 +1,37 @@
+import hashlib
+import re
+
+import pytest
+
+from wsyntree.key_scheme import KeyScheme
+
+
+def test_v1_keys_match_the_original_format():
+    ks = KeyScheme(1)
+    assert ks.digest_bytes == 64
+    assert ks.content_hash(b"abc") == hashlib.shake_256(b"abc").hexdigest(64)
+    assert ks.text_key("abc", 3) == f"3-{hashlib.shake_256(b'abc').hexdigest(64)}"
+    assert ks.text_key("abc", 3, b"\x01\x02") == "m1.2-3-0102"
+    assert re.fullmatch(r"[0-9a-f]{64}-0o100644-ch", ks.file_key("a.py", 0o100644, "ch"))
+    assert ks.edge_key("a", "b") == hashlib.shake_256(b"a+b").hexdigest(64)
+
+@pytest.mark.parametrize("digest_bytes", [8, 16, 64])
+def test_v2_keys_use_blake2b(digest_bytes):
+    ks = KeyScheme(2, digest_bytes)
+    h = hashlib.blake2b(b"abc", digest_size=digest_bytes).hexdigest()
+    assert ks.content_hash(b"abc") == h
+    assert ks.text_key("abc", 3) == f"3-{h}"
+    assert ks.text_key("abc", 3, b"\xff") == f"{ks.merkle_key_prefix}3-ff"
+    assert len(ks.file_key("a.py", 0o100644, "ch")) == 2 * digest_bytes
+    assert ks.file_key("a.py", 0o100644, "ch") != ks.file_key("a.py", 0o100755, "ch")
+    assert len(ks.edge_key("a", "b")) == 2 * digest_bytes
+
+def test_invalid_schemes_are_rejected():
+    with pytest.raises(ValueError):
+        KeyScheme(3)
+    with pytest.raises(ValueError):
+        KeyScheme(2, 4)
+
+def test_collision_probability():
+    assert KeyScheme(2, 8).collision_probability(2 ** 32) > 0.1
+    assert KeyScheme(2, 16).collision_probability(2 ** 32) < 1e-6
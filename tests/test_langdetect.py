@@ -0,0 +1,101 @@
+import re
+
+import pytest
+
+from wsyntree.constants import wsyntree_file_to_lang
+from wsyntree.langdetect import detect_language, detector
+
+
+def regex_loop(path):
+    """The detection langdetect replaced"""
+    for k, v in wsyntree_file_to_lang.items():
+        if re.search(re.compile(k), path):
+            return v
+    return None
+
+# only extensions the regexes knew, so both must agree
+LISTING = [
+    "README.md",
+    "Makefile",
+    "setup.py",
+    "src/main.rs",
+    "lib/thing.rb",
+    "src/a.c",
+    "include/a.h",
+    "src/b.cpp",
+    "src/b.hpp",
+    "src/b.cc",
+    "src/b.hh",
+    "src/b.cxx",
+    "src/b.hxx",
+    "src/b.c++",
+    "src/b.h++",
+    "cmd/main.go",
+    "src/main/java/App.java",
+    "web/app.js",
+    "web/app.min.js",
+    "web/app.js.map",
+    "dist/vendor.min.js",
+    "docs/conf.py.in",
+    "a.py/b",
+    ".gitignore",
+    "no_extension",
+    "weird.",
+    "dir.js/file",
+]
+
+@pytest.mark.parametrize("path", LISTING)
+def test_detect_path_agrees_with_regex_loop(path):
+    assert detector.detect_path(path) == regex_loop(path)
+
+@pytest.mark.parametrize("path, lang", [
+    ("SConstruct", "python"),
+    ("tools/SConscript", "python"),
+    ("Rakefile", "ruby"),
+    ("sub/Gemfile", "ruby"),
+    ("Gemfile.lock", None),
+    ("types.pyi", "python"),
+    ("mod.mjs", "javascript"),
+])
+def test_detect_path_beyond_the_regexes(path, lang):
+    assert detect_language(path) == lang
+
+@pytest.mark.parametrize("content, lang", [
+    (b"#!/usr/bin/env python3\nprint(1)\n", "python"),
+    (b"#!/usr/bin/python2.7\n", "python"),
+    (b"#! /usr/bin/env -S node --harmony\n", "javascript"),
+    (b"#!/usr/local/bin/ruby -w\n", "ruby"),
+    (b"#!/bin/sh\n", None),
+    (b"print(1)\n#!/usr/bin/python\n", None), # only on the first line
+])
+def test_sniff_shebang(content, lang):
+    assert detect_language("bin/tool", content) == lang
+
+@pytest.mark.parametrize("content, lang", [
+    (b"// vim: set ft=cpp :\nint x;\n", "cpp"),
+    (b"int x;\n/* vi: filetype=c */\n", "c"),
+    (b"# -*- mode: ruby -*-\n", "ruby"),
+    (b"// -*- Mode: Go -*-\n", "go"),
+    (b"\n" * 20 + b"# vim: syntax=python\n" + b"\n" * 20, None), # in the middle
+    (b"# vim: ft=cobol\n", None),
+])
+def test_sniff_modeline(content, lang):
+    assert detect_language("notes", content) == lang
+
+def test_content_does_not_override_path():
+    assert detect_language("a.py", b"#!/usr/bin/env ruby\n") == "python"
+
+@pytest.mark.parametrize("content, lang", [
+    (b"#include <stdio.h>\nint f(void);\n", "c"),
+    (b"#include <vector>\n", "cpp"),
+    (b"namespace a {\n}\n", "cpp"),
+    (b"template <typename T> T f(T);\n", "cpp"),
+    (b"class A {\npublic:\n};\n", "cpp"),
+    (b"struct class_info;\n", "c"),
+])
+def test_h_header(content, lang):
+    assert detect_language("include/a.h", content) == lang
+    assert detect_language("include/a.h") == "c"
+
+def test_excluded_paths_are_not_sniffed():
+    assert detect_language("dist/app.min.js", b"#!/usr/bin/env node\n") is None
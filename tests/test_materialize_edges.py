@@ -0,0 +1,70 @@
+import orjson
+import pytest
+
+from wsyntree.key_scheme import KeyScheme, get_key_scheme, set_key_scheme
+from wsyntree.tree_models import WST_Edge, WSTCodeTree, WSTNode, WSTText
+from wsyntree_collector.jsonl_frames import iter_documents
+from wsyntree_collector.jsonl_writer import WST_FileExporter, dump_document, read_key_scheme
+from wsyntree_collector.materialize_edges import materialize_dirs, node_edges
+
+
+@pytest.fixture
+def key_scheme():
+    previous = get_key_scheme()
+    scheme = KeyScheme(2, 8)
+    set_key_scheme(scheme)
+    yield scheme
+    set_key_scheme(previous)
+
+def collect(compact_graph):
+    """Documents of a 3 node tree, as the jsonl worker writes them"""
+    code_tree = WSTCodeTree(language="python", content_hash="abc")
+    code_tree._genkey()
+    docs, edges = [code_tree], []
+    # preorder -> (parent, text)
+    tree = {0: (-1, "f(x)"), 1: (0, "f"), 2: (0, None)}
+    for preorder, (parent, text) in tree.items():
+        nn = WSTNode(_key=f"{code_tree._key}-{preorder}", preorder=preorder, type="t", named=True)
+        if compact_graph:
+            nn.parent = parent
+        elif parent >= 0:
+            edges.append(WST_Edge(f"{WSTNode._collection}/{code_tree._key}-{parent}", nn))
+        else:
+            edges.append(code_tree / nn)
+        if text is not None:
+            nt = WSTText(length=len(text), text=text)
+            nt._genkey()
+            docs.append(nt)
+            if compact_graph:
+                nn.text_key = nt._key
+            else:
+                edges.append(nn / nt)
+        docs.append(nn)
+    return docs, edges
+
+def test_node_edges_equal_non_compact_edges(key_scheme):
+    compact_docs, _ = collect(compact_graph=True)
+    _, expected = collect(compact_graph=False)
+    nodes = [orjson.loads(dump_document(d, compact=True)) for d in compact_docs if isinstance(d, WSTNode)]
+    edges = [e for n in nodes for e in node_edges(n)]
+    assert sorted(e.__dict__.items() for e in edges) == sorted(e.__dict__.items() for e in expected)
+
+def test_materialize_dirs_uses_the_recorded_key_scheme(tmp_path, key_scheme):
+    docs, _ = collect(compact_graph=True)
+    _, expected = collect(compact_graph=False)
+    exporter = WST_FileExporter(tmp_path)
+    exporter._open_all_append()
+    exporter.write_many_documents(docs)
+    exporter._close_all()
+    assert read_key_scheme(tmp_path) == key_scheme
+
+    set_key_scheme(KeyScheme())
+    assert materialize_dirs([tmp_path], workers=1) == len(expected)
+    written = [
+        d for p in tmp_path.glob("*.materialized.edge.jsonl") for d in iter_documents(p)
+    ]
+    assert sorted(d["_key"] for d in written) == sorted(e["_key"] for e in expected)
+
+def test_materialize_dirs_needs_a_recorded_key_scheme(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        materialize_dirs([tmp_path], workers=1)
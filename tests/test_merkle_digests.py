@@ -0,0 +1,73 @@
+import hashlib
+
+import pytest
+
+from wsyntree.wrap_tree_sitter import FlatTree, merkle_digests
+
+# (start, end, children) of "a = f(b, c)"
+CONTENT = b"a = f(b, c)"
+TREE = (0, 11, [
+    (0, 1, []),
+    (4, 11, [
+        (4, 5, []),
+        (5, 11, [(6, 7, []), (9, 10, [])]),
+    ]),
+])
+
+
+def flat_tree(tree) -> FlatTree:
+    ft = FlatTree()
+    def add(node, parent):
+        preorder = len(ft)
+        ft.parent.append(parent)
+        ft.start_byte.append(node[0])
+        ft.end_byte.append(node[1])
+        for child in node[2]:
+            add(child, preorder)
+    add(tree, -1)
+    return ft
+
+def direct_digests(tree, content, new_hash, finish):
+    """The documented format, hashing each node's text on its own"""
+    digests = []
+    def digest(node):
+        start, end, children = node
+        i = len(digests)
+        digests.append(None)
+        h = new_hash()
+        if not children:
+            h.update(b"\x00" + content[start:end])
+        else:
+            h.update(b"\x01")
+            pos = start
+            for child in children:
+                d = digest(child)
+                gap = content[pos:child[0]]
+                h.update(len(gap).to_bytes(8, "little") + gap)
+                h.update(len(d).to_bytes(8, "little") + d)
+                pos = child[1]
+            h.update((end - pos).to_bytes(8, "little") + content[pos:end])
+        digests[i] = finish(h)
+        return digests[i]
+    digest(tree)
+    return digests
+
+@pytest.mark.parametrize("algorithm, digest_size", [("shake_256", 64), ("blake2b", 16), ("blake2b", 8)])
+def test_merkle_digests_match_direct_hashing(algorithm, digest_size):
+    if algorithm == "shake_256":
+        new_hash, finish = hashlib.shake_256, lambda h: h.digest(digest_size)
+    else:
+        new_hash, finish = lambda: hashlib.blake2b(digest_size=digest_size), lambda h: h.digest()
+    expected = direct_digests(TREE, CONTENT, new_hash, finish)
+    assert merkle_digests(flat_tree(TREE), CONTENT, digest_size, algorithm) == expected
+
+def test_leaf_and_internal_digests_are_separated():
+    # a leaf whose text is the same bytes as an internal node's
+    inner = flat_tree((0, 3, [(1, 2, [])]))
+    leaf = flat_tree((0, 3, []))
+    assert merkle_digests(inner, b"(b)")[0] != merkle_digests(leaf, b"(b)")[0]
+    # the same text, split into a different child
+    other = flat_tree((0, 3, [(0, 1, [])]))
+    assert merkle_digests(inner, b"(b)")[0] != merkle_digests(other, b"(b)")[0]
+    # equal texts of equal shape digest equally
+    assert merkle_digests(flat_tree(TREE), CONTENT)[3] == merkle_digests(flat_tree((0, 1, [])), b"f")[0]
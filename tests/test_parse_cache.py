@@ -0,0 +1,38 @@
+import itertools
+import threading
+
+from wsyntree.constants import wsyntree_text_modes, wsyntree_text_hash_methods
+from wsyntree_collector.parse_cache import ParseCache, text_cache_options
+
+
+def test_text_cache_options_are_distinct():
+    combos = list(itertools.product(
+        wsyntree_text_modes, wsyntree_text_hash_methods, (0, 16), (False, True),
+    ))
+    options = {text_cache_options(*c) for c in combos}
+    assert len(options) == len(combos)
+    assert text_cache_options("full", "full") == "full/full"
+    assert text_cache_options("named", "merkle", 16, True) == "named/merkle2/inline16/compact"
+
+def test_entries_are_per_options(tmp_path):
+    cache = ParseCache(tmp_path / "cache.sqlite3")
+    cache.put("python", "v1", "abc", "python-abc", "full/full")
+    assert cache.get("python", "v1", "abc", "full/full") == "python-abc"
+    assert cache.get("python", "v1", "abc", "full/full/compact") is None
+    assert cache.get("python", "v2", "abc", "full/full") is None
+    # first record wins
+    cache.put("python", "v1", "abc", "other", "full/full")
+    assert cache.get("python", "v1", "abc", "full/full") == "python-abc"
+    assert len(cache) == 1
+
+def test_connections_per_thread(tmp_path):
+    cache = ParseCache(tmp_path / "cache.sqlite3")
+    def put(i):
+        cache.put("c", "v1", f"h{i}", f"c-h{i}")
+    threads = [threading.Thread(target=put, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(cache) == 8
+    assert cache.get("c", "v1", "h3") == "c-h3"
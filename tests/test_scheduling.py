@@ -0,0 +1,133 @@
+import concurrent.futures as futures
+import threading
+import time
+
+from wsyntree_collector.jsonl_batch import _RepoJob, _export_completed
+from wsyntree_collector.scheduling import FairTaskScheduler, size_ordered_tasks
+from wsyntree.tree_models import WSTFile
+
+
+class ManualExecutor():
+    """pebble-like executor whose tasks are completed by the test"""
+    def __init__(self):
+        self.scheduled = [] # (task, future)
+
+    def schedule(self, fn, args=(), kwargs=None):
+        f = futures.Future()
+        self.scheduled.append((args[0], f))
+        return f
+
+def _run_streams(streams: dict, max_pending: int, limit: int):
+    """Complete one task at a time, oldest first, returns the stream order"""
+    ex = ManualExecutor()
+    sched = FairTaskScheduler(ex, max_pending)
+    for key, tasks in streams.items():
+        sched.add(key, None, tasks)
+    order = []
+    done = 0
+    deadline = time.time() + 10
+    while len(order) < limit and time.time() < deadline:
+        sched.fill()
+        order = [t[0] for t, f in ex.scheduled]
+        if done < len(ex.scheduled):
+            ex.scheduled[done][1].set_result(None)
+            done += 1
+        sched.wait(timeout=1)
+    sched.cancel()
+    return order[:limit]
+
+def test_fair_turns_carry_over():
+    streams = {k: [(k, i) for i in range(50)] for k in "ABC"}
+    order = _run_streams(streams, max_pending=4, limit=60)
+    assert len(order) == 60
+    for k in "ABC":
+        # the first stream must not take most of the freed slots
+        assert 16 <= order.count(k) <= 24, "".join(order)
+
+def test_slow_stream_does_not_block_others():
+    release = threading.Event()
+
+    def slow():
+        release.wait(10)
+        yield ("S", 0)
+
+    ex = ManualExecutor()
+    sched = FairTaskScheduler(ex, 4)
+    sched.add("S", None, slow())
+    sched.add("F", None, [("F", i) for i in range(3)])
+    deadline = time.time() + 5
+    while len(ex.scheduled) < 3 and time.time() < deadline:
+        sched.fill()
+        sched.wait(timeout=0.5)
+    assert [t[0] for t, f in ex.scheduled] == ["F", "F", "F"]
+    release.set()
+    deadline = time.time() + 5
+    while len(ex.scheduled) < 4 and time.time() < deadline:
+        sched.wait(timeout=0.5)
+        sched.fill()
+    assert ex.scheduled[-1][0] == ("S", 0)
+    sched.cancel()
+
+def test_stream_errors_are_recorded():
+    def failing():
+        yield ("E", 0)
+        raise RuntimeError("enumeration failed")
+
+    ex = ManualExecutor()
+    sched = FairTaskScheduler(ex, 4)
+    sched.add("E", None, failing())
+    deadline = time.time() + 5
+    while "E" not in sched.exhausted and time.time() < deadline:
+        sched.fill()
+        sched.wait(timeout=0.5)
+    assert isinstance(sched.errors["E"], RuntimeError)
+    ex.scheduled[0][1].set_result(None)
+    sched.wait()
+    assert sched.finished() == ["E"]
+
+def test_size_ordered_tasks_packs_small_files():
+    files = [WSTFile(path=f"f{i}", size=size) for i, size in enumerate([10, 2 ** 20, 20, 30])]
+    tasks = list(size_ordered_tasks(files))
+    assert [f.path for f in tasks[0]] == ["f1"]
+    assert sorted(f.path for f in tasks[1]) == ["f0", "f2", "f3"]
+
+class _Collector():
+    def export_completed(self, completed_files):
+        return len(completed_files)
+
+class _FailingCollector():
+    def export_completed(self, completed_files):
+        raise RuntimeError("writer gone")
+
+class _Counter():
+    def __init__(self):
+        self.count = 0
+
+    def update(self, n):
+        self.count += n
+
+def test_failing_stream_with_several_completions_in_one_wait():
+    ex = ManualExecutor()
+    sched = FairTaskScheduler(ex, 8)
+    sched.add("bad", None, [("bad", i) for i in range(4)])
+    sched.add("ok", None, [("ok", i) for i in range(4)])
+    deadline = time.time() + 5
+    while len(ex.scheduled) < 8 and time.time() < deadline:
+        sched.fill()
+        sched.wait(timeout=0.5)
+    for _t, f in ex.scheduled:
+        f.set_result(["file"])
+    completed = sched.wait(timeout=1)
+    assert sum(1 for k, _f in completed if k == "bad") >= 2
+
+    jobs = {
+        "bad": _RepoJob({}, _FailingCollector(), None, None, _Counter()),
+        "ok": _RepoJob({}, _Collector(), None, None, _Counter()),
+    }
+    ok_cntr = jobs["ok"].cntr
+    finished = []
+    _export_completed(completed, jobs, sched, lambda job, status: finished.append(status))
+    assert finished == ["error"]
+    assert list(jobs) == ["ok"]
+    assert ok_cntr.count == sum(1 for k, _f in completed if k == "ok")
+    sched.cancel()
@@ -0,0 +1,45 @@
+from pebble import ProcessPool
+
+from wsyntree.tree_models import WSTFile, WSTText
+from wsyntree_collector.jsonl_frames import iter_documents
+from wsyntree_collector.jsonl_writer import WST_ShardWriter, finalize_shards, get_shard_writer
+from wsyntree_collector.parse_cache import ParseCacheEntry, get_parse_cache
+
+
+def write_texts(directory, start, n):
+    shard = get_shard_writer(directory, "zstd")
+    shard.put([WSTText(_key=f"{i}-x", length=1, text=str(i)) for i in range(start, start + n)])
+    shard.flush_if_needed()
+
+def test_worker_shards_are_written_when_the_pool_stops(tmp_path):
+    with ProcessPool(max_workers=2) as pool:
+        futures = [pool.schedule(write_texts, (tmp_path, i * 100, 100)) for i in range(20)]
+        for f in futures:
+            f.result()
+    manifest = finalize_shards(tmp_path, compression="zstd")
+    files = manifest["collections"][WSTText._collection]["files"]
+    assert 1 <= len(files) <= 2
+    keys = [d["_key"] for f in files for d in iter_documents(tmp_path / f["name"])]
+    assert sorted(keys) == sorted(f"{i}-x" for i in range(2000))
+
+def test_shard_parse_cache_entries_wait_for_their_documents(tmp_path):
+    cache_path = str(tmp_path / "cache.sqlite3")
+    shard = WST_ShardWriter(tmp_path / "out", "p1")
+    shard.put([WSTText(_key="1-x", length=1, text="1")])
+    shard.put(ParseCacheEntry(cache_path, "c", "v1", "def", "c-def", "full/full"))
+    shard.flush_if_needed()
+    # the document is still pending, so must the entry be
+    assert get_parse_cache(cache_path).get("c", "v1", "def", "full/full") is None
+    shard.flush()
+    assert get_parse_cache(cache_path).get("c", "v1", "def", "full/full") == "c-def"
+    shard.close()
+
+def test_compact_shard_writes_documents_compact(tmp_path):
+    shard = WST_ShardWriter(tmp_path, "main", compact=True)
+    shard.put(WSTFile(path="a.c", mode=0o100644, size=1, git_oid="0" * 40, content_hash="ab", language=None))
+    shard.close()
+    manifest = finalize_shards(tmp_path)
+    (f,) = manifest["collections"][WSTFile._collection]["files"]
+    (doc,) = iter_documents(tmp_path / f["name"])
+    assert "_id" not in doc
+    assert None not in doc.values()
@@ -0,0 +1,62 @@
+import multiprocessing
+import queue
+
+from pebble import ProcessPool
+
+from wsyntree.tree_models import WSTNode, WSTText
+from wsyntree_collector.text_dedup import (
+    TextDedupFilter, _receive_stats, text_dedup_stats,
+)
+
+
+def claim_range(text_dedup, start, n):
+    return text_dedup.claim(f"{i}-k" for i in range(start, start + n))
+
+def test_claim_across_processes(tmp_path):
+    with TextDedupFilter.create(slots=4096, dir=tmp_path) as text_dedup:
+        with ProcessPool(max_workers=4) as pool:
+            # overlapping ranges: keys 0..1499, most claimed by several tasks
+            futures = [pool.schedule(claim_range, (text_dedup, i * 100, 600)) for i in range(10)]
+            claimed = [f.result() for f in futures]
+        # every key is claimed by exactly one task
+        assert sum(map(len, claimed)) == 1500
+        assert set().union(*claimed) == {f"{i}-k" for i in range(1500)}
+        s = text_dedup.stats()
+        assert (s["used"], s["misses"], s["hits"], s["rejected"]) == (1500, 1500, 4500, 0)
+
+def test_full_table_rejects_but_keeps_texts(tmp_path):
+    with TextDedupFilter.create(slots=64, dir=tmp_path) as text_dedup:
+        keys = [f"{i}-k" for i in range(200)]
+        assert text_dedup.claim(keys) == set(keys)
+        s = text_dedup.stats()
+        assert s["rejected"] == 200 - s["used"] > 0
+
+def test_filter_documents_reports_stats(tmp_path):
+    docs = [WSTText(_key=f"{i}-k", length=1, text="x") for i in range(10)]
+    node_q = queue.Queue()
+    with TextDedupFilter.create(slots=4096, dir=tmp_path) as text_dedup:
+        node = WSTNode(_key="c-0")
+        assert text_dedup.filter_documents([node, *docs[:5]], node_q) == [node, *docs[:5]]
+        assert text_dedup.filter_documents(docs, node_q) == docs[5:]
+    assert [node_q.get_nowait() for _ in range(2)] == [
+        ("text_dedup_stats", {"hits": 0, "misses": 5, "rejected": 0}),
+        ("text_dedup_stats", {"hits": 5, "misses": 5, "rejected": 0}),
+    ]
+
+def test_stats_receiver_totals():
+    node_q = queue.Queue()
+    receiver = _receive_stats(node_q, 0.0)
+    node_q.put(("text_dedup_stats", {"hits": 1, "misses": 2, "rejected": 0}))
+    # other stats share the channel
+    node_q.put(("cache_stats", {"text_lfu_hit": 3}))
+    node_q.put(("text_dedup_stats", {"hits": 4, "misses": 0, "rejected": 5}))
+    node_q.put(None)
+    assert receiver.result(timeout=10) == {"hits": 5, "misses": 2, "rejected": 5}
+
+def test_text_dedup_stats_channel(tmp_path):
+    with multiprocessing.Manager() as mp_manager:
+        with text_dedup_stats(None, mp_manager) as node_q:
+            assert node_q is None
+        with TextDedupFilter.create(slots=4096, dir=tmp_path) as text_dedup, \
+                text_dedup_stats(text_dedup, mp_manager) as node_q:
+            text_dedup.filter_documents([WSTText(_key="1-k", length=1, text="x")], node_q)
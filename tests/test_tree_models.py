@@ -0,0 +1,22 @@
+import orjson
+
+from wsyntree.tree_models import WSTNode, WSTText
+from wsyntree_collector.jsonl_writer import dump_document
+
+
+def test_unset_optional_node_fields_are_left_out():
+    n = WSTNode(_key="python-abc-0", preorder=0, type="module", named=True,
+        x1=0, y1=0, x2=1, y2=0, start_byte=0, end_byte=10)
+    d = orjson.loads(dump_document(n))
+    assert not {"text", "parent", "text_key"} & d.keys()
+    assert d["_id"] == "wst_nodes/python-abc-0"
+
+    n.text = "pass"
+    n.parent = -1
+    d = orjson.loads(dump_document(n))
+    assert d["text"] == "pass" and d["parent"] == -1
+    assert "text_key" not in d
+
+def test_required_fields_are_kept_when_unset():
+    d = WSTText(_key="0-x").__dict__
+    assert d["text"] is None and d["length"] is None
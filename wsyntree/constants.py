@@ -2,7 +2,12 @@
 """
 "language": {
     "tsrepo": "repo_clone_url",
-    "file_ext": ".lang$"
+    "file_ext": ".lang$", # regex, kept for reference, see langdetect
+    "extensions": ["lang"], # without the dot, case sensitive
+    "filenames": ["Langfile"], # whole file names, optional
+    "exclude": "\.min\.lang$", # regex of paths to never match, optional
+    "interpreters": ["lang"], # names in a #! line, optional
+    "modelines": ["lang"], # vim ft= / emacs mode: names, optional
 }
 """
 
@@ -10,18 +15,32 @@ wsyntree_langs = {
     "javascript": {
         "tsrepo": "https://github.com/tree-sitter/tree-sitter-javascript.git",
         "file_ext": "(?<!(\.min))\.js$", # no .min.js
+        "extensions": ["js", "mjs", "cjs"],
+        "exclude": "\.min\.js$",
+        "interpreters": ["node", "nodejs"],
+        "modelines": ["javascript", "js"],
     },
     "python": {
         "tsrepo": "https://github.com/tree-sitter/tree-sitter-python.git",
         "file_ext": "\.py$",
+        "extensions": ["py", "pyi"],
+        "filenames": ["SConstruct", "SConscript"],
+        "interpreters": ["python", "pypy"],
+        "modelines": ["python"],
     },
     "rust": {
         "tsrepo": "https://github.com/tree-sitter/tree-sitter-rust.git",
         "file_ext": "\.rs$",
+        "extensions": ["rs"],
+        "modelines": ["rust"],
     },
     "ruby": {
         "tsrepo": "https://github.com/tree-sitter/tree-sitter-ruby.git",
         "file_ext": "\.rb$",
+        "extensions": ["rb", "rake", "gemspec"],
+        "filenames": ["Rakefile", "Gemfile", "Guardfile", "Vagrantfile"],
+        "interpreters": ["ruby", "jruby"],
+        "modelines": ["ruby"],
     },
     # "csharp": {
     #     "tsrepo": "https://github.com/tree-sitter/tree-sitter-c-sharp.git",
@@ -30,18 +49,27 @@ wsyntree_langs = {
     "c": {
         "tsrepo": "https://github.com/tree-sitter/tree-sitter-c.git",
         "file_ext": "\.(c|h)$",
+        # .h might also be C++, see langdetect
+        "extensions": ["c", "h"],
+        "modelines": ["c"],
     },
     "cpp": {
         "tsrepo": "https://github.com/tree-sitter/tree-sitter-cpp.git",
-        "file_ext": "\.(cpp|hpp|c\+\+|h\+\+|cc|hh|cxx|hxx)$"
+        "file_ext": "\.(cpp|hpp|c\+\+|h\+\+|cc|hh|cxx|hxx)$",
+        "extensions": ["cpp", "hpp", "c++", "h++", "cc", "hh", "cxx", "hxx"],
+        "modelines": ["cpp", "c++"],
     },
     "go": {
         "tsrepo": "https://github.com/tree-sitter/tree-sitter-go.git",
         "file_ext": "\.go$",
+        "extensions": ["go"],
+        "modelines": ["go"],
     },
     "java": {
         "tsrepo": "https://github.com/tree-sitter/tree-sitter-java.git",
         "file_ext": "\.java$",
+        "extensions": ["java"],
+        "modelines": ["java"],
     }
 }
 
@@ -49,3 +77,13 @@ wsyntree_file_to_lang = {}
 
 for k,v in wsyntree_langs.items():
     wsyntree_file_to_lang[v['file_ext']] = k
+
+# which nodes get their text stored by the collectors:
+# full: every node, leaves: nodes without children, named: only named nodes,
+# none: no text (rebuild it from the source blob using the node byte ranges)
+wsyntree_text_modes = ("full", "leaves", "named", "none")
+
+# how WSTText keys are hashed:
+# full: every node's text is hashed, merkle: hashes are built from the
+# hashes of child nodes so every byte of a file is hashed only once
+wsyntree_text_hash_methods = ("full", "merkle")
@@ -3,7 +3,9 @@ from typing import Callable
 
 import tenacity
 from tenacity.retry import retry_if_exception
+import requests.exceptions
 from arango.exceptions import (
+    ArangoServerError,
     DocumentInsertError as ArangoDocumentInsertError,
     AsyncJobResultError as ArangoAsyncJobResultError,
     BatchJobResultError as ArangoBatchJobResultError,
@@ -31,13 +33,53 @@ class UnhandledGitFileMode(ValueError, WSTBaseError):
 class DeduplicatedObjectMismatch(ValueError, WSTBaseError):
     pass
 
+class KeyCollisionError(ValueError, WSTBaseError):
+    """Different contents got the same key, see key_scheme"""
+    pass
+
+class BudgetExceeded(RuntimeError, WSTBaseError):
+    """A file went over one of its processing limits
+
+    code: the WST error code to record, e.g. WST_PARSE_TIMEOUT
+    """
+    def __init__(self, code: str, message: str = None):
+        super().__init__(f"{code}: {message}" if message else code)
+        self.code = code
+
+class BulkImportError(RuntimeError, WSTBaseError):
+    """Some documents of a bulk import failed
+
+    details: the error messages of the failed documents, from the server
+    """
+    def __init__(self, collection: str, details: list = None):
+        self.collection = collection
+        self.details = details or []
+        super().__init__(f"{len(self.details)} documents failed to import to {collection}: {self.details[:3]}")
+
+    @property
+    def conflicts_only(self) -> bool:
+        """Did documents only fail because of write-write conflicts"""
+        return bool(self.details) and all(
+            "conflict" in d and "unique constraint" not in d for d in self.details
+        )
+
 def isArangoWriteWriteConflict(e: ArangoDocumentInsertError) -> bool:
     """Is an exception a Write-Write conflict?"""
     if isinstance(e, ArangoDocumentInsertError):
         if e.error_code == arango.errno.CONFLICT:
             return True
+    if isinstance(e, BulkImportError):
+        return e.conflicts_only
     return False
 
+def isArangoTransientError(e: Exception) -> bool:
+    """Would sending the same request again likely succeed?"""
+    if isArangoWriteWriteConflict(e):
+        return True
+    if isinstance(e, ArangoServerError):
+        return e.http_code in (408, 429, 500, 502, 503, 504)
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
 def isArangoAsyncJobNotDone(e: ArangoAsyncJobResultError) -> bool:
     """Is an AsyncJobResultError because the job is not yet done?"""
     if isinstance(e, ArangoAsyncJobResultError):
@@ -89,3 +131,15 @@ def auto_batchjobdone_retry(f: Callable) -> Callable:
         retry=retry_if_exception(isArangoBatchJobNotDone),
         reraise=True,
     )(f)
+
+def auto_transient_retry(f: Callable) -> Callable:
+    """Decorator to retry requests failing on conflicts, overload or the network"""
+    return tenacity.retry(
+        stop=tenacity.stop.stop_after_attempt(10),
+        wait=tenacity.wait.wait_random_exponential(
+            multiplier=0.5,
+            max=30,
+        ),
+        retry=retry_if_exception(isArangoTransientError),
+        reraise=True,
+    )(f)
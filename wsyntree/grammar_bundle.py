@@ -0,0 +1,202 @@
+"""
+Prebuilt bundle of every tree-sitter grammar in one shared library
+
+Built ahead of time (`wsyntree-collector langs build`), so that collection
+never has to clone or compile grammars, nor wait on the per-language build
+lock of TreeSitterAutoBuiltLanguage.
+
+A bundle is a directory with the library and a manifest.json:
+{
+    "format": 1,
+    "library": "languages.so",
+    "languages": {
+        "python": {"commit": "<grammar repo commit>", "abi": 14, "source": "..."},
+        ...
+    }
+}
+"""
+
+from pathlib import Path
+from platform import system
+from typing import Dict, Iterable
+import concurrent.futures as futures
+import functools
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+import orjson
+import pygit2 as git
+from tree_sitter import Language, Parser
+
+from . import log
+from .localstorage import LocalCache
+from .constants import wsyntree_langs
+
+BUNDLE_FORMAT = 1
+_MANIFEST_NAME = "manifest.json"
+_LIBRARY_NAME = "languages.so"
+_abi_re = re.compile(rb"^#define LANGUAGE_VERSION (\d+)", re.MULTILINE)
+
+
+def default_bundle_dir() -> Path:
+    """WST_GRAMMAR_BUNDLE if set, otherwise inside the local cache"""
+    if "WST_GRAMMAR_BUNDLE" in os.environ:
+        return Path(os.environ["WST_GRAMMAR_BUNDLE"])
+    return LocalCache.get_local_cache_dir() / "grammar_bundle"
+
+def grammar_repo_name(lang: str) -> str:
+    """Directory name of a grammar's repo, e.g. tree-sitter-python"""
+    name = wsyntree_langs[lang]["tsrepo"].rstrip('/').rsplit('/', 1)[-1]
+    return name[:-len(".git")] if name.endswith(".git") else name
+
+class GrammarBundle():
+    def __init__(self, directory: Path):
+        self.dir = Path(directory)
+        manifest = orjson.loads((self.dir / _MANIFEST_NAME).read_bytes())
+        if manifest.get("format") != BUNDLE_FORMAT:
+            raise ValueError(f"{self.dir} bundle format {manifest.get('format')} is not {BUNDLE_FORMAT}")
+        self.library = self.dir / manifest["library"]
+        self.languages = manifest["languages"]
+
+    def __repr__(self):
+        return f"GrammarBundle<{self.dir}, {list(self.languages.keys())}>"
+
+    def __contains__(self, lang: str):
+        return lang in self.languages
+
+    def get_language(self, lang: str) -> Language:
+        return Language(str(self.library), lang)
+
+    def get_version(self, lang: str) -> str:
+        return self.languages[lang]["commit"]
+
+@functools.lru_cache(maxsize=None)
+def get_grammar_bundle(directory: Path = None) -> GrammarBundle:
+    """The bundle in directory (default_bundle_dir()), or None if not built"""
+    directory = Path(directory or default_bundle_dir())
+    if not (directory / _MANIFEST_NAME).exists():
+        return None
+    bundle = GrammarBundle(directory)
+    log.debug(f"using {bundle}")
+    return bundle
+
+def find_grammar_source(lang: str, source_dirs: Iterable[Path]) -> Path:
+    """Local grammar repo of a language: in one of source_dirs, or the TSABL cache"""
+    for d in source_dirs:
+        for candidate in (Path(d) / grammar_repo_name(lang), Path(d) / lang):
+            if (candidate / "src" / "parser.c").exists():
+                return candidate
+    cached = LocalCache.get_local_cache_dir() / lang / "tsrepo"
+    if (cached / "src" / "parser.c").exists():
+        return cached
+    return None
+
+def grammar_commit(source: Path) -> str:
+    """Commit of a grammar checkout, or a hash of its parser if not a git repo"""
+    repopath = git.discover_repository(str(source.resolve()))
+    if repopath is not None:
+        return str(git.Repository(repopath).head.target)
+    return "src-" + hashlib.shake_256((source / "src" / "parser.c").read_bytes()).hexdigest(20)
+
+def grammar_abi(source: Path) -> int:
+    """LANGUAGE_VERSION the grammar's parser was generated with"""
+    with (source / "src" / "parser.c").open('rb') as f:
+        m = _abi_re.search(f.read(2 ** 16))
+    return int(m.group(1)) if m else None
+
+def _grammar_sources(source: Path):
+    src = source / "src"
+    yield src / "parser.c"
+    for scanner in ("scanner.cc", "scanner.c"):
+        if (src / scanner).exists():
+            yield src / scanner
+            break
+
+def _compile_source(source_file: Path, output_dir: str) -> str:
+    # local import like Language.build_library, distutils is only needed here
+    from distutils.ccompiler import new_compiler
+    from distutils.unixccompiler import UnixCCompiler
+    compiler = new_compiler()
+    if isinstance(compiler, UnixCCompiler):
+        compiler.set_executables(compiler_cxx="c++")
+    flags = None
+    if system() != "Windows":
+        flags = ["-fPIC", "-O2"]
+        if source_file.suffix == ".c":
+            flags.append("-std=c11")
+    return compiler.compile(
+        [str(source_file)],
+        output_dir=output_dir,
+        include_dirs=[str(source_file.parent)],
+        extra_preargs=flags,
+    )[0]
+
+def build_grammar_bundle(
+        output_dir: Path,
+        sources: Dict[str, Path],
+        workers: int = None,
+    ) -> GrammarBundle:
+    """Compile the grammars (lang -> grammar repo dir) into one bundle
+
+    Every source file is compiled in parallel, then all are linked into a
+    single library. Each language is loaded back to check that its ABI is
+    supported by the tree_sitter bindings.
+    """
+    from distutils.ccompiler import new_compiler
+    from distutils.unixccompiler import UnixCCompiler
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    library = output_dir / _LIBRARY_NAME
+    tmp_library = output_dir / f".{_LIBRARY_NAME}.{os.getpid()}"
+    start = time.time()
+    with tempfile.TemporaryDirectory(suffix="wst_grammar_bundle") as tmpdir:
+        jobs = {}
+        with futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            for lang, source in sources.items():
+                for source_file in _grammar_sources(source):
+                    jobs[pool.submit(_compile_source, source_file, f"{tmpdir}/{lang}")] = source_file
+            objects = []
+            for job in futures.as_completed(jobs):
+                objects.append(job.result())
+                log.debug(f"compiled {jobs[job]}")
+        cpp = any(s.suffix == ".cc" for s in jobs.values())
+        compiler = new_compiler()
+        if isinstance(compiler, UnixCCompiler):
+            compiler.set_executables(compiler_cxx="c++")
+        compiler.link_shared_object(
+            sorted(objects), str(tmp_library), target_lang="c++" if cpp else "c",
+        )
+    log.info(f"built {len(sources)} grammars in {round(time.time() - start)} seconds")
+
+    languages = {}
+    incompatible = []
+    for lang, source in sources.items():
+        try:
+            Parser().set_language(Language(str(tmp_library), lang))
+        except ValueError as e:
+            incompatible.append(f"{lang} (ABI {grammar_abi(source)}): {e}")
+            continue
+        languages[lang] = {
+            "commit": grammar_commit(source),
+            "abi": grammar_abi(source),
+            "source": str(source.resolve()),
+        }
+    if incompatible:
+        tmp_library.unlink()
+        raise RuntimeError(f"grammars incompatible with the tree_sitter bindings: {incompatible}")
+
+    # replace, never modify, a library other processes may have loaded
+    os.replace(tmp_library, library)
+    manifest = {
+        "format": BUNDLE_FORMAT,
+        "library": _LIBRARY_NAME,
+        "built": int(time.time()),
+        "languages": languages,
+    }
+    with (output_dir / _MANIFEST_NAME).open('wb') as f:
+        f.write(orjson.dumps(manifest, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE))
+    get_grammar_bundle.cache_clear()
+    return GrammarBundle(output_dir)
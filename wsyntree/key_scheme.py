@@ -0,0 +1,144 @@
+"""
+Versioned formats of the document keys
+
+Keys are made from content hashes, so that the same content always gets the
+same key, in every run. They are also most of the bytes of the collected
+data, and of the database's primary indexes.
+
+v1: the original format, 64 byte shake256 digests everywhere
+    WSTCodeTree "{language}-{128 hex}", WSTNode "{codetree key}-{preorder}",
+    WSTText "{length}-{128 hex}" or "m1.2-{length}-{128 hex}" (merkle),
+    WSTFile "{64 hex of path}-{oct mode}-{content hash}", edges 128 hex
+v2: BLAKE2b digests of digest_bytes (default 16), the same layouts except
+    WSTText "{length}-{hex}" or "m2.2-{length}-{hex}" (merkle),
+    WSTFile "{hex of path, mode and content hash}"
+
+Merkle WSTText keys also carry the format of wrap_tree_sitter.merkle_digests
+(MERKLE_FORMAT): "m1-" and "m2-" keys are of format 1, without domain
+separation.
+
+The collected data of one database must all use the same scheme: the keys
+of the same content differ between schemes (and digest sizes).
+
+Collisions of digests are detected where the colliding documents meet
+(texts of one file, existing WSTFiles and WSTCodeTrees in Arango mode) and
+raise KeyCollisionError. Keep digests long enough for the number of
+documents: see KeyScheme.collision_probability.
+"""
+
+from typing import Union
+import hashlib
+
+from . import log
+
+key_scheme_versions = (1, 2)
+DEFAULT_VERSION = 2
+DEFAULT_DIGEST_BYTES = 16
+MIN_DIGEST_BYTES = 8
+MAX_DIGEST_BYTES = 64 # largest BLAKE2b digest
+# format of wrap_tree_sitter.merkle_digests, bump on any change
+MERKLE_FORMAT = 2
+
+
+class KeyScheme():
+    """Makes the keys and content hashes of documents, see module docs"""
+    def __init__(self, version: int = DEFAULT_VERSION, digest_bytes: int = DEFAULT_DIGEST_BYTES):
+        """digest_bytes: size of the v2 digests, v1 always uses 64"""
+        if version not in key_scheme_versions:
+            raise ValueError(f"key scheme version must be one of {key_scheme_versions}, not {version!r}")
+        if version == 1:
+            digest_bytes = 64
+        elif not MIN_DIGEST_BYTES <= digest_bytes <= MAX_DIGEST_BYTES:
+            raise ValueError(f"digest_bytes must be between {MIN_DIGEST_BYTES} and {MAX_DIGEST_BYTES}")
+        self.version = version
+        self.digest_bytes = digest_bytes
+
+    def __repr__(self):
+        return f"KeyScheme<v{self.version}, {self.digest_bytes} byte digests>"
+
+    def __eq__(self, other):
+        return isinstance(other, KeyScheme) and \
+            (self.version, self.digest_bytes) == (other.version, other.digest_bytes)
+
+    def __hash__(self):
+        return hash((self.version, self.digest_bytes))
+
+    @property
+    def hash_algorithm(self) -> str:
+        """hashlib name of the digests, for wrap_tree_sitter.merkle_digests"""
+        return "shake_256" if self.version == 1 else "blake2b"
+
+    @property
+    def merkle_key_prefix(self) -> str:
+        return f"m{self.version}.{MERKLE_FORMAT}-"
+
+    def hexdigest(self, data: Union[bytes, str], size: int = None) -> str:
+        """Digest of data, size bytes (default digest_bytes) as hex"""
+        if isinstance(data, str):
+            data = data.encode()
+        if self.version == 1:
+            return hashlib.shake_256(data).hexdigest(size or self.digest_bytes)
+        return hashlib.blake2b(data, digest_size=size or self.digest_bytes).hexdigest()
+
+    def content_hash(self, content: bytes) -> str:
+        """WSTFile and WSTCodeTree content_hash"""
+        return self.hexdigest(content)
+
+    def text_key(self, text: str, length: int, merkle_digest: bytes = None) -> str:
+        """WSTText key, merkle_digest: of the node, see merkle_digests"""
+        if merkle_digest is None:
+            return f"{length}-{self.hexdigest(text)}"
+        return f"{self.merkle_key_prefix}{length}-{merkle_digest.hex()}"
+
+    def file_key(self, path: str, mode: int, content_hash: str) -> str:
+        if self.version == 1:
+            return f"{self.hexdigest(path, 32)}-{oct(mode)}-{content_hash}"
+        return self.hexdigest(f"{path}\0{oct(mode)}\0{content_hash}")
+
+    def edge_key(self, from_key: str, to_key: str) -> str:
+        # hash the keys because each vert's key could be >= half the max key size
+        return self.hexdigest(f"{from_key}+{to_key}")
+
+    def repo_key(self, url: str) -> str:
+        return self.hexdigest(url)
+
+    def collision_probability(self, n: int) -> float:
+        """Birthday bound of any collision among n keys of one kind"""
+        return min(1.0, n * (n - 1) / 2 / 2 ** (8 * self.digest_bytes))
+
+_key_scheme = KeyScheme()
+
+def get_key_scheme() -> KeyScheme:
+    """The key scheme of the current process"""
+    return _key_scheme
+
+def set_key_scheme(scheme: KeyScheme):
+    """Use scheme for the keys generated by this process (and later forks)"""
+    global _key_scheme
+    if scheme != _key_scheme:
+        log.debug(f"using {scheme}")
+    _key_scheme = scheme
+
+def add_key_scheme_args(parser):
+    """Add the key scheme options to a command"""
+    parser.add_argument(
+        "--key-scheme",
+        type=int,
+        choices=key_scheme_versions,
+        help="Document key format, 1 for keys compatible with data collected before v2 (default: %(default)s)",
+        default=DEFAULT_VERSION,
+    )
+    parser.add_argument(
+        "--key-digest-bytes",
+        type=int,
+        help=f"Size of the v2 key digests, {MIN_DIGEST_BYTES} to {MAX_DIGEST_BYTES} (default: %(default)s)",
+        default=DEFAULT_DIGEST_BYTES,
+    )
+
+def key_scheme_from_args(args) -> KeyScheme:
+    """The KeyScheme of the options, also set for this process"""
+    scheme = KeyScheme(args.key_scheme, args.key_digest_bytes)
+    if scheme.collision_probability(2 ** 32) > 1e-6:
+        log.warn(f"{scheme}: key collisions are likely with billions of documents, use more --key-digest-bytes")
+    set_key_scheme(scheme)
+    return scheme
@@ -0,0 +1,173 @@
+"""
+Language detection for file paths (and optionally their content)
+
+Built once at import time from constants.wsyntree_langs:
+- a hash table of file extensions and one of whole file names
+- one combined regex of all the unusual cases (excluded paths)
+- for paths that match nothing, optional sniffing of the content:
+  #! interpreter lines, and vim / emacs modelines
+- C/C++ disambiguation of .h headers by content
+"""
+
+from typing import Optional
+import re
+
+from . import log
+from .constants import wsyntree_langs
+
+# how much of the content to look at when sniffing
+SNIFF_BYTES = 2 ** 12
+# modelines are only looked for in the first and last lines
+MODELINE_LINES = 5
+
+_shebang_re = re.compile(
+    rb"^#![ \t]*(?:\S*/)?(?:env[ \t]+(?:-\S+[ \t]+)*)?([A-Za-z_+-]+?)[0-9.]*(?:[ \t]|$)",
+    re.MULTILINE,
+)
+_modeline_re = re.compile(
+    rb"(?:\bvim?:.*?\b(?:ft|filetype|syntax)=([A-Za-z+]+)"
+    rb"|-\*-.*?\b[Mm]ode:[ \t]*([A-Za-z+]+))"
+)
+# markers of C++ in a .h header that C never has
+_cpp_header_re = re.compile(
+    rb"^[ \t]*(?:class[ \t]+\w+[^;]*$|namespace\b|template[ \t]*<|using[ \t]+namespace\b"
+    rb"|(?:public|private|protected)[ \t]*:|#[ \t]*include[ \t]*<(?:iostream|string|vector|memory|map)>)",
+    re.MULTILINE,
+)
+
+
+class LanguageDetector():
+    def __init__(self, langs: dict = wsyntree_langs):
+        self.extensions = {}
+        self.filenames = {}
+        self.interpreters = {}
+        self.modelines = {}
+        excludes = []
+        # the exclusion regex only needs to run for these:
+        self._langs_with_excludes = set()
+        for lang, spec in langs.items():
+            for table, key in (
+                    (self.extensions, "extensions"),
+                    (self.filenames, "filenames"),
+                    (self.interpreters, "interpreters"),
+                    (self.modelines, "modelines"),
+                ):
+                for name in spec.get(key, ()):
+                    if name in table:
+                        log.warn(f"{key} entry {name} of {lang} already used by {table[name]}")
+                        continue
+                    table[name] = lang
+            if "exclude" in spec:
+                excludes.append(f"(?:{spec['exclude']})")
+                self._langs_with_excludes.add(lang)
+        self._exclude_re = re.compile("|".join(excludes)) if excludes else None
+
+    def __repr__(self):
+        return f"LanguageDetector<{len(self.extensions)} extensions, {len(self.filenames)} filenames>"
+
+    def _is_excluded(self, path: str) -> bool:
+        return self._exclude_re is not None and self._exclude_re.search(path) is not None
+
+    def detect_path(self, path: str) -> Optional[str]:
+        """Language name of a path, using only the path"""
+        name = path.rsplit('/', 1)[-1]
+        lang = self.filenames.get(name)
+        if lang is not None:
+            return lang
+        _, dot, ext = name.rpartition('.')
+        if not dot:
+            return None
+        lang = self.extensions.get(ext)
+        if lang in self._langs_with_excludes and self._is_excluded(path):
+            return None
+        return lang
+
+    def sniff(self, content: bytes) -> Optional[str]:
+        """Language name from a #! line or modeline in the content"""
+        head = content[:SNIFF_BYTES]
+        if head.startswith(b"#!"):
+            m = _shebang_re.match(head)
+            if m and (lang := self.interpreters.get(m.group(1).decode())):
+                return lang
+        lines = head.split(b"\n", MODELINE_LINES)[:MODELINE_LINES]
+        lines += content[-SNIFF_BYTES:].rsplit(b"\n", MODELINE_LINES)[-MODELINE_LINES:]
+        for line in lines:
+            m = _modeline_re.search(line)
+            if m:
+                name = (m.group(1) or m.group(2)).decode().lower()
+                if (lang := self.modelines.get(name)):
+                    return lang
+        return None
+
+    def detect(self, path: str, content: bytes = None) -> Optional[str]:
+        """Language name of a file, or None
+
+        content: if given, used for .h headers and paths that match nothing
+        """
+        lang = self.detect_path(path)
+        if content is None:
+            return lang
+        if lang is None:
+            if self._is_excluded(path):
+                return None
+            return self.sniff(content)
+        if lang == "c" and path.endswith(".h"):
+            if _cpp_header_re.search(content[:SNIFF_BYTES * 16]):
+                return "cpp"
+        return lang
+
+detector = LanguageDetector()
+
+def detect_language(path: str, content: bytes = None) -> Optional[str]:
+    """Language name of a file using the default detector, see LanguageDetector.detect"""
+    return detector.detect(path, content)
+
+if __name__ == '__main__':
+    # micro-benchmark against the previous detection method
+    import argparse
+    import subprocess
+    import time
+
+    from .constants import wsyntree_file_to_lang
+
+    parser = argparse.ArgumentParser(description="Benchmark language detection")
+    parser.add_argument(
+        "repo",
+        type=str,
+        nargs="?",
+        help="git repository to take the file listing from",
+        default=".",
+    )
+    parser.add_argument(
+        "-n", "--repeat",
+        type=int,
+        help="times to classify the listing",
+        default=10,
+    )
+    args = parser.parse_args()
+
+    paths = subprocess.run(
+        ["git", "-C", args.repo, "ls-files", "-z"],
+        check=True, capture_output=True,
+    ).stdout.decode(errors='surrogateescape').split('\0')[:-1]
+
+    def regex_loop(path):
+        for k, v in wsyntree_file_to_lang.items():
+            if re.search(re.compile(k), path):
+                return v
+        return None
+
+    def bench(name, fn):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            result = fn()
+        elapsed = time.perf_counter() - start
+        per_file = elapsed / (args.repeat * max(len(paths), 1)) * 1e9
+        log.info(f"{name}: {elapsed:.3f}s, {per_file:.0f} ns/file")
+        return result
+
+    log.info(f"classifying {len(paths)} files {args.repeat} times")
+    old = bench("regex loop", lambda: [regex_loop(p) for p in paths])
+    new = bench("detect_path", lambda: [detector.detect_path(p) for p in paths])
+    changed = sum(1 for a, b in zip(old, new) if a != b)
+    log.info(f"{changed} of {len(paths)} files classified differently")
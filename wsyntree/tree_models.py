@@ -9,8 +9,9 @@ import tenacity
 from tenacity.retry import retry_if_exception
 
 from . import log
-from .utils import dotdict, shake256hex
+from .utils import dotdict
 from .exceptions import *
+from .key_scheme import get_key_scheme
 
 __all__ = [
     'WST_Document', 'WST_Edge',
@@ -27,6 +28,8 @@ class WST_Document():
         "__collection",
         "_key",
     ]
+    # slots left out of the document while unset (None)
+    _optional_slots = frozenset()
 
     @classmethod
     def get(cls, db, key):
@@ -92,6 +95,9 @@ class WST_Document():
         attrs = {
             s: getattr(self, s, None) for s in slots if not s.startswith('__')
         }
+        for s in self._optional_slots:
+            if attrs.get(s, 0) is None:
+                del attrs[s]
         return {
             **attrs,
             "_id": self._id,
@@ -211,8 +217,7 @@ class WST_Edge(dict):
             raise TypeError(f"cannot connect type {_src_cls.__name__} to {nto}, edge collection from {_src_cls._collection} to {self._to_collection} not set")
         self._edge_collection = _src_cls._edge_to[self._to_collection]
 
-        # hash the keys because each vert's key could be >= half the max key size
-        self["_key"] = shake256hex(f"{self._from_key}+{self._to_key}", 64)
+        self["_key"] = get_key_scheme().edge_key(self._from_key, self._to_key)
         self["_from"] = f"{self._from_collection}/{self._from_key}"
         self["_to"] = f"{self._to_collection}/{self._to_key}"
 
@@ -263,17 +268,33 @@ class WST_Edge(dict):
 # notable exceptions include guarantees like WST `language` names length
 
 class WSTText(WST_Document):
+    """Deduplicated text content of one or more WSTNodes
+
+    The key format tells which hash was used, see WSTText.key_hash_method:
+    full: "{length}-{digest of text}"
+    merkle: "m{key scheme version}.{merkle format}-{length}-{merkle digest}",
+        see wrap_tree_sitter.merkle_digests
+    """
     _collection = "wst_texts"
+    # only merkle keys start with a letter, also those of older formats
+    _merkle_key_prefixes = ("m",)
     __slots__ = [
         "length",
         "text",
         # "content_hash", # 128 hex chars
     ]
 
-    def _genkey(self):
-        self._key = f"{self.length}-{shake256hex(self.text.encode(), 64)}"
+    def _genkey(self, merkle_digest: bytes = None):
+        self._key = get_key_scheme().text_key(self.text, self.length, merkle_digest)
         return self._key
 
+    @classmethod
+    def key_hash_method(cls, key: str) -> str:
+        """Which of constants.wsyntree_text_hash_methods generated a key"""
+        if key.startswith(cls._merkle_key_prefixes):
+            return "merkle"
+        return "full"
+
     def insert_in_db(self, db: Union[StandardDatabase, BatchDatabase], **kwargs):
         """WSTTexts might be duplicate
 
@@ -301,6 +322,10 @@ class WSTNode(WST_Document):
         "x2",
         "y2",
 
+        # byte offsets into the file content, [start_byte, end_byte)
+        "start_byte",
+        "end_byte",
+
         # preorder: depth-first traversal order, unique within WSTCodeTree
         # aka: topologically sorted
         # root node is zero and has no parent
@@ -308,7 +333,35 @@ class WSTNode(WST_Document):
 
         "named",
         "type",
+
+        # texts up to the collector's text_inline bytes are stored here,
+        # longer ones in a WSTText (see get_text), None if not inline
+        "text",
+
+        # compact graph output only, instead of the structural edges:
+        # preorder of the parent node, -1 for the root node
+        "parent",
+        # key of the node's WSTText
+        "text_key",
     ]
+    _optional_slots = frozenset(["text", "parent", "text_key"])
+
+    def get_text(self, db) -> str:
+        """Text of this node, inline or from its WSTText, None if not stored"""
+        if getattr(self, "text", None) is not None:
+            return self.text
+        if getattr(self, "text_key", None) is not None:
+            nt = WSTText.get(db, self.text_key)
+        else:
+            nt = next(self.get_children(db, WSTText), None)
+        return nt.text if nt is not None else None
+
+    def text_from_source(self, source: bytes) -> str:
+        """Rebuild the text of this node from the content of its file
+
+        Used for nodes collected without a WSTText, see WSTCodeTree.read_source
+        """
+        return source[self.start_byte:self.end_byte].decode()
 
 class WSTCodeTree(WST_Document):
     """A code tree is a parsed syntax tree"""
@@ -320,13 +373,17 @@ class WSTCodeTree(WST_Document):
     __slots__ = [
         "language", # WST lang id
         "lang_version", # probably the commit of tree-sitter language lib used
-        "content_hash", # 128 hex chars
+        "content_hash", # hex, see key_scheme
         "git_oid",
 
         # set when we could not generate all WSTNodes
         "error", # any reason the CodeTree may not be accurate or complete
     ]
 
+    def read_source(self, repo) -> bytes:
+        """Read the content this tree was parsed from out of a pygit2 Repository"""
+        return repo[self.git_oid].data
+
 class WSTFile(WST_Document):
     _collection = "wst_files"
     _edge_to = {
@@ -344,11 +401,11 @@ class WSTFile(WST_Document):
 
         # so that we can build _key / _id to a CodeTree without a lookup,
         # this needs to match WSTCodeTree.content_hash
-        "content_hash", # 128 hex chars
+        "content_hash", # hex, see key_scheme
     ]
 
     def _genkey(self):
-        self._key = f"{shake256hex(self.path, 32)}-{oct(self.mode)}-{self.content_hash}"
+        self._key = get_key_scheme().file_key(self.path, self.mode, self.content_hash)
         return self._key
 
 class WSTCommit(WST_Document):
@@ -381,7 +438,7 @@ class WSTRepository(WST_Document):
     ]
 
     def _genkey(self):
-        self._key = f"{shake256hex(self.url, 64)}"
+        self._key = get_key_scheme().repo_key(self.url)
         return self._key
 
 # autogenerate names for the database:
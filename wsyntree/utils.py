@@ -3,6 +3,7 @@ import os
 import itertools
 from pathlib import Path
 import contextlib
+import functools
 import hashlib
 from urllib.parse import urlparse
 from typing import Union
@@ -18,6 +19,31 @@ def list_all_git_files(repo: git.Repository, relative=True):
             p = Path(entry.path)
             yield p if relative else Path(repo.path).join(p)
 
+def iter_git_tree_files(repo: git.Repository, tree: git.Tree, prefix: str = ""):
+    """Recursively iterate the files of a git tree without a checkout
+
+    Yields (path, filemode, oid) for every non-tree entry.
+    """
+    for entry in tree:
+        path = f"{prefix}{entry.name}"
+        if entry.filemode == git.GIT_FILEMODE_TREE:
+            yield from iter_git_tree_files(repo, repo[entry.id], prefix=f"{path}/")
+        else:
+            yield path, entry.filemode, entry.id
+
+def git_object_size(repo: git.Repository, oid) -> int:
+    """Size of a git object, from the object header where pygit2 supports it"""
+    odb = repo.odb
+    if hasattr(odb, 'read_header'):
+        _otype, size = odb.read_header(oid)
+        return size
+    return repo[oid].size
+
+@functools.lru_cache(maxsize=16)
+def open_git_repo(path: str) -> git.Repository:
+    """Per-process cached Repository, for reading objects from many tasks"""
+    return git.Repository(path)
+
 @contextlib.contextmanager
 def pushd(new_dir):
     previous_dir = os.getcwd()
@@ -74,7 +100,10 @@ def strip_url(u: str):
 
 def desensitize_url(u: str):
     p = urlparse(u)
-    return f"{p.scheme}://{p.username}@{p.hostname}:{p.port}{p.path}"
+    # netloc may list many hosts, which urlparse can't split
+    userinfo, _, hosts = p.netloc.rpartition('@')
+    username = userinfo.partition(':')[0] or None
+    return f"{p.scheme}://{username}@{hosts}{p.path}"
 
 def sha1hex(s: str) -> str:
     return hashlib.sha1(s.encode()).hexdigest()
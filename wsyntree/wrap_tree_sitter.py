@@ -1,8 +1,9 @@
 
 from pathlib import Path
 from typing import AnyStr, Callable
+from array import array
 import functools
-import re
+import hashlib
 import time
 
 import pebble
@@ -12,8 +13,11 @@ import filelock
 from filelock import FileLock
 
 from . import log
+from .exceptions import BudgetExceeded
 from .localstorage import LocalCache
-from .constants import wsyntree_langs, wsyntree_file_to_lang
+from .constants import wsyntree_langs, wsyntree_text_modes
+from .langdetect import detect_language
+from .grammar_bundle import get_grammar_bundle
 
 
 class TreeSitterAutoBuiltLanguage():
@@ -21,6 +25,8 @@ class TreeSitterAutoBuiltLanguage():
         self.lang = lang
         self.parser = None
         self.ts_language = None
+        self.version = None
+        self._timeout_micros = 0
         # use this lock when modifying the cachedir:
         self.ts_lang_cache_lock = FileLock(self._get_language_cache_dir() / "tsabl.lock")
 
@@ -79,6 +85,12 @@ class TreeSitterAutoBuiltLanguage():
     def _get_ts_language(self):
         if self.ts_language is not None:
             return self.ts_language
+        bundle = get_grammar_bundle()
+        if bundle is not None and self.lang in bundle:
+            # prebuilt, no cloning, building or locking needed
+            self.ts_language = bundle.get_language(self.lang)
+            self.version = bundle.get_version(self.lang)
+            return self.ts_language
         self.ts_language = Language(
             self._get_language_library(),
             self.lang
@@ -97,6 +109,30 @@ class TreeSitterAutoBuiltLanguage():
     def get_parser(self):
         return self._get_parser()
 
+    def is_available(self) -> bool:
+        """Can the language be loaded without cloning or building anything"""
+        if self.ts_language is not None:
+            return True
+        bundle = get_grammar_bundle()
+        if bundle is not None and self.lang in bundle:
+            return True
+        return (self._get_language_cache_dir() / "language.so").exists()
+
+    def get_source_dir(self) -> Path:
+        """Local clone of the tree-sitter language repo, cloned if needed"""
+        self._get_language_repo()
+        return self._get_language_repo_path()
+
+    def get_version(self) -> str:
+        """The commit of the tree-sitter language repo in use"""
+        if self.version is None:
+            bundle = get_grammar_bundle()
+            if bundle is not None and self.lang in bundle:
+                self.version = bundle.get_version(self.lang)
+            else:
+                self.version = str(self._get_language_repo().head.target)
+        return self.version
+
     def parse_file(self, file):
         if issubclass(type(file), Path):
             return self._get_parser().parse(
@@ -109,6 +145,36 @@ class TreeSitterAutoBuiltLanguage():
         else:
             raise NotImplementedError(f"cannot understand file argument of type {type(file)}")
 
+    def parse_bytes(self, content: bytes, old_tree = None, timeout_micros: int = None):
+        """Parse content already read into memory
+
+        old_tree: an earlier tree, already edited to match content
+            (see content_edit), to reparse incrementally
+        timeout_micros: stop parsing after this long, raising BudgetExceeded
+            with WST_PARSE_TIMEOUT
+        """
+        parser = self._get_parser()
+        timeout_micros = timeout_micros or 0
+        if timeout_micros != self._timeout_micros:
+            # the parser is reused, only touch the timeout when it changes
+            parser.set_timeout_micros(timeout_micros)
+            self._timeout_micros = timeout_micros
+        try:
+            if old_tree is None:
+                tree = parser.parse(content)
+            else:
+                tree = parser.parse(content, old_tree)
+        except ValueError as e:
+            # the bindings raise when the parse was halted
+            if not timeout_micros:
+                raise
+            tree = None
+        if tree is None:
+            # otherwise the next parse would resume this one
+            parser.reset()
+            raise BudgetExceeded("WST_PARSE_TIMEOUT", f"{self} parse took over {timeout_micros}us")
+        return tree
+
 class TreeSitterCursorIterator(): # cannot subclass TreeCursor because it's C
     """Iterator wrapper for a TreeCursor
 
@@ -169,15 +235,268 @@ class TreeSitterCursorIterator(): # cannot subclass TreeCursor because it's C
         return self._cursor.node
 
 
+class FlatTree():
+    """Struct-of-arrays representation of a parsed tree
+
+    Every array is indexed by preorder (depth-first traversal order),
+    the root node is preorder zero and has a parent of -1.
+
+    kind: index into `kinds`, ids are local to this FlatTree
+    named: 1 if the node is named, else 0
+    """
+    __slots__ = [
+        "parent",
+        "depth",
+        "start_row",
+        "start_col",
+        "end_row",
+        "end_col",
+        "start_byte",
+        "end_byte",
+        "kind",
+        "named",
+        "kinds",
+    ]
+
+    def __init__(self):
+        self.parent = array('q')
+        self.depth = array('q')
+        self.start_row = array('q')
+        self.start_col = array('q')
+        self.end_row = array('q')
+        self.end_col = array('q')
+        self.start_byte = array('q')
+        self.end_byte = array('q')
+        self.kind = array('q')
+        self.named = array('B')
+        self.kinds = []
+
+    def __len__(self):
+        return len(self.parent)
+
+    def __repr__(self):
+        return f"FlatTree<{len(self)} nodes, {len(self.kinds)} kinds>"
+
+    @property
+    def preorder(self) -> range:
+        return range(len(self))
+
+    def type(self, preorder: int) -> str:
+        return self.kinds[self.kind[preorder]]
+
+    def is_leaf(self, preorder: int) -> bool:
+        """A node is a leaf when the next node in preorder is not its child"""
+        nxt = preorder + 1
+        return nxt >= len(self.parent) or self.parent[nxt] != preorder
+
+def flatten_tree(tree, max_nodes: int = None) -> FlatTree:
+    """Walk a tree-sitter Tree once, returning a FlatTree of all its nodes
+
+    max_nodes: raise BudgetExceeded with WST_TOO_MANY_NODES once the tree
+        is known to have more nodes than this
+    """
+    if max_nodes is None:
+        max_nodes = -1
+    ft = FlatTree()
+    kind_ids = {}
+    kinds = ft.kinds
+    add_parent = ft.parent.append
+    add_depth = ft.depth.append
+    add_start_row = ft.start_row.append
+    add_start_col = ft.start_col.append
+    add_end_row = ft.end_row.append
+    add_end_col = ft.end_col.append
+    add_start_byte = ft.start_byte.append
+    add_end_byte = ft.end_byte.append
+    add_kind = ft.kind.append
+    add_named = ft.named.append
+
+    cursor = tree.walk()
+    parent_stack = []
+    preorder = 0
+    while True:
+        if preorder == max_nodes:
+            raise BudgetExceeded("WST_TOO_MANY_NODES", f"tree has over {max_nodes} nodes")
+        node = cursor.node
+        add_parent(parent_stack[-1] if parent_stack else -1)
+        add_depth(len(parent_stack))
+        (row, col) = node.start_point
+        add_start_row(row)
+        add_start_col(col)
+        (row, col) = node.end_point
+        add_end_row(row)
+        add_end_col(col)
+        add_start_byte(node.start_byte)
+        add_end_byte(node.end_byte)
+        t = node.type
+        kid = kind_ids.get(t)
+        if kid is None:
+            kid = kind_ids[t] = len(kinds)
+            kinds.append(t)
+        add_kind(kid)
+        add_named(node.is_named)
+
+        # now determine where to move to next:
+        if cursor.goto_first_child():
+            parent_stack.append(preorder)
+            preorder += 1
+            continue
+        preorder += 1
+        while not cursor.goto_next_sibling():
+            if not cursor.goto_parent():
+                # finished iterating tree
+                if parent_stack:
+                    log.err(f"Bad tree iteration detected! Recorded more parents than ascended.")
+                return ft
+            parent_stack.pop()
+
+def text_node_filter(ft: FlatTree, text_mode: str = "full") -> Callable[[int], bool]:
+    """Get a filter by preorder of the nodes whose text should be stored"""
+    if text_mode == "full":
+        return lambda preorder: True
+    elif text_mode == "leaves":
+        return ft.is_leaf
+    elif text_mode == "named":
+        return ft.named.__getitem__
+    elif text_mode == "none":
+        return lambda preorder: False
+    raise ValueError(f"text_mode must be one of {wsyntree_text_modes}, not {text_mode!r}")
+
+def merkle_digests(ft: FlatTree, content: bytes, digest_size: int = 64, algorithm: str = "shake_256") -> list:
+    """Content digests of every node's text in linear time
+
+    A node's digest is the hash of its text, where the text of each child
+    is substituted by the child's digest. Every byte of content is therefore
+    hashed exactly once, instead of once per ancestor.
+
+    Format (key_scheme.MERKLE_FORMAT 2), lengths are 8 byte little endian:
+    leaf: H(0x00 || text)
+    internal: H(0x01 || for each child: len(gap) || gap || len(digest) || digest
+        || len(tail) || tail), gaps being the text before each child
+    so that no text of a leaf nor of an internal node hashes like another.
+
+    algorithm: "shake_256" or "blake2b", see KeyScheme.hash_algorithm
+
+    Returns a list of digests (bytes), indexed by preorder.
+    """
+    if algorithm == "shake_256":
+        new_hash, finish = hashlib.shake_256, lambda h: h.digest(digest_size)
+    else:
+        new_hash, finish = functools.partial(hashlib.new, algorithm, digest_size=digest_size), lambda h: h.digest()
+    content = memoryview(content)
+    start_bytes, end_bytes, parents = ft.start_byte, ft.end_byte, ft.parent
+    digests = [None] * len(ft)
+    digest_length = digest_size.to_bytes(8, "little")
+    # stack of open nodes: [preorder, hasher, position of next unhashed byte, has children]
+    stack = []
+
+    def finish_top():
+        preorder, h, pos, internal = stack.pop()
+        end = end_bytes[preorder]
+        if internal:
+            h.update((end - pos).to_bytes(8, "little"))
+            h.update(content[pos:end])
+        else:
+            h.update(b"\x00")
+            h.update(content[pos:end])
+        digests[preorder] = d = finish(h)
+        if stack:
+            parent = stack[-1]
+            if not parent[3]:
+                parent[1].update(b"\x01")
+                parent[3] = True
+            gap = content[parent[2]:start_bytes[preorder]]
+            parent[1].update(len(gap).to_bytes(8, "little"))
+            parent[1].update(gap)
+            parent[1].update(digest_length)
+            parent[1].update(d)
+            parent[2] = end
+
+    for preorder in ft.preorder:
+        parent = parents[preorder]
+        while stack and stack[-1][0] != parent:
+            finish_top()
+        stack.append([preorder, new_hash(), start_bytes[preorder], False])
+    while stack:
+        finish_top()
+    return digests
+
+def _common_prefix_length(a: bytes, b: bytes, step: int = 4096) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i + step <= n and a[i:i+step] == b[i:i+step]:
+        i += step
+    # then bisect within the first differing block
+    lo, hi = i, min(i + step, n)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[i:mid] == b[i:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def _byte_point(content: bytes, offset: int) -> tuple:
+    """tree-sitter (row, column in bytes) of a byte offset"""
+    row = content.count(b"\n", 0, offset)
+    return (row, offset - (content.rfind(b"\n", 0, offset) + 1))
+
+def content_edit(old: bytes, new: bytes) -> dict:
+    """Single edit turning old into new, as Tree.edit() arguments
+
+    The edit spans from the end of the common prefix to the start of the
+    common suffix. Returns None if the contents are identical.
+    """
+    if old == new:
+        return None
+    start = _common_prefix_length(old, new)
+    max_suffix = min(len(old), len(new)) - start
+    suffix = _common_prefix_length(old[::-1], new[::-1])
+    suffix = min(suffix, max_suffix)
+    old_end, new_end = len(old) - suffix, len(new) - suffix
+    return dict(
+        start_byte=start,
+        old_end_byte=old_end,
+        new_end_byte=new_end,
+        start_point=_byte_point(new, start),
+        old_end_point=_byte_point(old, old_end),
+        new_end_point=_byte_point(new, new_end),
+    )
+
 @pebble.synchronized
 @functools.lru_cache(maxsize=None)
 def get_cached_TSABL(lang: str):
     return TreeSitterAutoBuiltLanguage(lang)
 
-def get_TSABL_for_file(file: str):
-    """Match the filename and get the respective TreeSitterAutoBuiltLanguage"""
-    for k,v in wsyntree_file_to_lang.items():
-        pattern = re.compile(k)
-        if re.search(pattern, file):
-            return get_cached_TSABL(v)
-    return None
+def preload_languages(langs = None, build: bool = False) -> list:
+    """Load the Language, Parser and version of many languages in this process
+
+    langs: languages to load, default: every language in wsyntree_langs
+    build: also clone and build languages not available yet, otherwise
+        those are skipped, and still built lazily when first needed
+
+    Returns the list of loaded TreeSitterAutoBuiltLanguages.
+    """
+    loaded = []
+    for lang in (langs or wsyntree_langs.keys()):
+        tsabl = get_cached_TSABL(lang)
+        if not build and not tsabl.is_available():
+            continue
+        try:
+            tsabl.get_parser()
+            tsabl.get_version()
+        except Exception as e:
+            log.warn(f"failed to preload {tsabl}: {type(e)}: {e}")
+            continue
+        loaded.append(tsabl)
+    return loaded
+
+def get_TSABL_for_file(file: str, content: bytes = None):
+    """Match the filename and get the respective TreeSitterAutoBuiltLanguage
+
+    content: if given, also sniffed for the language, see langdetect
+    """
+    lang = detect_language(str(file), content)
+    if lang is None:
+        return None
+    return get_cached_TSABL(lang)
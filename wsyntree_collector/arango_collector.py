@@ -9,9 +9,9 @@ from multiprocessing import Queue, Manager
 import concurrent.futures as futures
 import os
 import time
+from contextlib import nullcontext
 
 import arango.exceptions
-from arango import ArangoClient
 import pygit2 as git
 from pebble import ProcessPool, ThreadPool
 import enlighten
@@ -20,13 +20,21 @@ from wsyntree import log, tree_models, multiprogress
 from wsyntree.exceptions import *
 from wsyntree.tree_models import * # __all__
 from wsyntree.localstorage import LocalCache
+from wsyntree.arango_conn import connect_db, parse_db_uri
+from wsyntree.constants import wsyntree_text_modes, wsyntree_text_hash_methods
+from wsyntree.key_scheme import KeyScheme, get_key_scheme, set_key_scheme
 from wsyntree.utils import (
-    list_all_git_files, pushd, strip_url, sha1hex, chunkiter
+    list_all_git_files, pushd, strip_url, sha1hex, chunkiter,
 )
-from .arango_collector_worker import _tqdm_node_receiver, process_file
+from .arango_collector_worker import _tqdm_node_receiver, process_files
+from .scheduling import size_ordered_tasks, BoundedTaskScheduler
+from .budget import FileBudget, Quarantine, only_files
+from .git_repo import GitRepoSource
+from .worker_pool import file_worker_pool
+from .db_writer import DEFAULT_MAX_IN_FLIGHT
 
 
-class WST_ArangoTreeCollector():
+class WST_ArangoTreeCollector(GitRepoSource):
     def __init__(
             self,
             repo_url: str,
@@ -35,11 +43,38 @@ class WST_ArangoTreeCollector():
             workers: int = None,
             commit_sha: str = None,
             en_manager = None,
+            text_mode: str = "full",
+            text_hash: str = "full",
+            text_inline: int = 0,
+            key_scheme: KeyScheme = None,
+            use_odb: bool = False,
+            parse_cache: Path = None,
+            budget: FileBudget = None,
+            quarantine: Path = None,
+            only_quarantined: Path = None,
+            executor = None,
+            writes_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
         ):
         """
         database_conn: Full URI including user:password@host:port/database
         commit_sha: full sha1 hex commit, optional, if present will checkout
         workers: number of file processes in parallel
+        text_mode: which nodes get a WSTText, see constants.wsyntree_text_modes
+        text_hash: WSTText key hashing, see constants.wsyntree_text_hash_methods
+        text_inline: store texts of at most this many bytes on their WSTNode
+            instead of in a WSTText, 0 to never
+        key_scheme: document key format, default: the current process' one,
+            see key_scheme
+        use_odb: never check out, read files from the git object database
+            (the local clone is made bare)
+        parse_cache: path of a ParseCache shared across runs, None to disable
+        budget: per-file limits, see budget.FileBudget
+        quarantine: record files going over their budget to this file
+        only_quarantined: only process this repo's files in this quarantine file
+        executor: a running file worker pool to use (and not stop), shared
+            with other collectors, see worker_pool.file_worker_pool
+        writes_in_flight: bulk writes each file worker keeps in the
+            background, see db_writer.BulkWriter
         """
         self.repo_url = repo_url
         self.database_conn_str = database_conn
@@ -56,13 +91,7 @@ class WST_ArangoTreeCollector():
         self._url_hostname = pr.hostname
         self._url_path = pr.path[1:]
 
-        ur = urlparse(self.database_conn_str)
-        self._db_scheme = ur.scheme or 'http'
-        self._db_hostname = ur.hostname or 'localhost'
-        self._db_port = ur.port or 8529
-        self._db_username = ur.username or 'wst'
-        self._db_password = ur.password or 'wst'
-        self._db_database = ur.path[1:] or 'wst'
+        self._db_conn = parse_db_uri(self.database_conn_str)
         self._coll = {} # collections
         self._vert_colls = {}
         # unconnected:
@@ -70,23 +99,33 @@ class WST_ArangoTreeCollector():
         self._graph = None
 
         self._target_commit = commit_sha
+        if text_mode not in wsyntree_text_modes:
+            raise ValueError(f"text_mode must be one of {wsyntree_text_modes}")
+        self._text_mode = text_mode
+        if text_hash not in wsyntree_text_hash_methods:
+            raise ValueError(f"text_hash must be one of {wsyntree_text_hash_methods}")
+        self._text_hash = text_hash
+        if text_inline < 0:
+            raise ValueError(f"text_inline must not be negative")
+        self._text_inline = text_inline
+        self._key_scheme = key_scheme or get_key_scheme()
+        self._use_odb = use_odb
+        self._parse_cache = str(parse_cache) if parse_cache else None
+        self._budget = budget
+        self._quarantine = Quarantine(quarantine, repo_url) if quarantine else None
+        self._only_quarantined = Quarantine(only_quarantined) if only_quarantined else None
         self._tree_repo = None
 
         self._worker_count = workers or os.cpu_count()
+        self._shared_executor = executor
+        self._writes_in_flight = writes_in_flight
         self._mp_manager = None
         self._node_queue = None
 
     ### NOTE private control functions:
 
     def _connect_db(self):
-        self._client = client = ArangoClient(
-            hosts=strip_url(self.database_conn_str),
-        )
-        self._db = self._client.db(
-            self._db_database,
-            username=self._db_username,
-            password=self._db_password,
-        )
+        self._db = connect_db(self.database_conn_str)
 
         vert_colls = ['wstfiles', 'wstrepos', 'wstnodes', 'wsttexts']
         edge_colls = ['wst-fromfile', 'wst-fromrepo', 'wst-nodeparent', 'wst-nodetext']
@@ -98,31 +137,22 @@ class WST_ArangoTreeCollector():
         for ecn in vert_colls:
             self._vert_colls[ecn] = self._graph.vertex_collection(ecn)
 
-    def _get_git_repo(self):
-        repodir = self._local_repo_path
-        if not (repodir / '.git').exists():
-            repodir.mkdir(mode=0o770, parents=True, exist_ok=True)
-            log.info(f"cloning repo to {repodir} ...")
-            return git.clone_repository(
-                self.repo_url,
-                repodir.resolve()
-            )
-        else:
-            repopath=git.discover_repository(
-                repodir.resolve()
-            )
-            return git.Repository(repopath)
 
-    @property
-    def _current_commit(self) -> git.Commit:
-        try:
-            return self._get_git_repo().revparse_single('HEAD')
-        except KeyError as e:
-            log.error(f"repo in {self._local_repo_path} might not have HEAD?")
+    def _workdir(self):
+        """Context for the collection: inside the checkout, if there is one"""
+        if self._use_odb or self._shared_executor is not None:
+            # the cwd is shared by every collector in this process,
+            # workers are given the checkout path instead
+            return nullcontext()
+        return pushd(self._local_repo_path)
 
-    @property
-    def _current_commit_hash(self) -> str:
-        return self._current_commit.hex
+    def _select_files(self, files):
+        """Only the quarantined files of this repo, with only_quarantined"""
+        if self._only_quarantined is None:
+            return files
+        keys = self._only_quarantined.file_keys(self.repo_url)
+        log.info(f"only processing {len(keys)} quarantined files of {self.repo_url}")
+        return only_files(files, keys)
 
     ### NOTE immutable properties
 
@@ -132,14 +162,6 @@ class WST_ArangoTreeCollector():
         return f"WST_ArangoTreeCollector<{repo_url}@{hash}>"
     __str__ = __repr__
 
-    @functools.cached_property
-    def _local_repo_path(self):
-        cachedir = LocalCache.get_local_cache_dir() / 'collector_repos'
-        if not cachedir.exists():
-            cachedir.mkdir(mode=0o770, exist_ok=True)
-            log.debug(f"created dir {cachedir}")
-        return cachedir.joinpath(self._url_path)
-
     ### NOTE public control functions
 
     def delete_all_tree_data(self):
@@ -186,6 +208,7 @@ class WST_ArangoTreeCollector():
 
     def collect_all(self, existing_node_q = None, overwrite_incomplete: bool = False):
         """Creates every node down the tree for this repo"""
+        set_key_scheme(self._key_scheme)
         # create the main Repos
         self._tree_repo = WSTRepository(
             type='git',
@@ -231,74 +254,71 @@ class WST_ArangoTreeCollector():
             else:
                 raise
 
-        index = self._get_git_repo().index
-        index.read()
-
         # file-level processing
         # files = []
-        with pushd(self._local_repo_path), Manager() as self._mp_manager:
+        with self._workdir(), (nullcontext() if existing_node_q else Manager()) as self._mp_manager:
             if not existing_node_q:
                 self._node_queue = self._mp_manager.Queue()
                 node_receiver = _tqdm_node_receiver(self._node_queue, self.en_manager_proxy)
             else:
                 self._node_queue = existing_node_q
-            with ProcessPool(max_workers=self._worker_count) as executor:
+            if self._shared_executor is not None:
+                pool_context = nullcontext(self._shared_executor)
+            else:
+                pool_context = file_worker_pool(self._worker_count)
+            with pool_context as executor:
                 self._stoppable = executor
-                log.info(f"scanning git for files ...")
-                ret_futures = []
-                cntr_add_jobs = self.en_manager.counter(
-                    desc=f"scanning files for {self._url_path}",
-                    total=len(index), autorefresh=True, leave=False
-                )
-                for gobj in index:
-                    if not gobj.mode in (git.GIT_FILEMODE_BLOB, git.GIT_FILEMODE_BLOB_EXECUTABLE, git.GIT_FILEMODE_LINK):
-                        continue
-                    _file = Path(gobj.path)
-                    # check size of file first:
-                    _fstat = _file.lstat()
-
-                    nf = WSTFile(
-                        # _key=f"{nr.commit}-{gobj.hex}-{sha1hex(gobj.path)}",
-                        path=gobj.path,
-                        mode=gobj.mode,
-                        size=_fstat.st_size,
-                        git_oid=gobj.hex,
-                    )
-                    # file_paths.append(p)
-                    ret_futures.append(executor.schedule(
-                        process_file,
-                        (nf, self._wst_commit, self.database_conn_str),
-                        {'node_q': self._node_queue, 'en_manager': self.en_manager_proxy}
-                    ))
-                    cntr_add_jobs.update()
-                cntr_add_jobs.close(clear=True)
                 log.info(f"processing files with {self._worker_count} workers ...")
+                scheduler = BoundedTaskScheduler(executor, self._worker_count * 4)
+                repo_path = self._get_git_repo().path if self._use_odb else None
+                work_dir = None if self._use_odb else str(self._local_repo_path.resolve())
                 try:
                     cntr_files_processed = self.en_manager.counter(
                         desc=f"processing {self._url_path}",
-                        total=len(ret_futures), unit="files",
+                        total=self._count_files(), unit="files",
                         leave=False, autorefresh=True
                     )
-                    for r in futures.as_completed(ret_futures):
-                        completed_file = r.result()
-                        # log.debug(f"result {nf}")
-                        cntr_files_processed.update()
+                    completed = scheduler.run(
+                        process_files,
+                        size_ordered_tasks(self._select_files(self._iter_files())),
+                        (self._wst_commit, self.database_conn_str),
+                        {
+                            'node_q': self._node_queue,
+                            'en_manager': self.en_manager_proxy,
+                            'text_mode': self._text_mode,
+                            'text_hash': self._text_hash,
+                            'text_inline': self._text_inline,
+                            'key_scheme': self._key_scheme,
+                            'repo_path': repo_path,
+                            'work_dir': work_dir,
+                            'parse_cache': self._parse_cache,
+                            'budget': self._budget,
+                            'quarantine': self._quarantine,
+                            'writes_in_flight': self._writes_in_flight,
+                        }
+                    )
+                    for r in completed:
+                        completed_files = r.result()
+                        # log.debug(f"result {completed_files}")
+                        cntr_files_processed.update(len(completed_files))
                     # after all results returned
                     self._tree_repo.wst_status = "completed"
                     self._tree_repo.update_in_db(self._db)
                     log.info(f"{self._url_path} marked completed.")
                 except KeyboardInterrupt as e:
                     log.warn(f"stopping collection ...")
-                    for rf in ret_futures:
-                        rf.cancel()
-                    executor.close()
-                    executor.join(5)
-                    executor.stop()
+                    scheduler.cancel()
+                    if self._shared_executor is None:
+                        # a shared pool is stopped by its owner
+                        executor.close()
+                        executor.join(5)
+                        executor.stop()
                     # raise e
                     self._tree_repo.wst_status = "cancelled"
                     self._tree_repo.update_in_db(self._db)
                     log.info(f"{self._tree_repo.url} wst_status marked as cancelled")
                 except Exception as e:
+                    scheduler.cancel()
                     self._tree_repo.wst_status = "error"
                     self._tree_repo.update_in_db(self._db)
                     raise e
@@ -322,6 +342,10 @@ class WST_ArangoTreeCollector():
             except Exception as e:
                 log.error(f"Failed to repair repository: {type(e)}: {e}")
                 raise e
+        if self._use_odb:
+            # files are read straight from the object database
+            log.debug(f"{self} will be read without a checkout")
+            return
         # to _target_commit if set
         if self._target_commit and self._target_commit != self._current_commit_hash:
             log.info(f"Checking out commit {self._target_commit}...")
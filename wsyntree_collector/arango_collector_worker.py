@@ -3,7 +3,7 @@ from pathlib import Path
 import time
 import os
 from urllib.parse import urlparse
-from contextlib import nullcontext
+from contextlib import nullcontext, suppress
 import functools
 import hashlib
 import traceback
@@ -11,7 +11,6 @@ import traceback
 import pygit2 as git
 from arango.database import StandardDatabase, BatchDatabase
 import arango.exceptions
-from arango import ArangoClient
 import enlighten
 from pebble import concurrent
 import cachetools.func
@@ -22,11 +21,18 @@ from tenacity import retry
 
 from wsyntree import log, tree_models
 from wsyntree.exceptions import *
+from wsyntree.arango_conn import get_db
 from wsyntree.utils import dotdict, strip_url, sha1hex, sha512hex
 from wsyntree.tree_models import * # __all__
-from wsyntree.wrap_tree_sitter import get_TSABL_for_file
+from wsyntree.key_scheme import KeyScheme, get_key_scheme, set_key_scheme
+from wsyntree.wrap_tree_sitter import (
+    get_TSABL_for_file, flatten_tree, text_node_filter, merkle_digests,
+)
 
-_HASH_CHUNK_READ_SIZE_BYTES = 2 ** 16 # 64 KiB
+from wsyntree_collector.file.prepare import prepare_file
+from wsyntree_collector.parse_cache import get_parse_cache, text_cache_options
+from wsyntree_collector.budget import FileBudget, Quarantine, budget_error_codes
+from wsyntree_collector.db_writer import get_bulk_writer, DEFAULT_MAX_IN_FLIGHT
 
 
 @concurrent.process
@@ -44,6 +50,14 @@ def _tqdm_node_receiver(q, en_manager):
             "text_lfu_miss": 0,
         }
         dedup_stats = {}
+        write_stats = {
+            "requests": 0,
+            "docs": 0,
+            "latency": 0.0,
+            "max_latency": 0.0,
+            "stalled": 0.0,
+        }
+        t_start = time.time()
         cntr = en_manager.counter(
             desc="writing to db", position=1, unit='docs', autorefresh=True
         )
@@ -59,33 +73,73 @@ def _tqdm_node_receiver(q, en_manager):
                 if nc[1] not in dedup_stats:
                     dedup_stats[nc[1]] = 0
                 dedup_stats[nc[1]] += nc[2]
+            elif nc[0] == "write_stats":
+                for k, v in nc[1].items():
+                    if k == "max_latency":
+                        write_stats[k] = max(write_stats[k], v)
+                    else:
+                        write_stats[k] += v
             else:
                 log.error(f"node receiver process got invalid data sent of type {type(nc)}")
         log.info(f"stopped counting nodes, total documents inserted: {n}")
         cache_text_lfu_ratio = cache_stats["text_lfu_hit"] / (cache_stats["text_lfu_miss"] or 1)
         log.debug(f"text_lfu cache stats: ratio {cache_text_lfu_ratio}, hit {cache_stats['text_lfu_hit']}")
+        if write_stats["requests"]:
+            elapsed = time.time() - t_start
+            log.info(" ".join([
+                f"bulk writes: {write_stats['requests']} requests,",
+                f"{write_stats['docs'] / elapsed:.0f} docs/s,",
+                f"latency mean {write_stats['latency'] / write_stats['requests']:.3f}s",
+                f"max {write_stats['max_latency']:.3f}s,",
+                f"workers stalled on backpressure for {write_stats['stalled']:.1f}s",
+            ]))
         return True
     except Exception as e:
         # need to print here, otherwise failure is silent if parent doesn't check the future
         log.err(f"node_receiver failed: {e}")
         raise e
 
-def batch_insert_WSTNode(db: StandardDatabase, stuff_to_insert):
-    jobs_n_things = []
-    with db.begin_batch_execution() as bdb:
-        for thing in stuff_to_insert:
-            job = thing.insert_in_db(bdb)
-            jobs_n_things.append((job, thing))
-    # checking results in case they raise errors
-    adb = db.begin_async_execution(return_result=True)
-    for job, thing in jobs_n_things:
+def _import_bulk(coll, documents: list, on_duplicate: str):
+    """One import request, raises BulkImportError if any document failed"""
+    result = coll.import_bulk(
+        documents,
+        halt_on_error=False,
+        details=True,
+        on_duplicate=on_duplicate,
+    )
+    if result["errors"]:
+        raise BulkImportError(coll.name, result.get("details"))
+    return result
+
+def bulk_insert_documents(db: StandardDatabase, stuff_to_insert, ignore_existing: bool = False):
+    """Insert many documents with one bulk import request per collection
+
+    WSTTexts already present are always kept, they are equal by their key.
+
+    ignore_existing: documents already present are kept, for resuming an
+        interrupted CodeTree, whose keys are the same in every run
+    """
+    by_collection = {}
+    for thing in stuff_to_insert:
+        if isinstance(thing, WST_Document) and not getattr(thing, '_key', None):
+            thing._genkey()
+        docs = by_collection.get(thing._collection)
+        if docs is None:
+            docs = by_collection[thing._collection] = []
+        docs.append(thing.__dict__)
+    for collname, documents in by_collection.items():
+        coll = db.collection(collname)
+        if ignore_existing or collname == WSTText._collection:
+            on_duplicate = "ignore"
+        else:
+            on_duplicate = "error"
         try:
-            result = auto_batchjobdone_retry(lambda: job.result())()
-        except arango.exceptions.DocumentInsertError as e:
-            if isArangoWriteWriteConflict(e):
-                auto_writewrite_retry(lambda: thing.insert_in_db(adb))
-            else:
+            _import_bulk(coll, documents, on_duplicate)
+        except BulkImportError as e:
+            if not e.conflicts_only:
                 raise
+            # the rest of the batch is in: retry it, keeping what was created
+            auto_writewrite_retry(lambda: _import_bulk(coll, documents, "ignore"))()
 
 def process_file(*args, **kwargs):
     try:
@@ -95,6 +149,31 @@ def process_file(*args, **kwargs):
         log.trace(log.debug, traceback.format_exc())
         raise e
 
+def drain_writes(node_q = None, writes_in_flight: int = DEFAULT_MAX_IN_FLIGHT):
+    """Wait for this process' queued writes, and report their stats to node_q"""
+    writer = get_bulk_writer(writes_in_flight)
+    try:
+        writer.drain()
+    finally:
+        if node_q:
+            node_q.put(("write_stats", writer.take_stats()))
+
+def process_files(files, *args, **kwargs):
+    """Run process_file for each of a batch of files, returns the list of results
+
+    Returns once every document of the files is written.
+    """
+    drain_args = (kwargs.get('node_q'), kwargs.get('writes_in_flight', DEFAULT_MAX_IN_FLIGHT))
+    try:
+        results = [process_file(f, *args, **kwargs) for f in files]
+    except Exception:
+        # don't leave this task's writes (or their errors) to the next one
+        with suppress(Exception):
+            drain_writes(*drain_args)
+        raise
+    drain_writes(*drain_args)
+    return results
+
 def _process_file(
         file: WSTFile,
         wst_commit: WSTCommit, # the commit the file is a part of
@@ -102,70 +181,66 @@ def _process_file(
         *,
         node_q = None,
         en_manager = None,
-        batch_write_size=1000,
+        repo_path: str = None,
+        work_dir: str = None,
+        text_mode: str = "full",
+        text_hash: str = "full",
+        text_inline: int = 0,
+        key_scheme: KeyScheme = None,
+        parse_cache: str = None,
+        budget: FileBudget = None,
+        quarantine: Quarantine = None,
+        batch_write_size=10000,
+        writes_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
         overwrite_errored_docs=True,
     ):
     """Given an incomplete WSTFile,
     Creates a WSTCodeTree, WSTNodes, and WSTTexts for it
 
-    Process working directory should already be within checked out repository
+    Unless repo_path or work_dir is given, process working directory should
+    already be within checked out repository
 
     node_q: push integers for counting number of added syntax nodes
     en_manager: Enlighten Manager compatible API to get Counters from
+    repo_path: read file content from this repo's object database instead
+    work_dir: read file content from this checkout instead
+    text_mode: which nodes get a WSTText, one of constants.wsyntree_text_modes
+    text_hash: how WSTText keys are hashed, one of constants.wsyntree_text_hash_methods
+    text_inline: texts of at most this many bytes are stored on their WSTNode,
+        only longer ones get a WSTText, 0 for none
+    key_scheme: make keys and content hashes with this KeyScheme, default:
+        the process' current one
+    parse_cache: path of a ParseCache, skip parsing blobs already recorded there
+    budget: limits for this file, going over sets the WSTFile or WSTCodeTree
+        error to the budget error code instead of failing
+    quarantine: record files going over their budget here
     batch_write_size: when number of items in memory reaches this, write them all
+    writes_in_flight: bulk writes queued in the background at most, node
+        generation waits while this many are (see db_writer)
 
-    Returns the completed AND inserted WSTFile, linked with wst_commit
+    Returns the inserted WSTFile, linked with wst_commit. Its nodes may still
+    be being written, and its WSTCodeTree completed, until drain_writes.
     """
 
-    ur = urlparse(database_conn_str)
-    _db_username = ur.username or 'wst'
-    _db_password = ur.password or 'wst'
-    _db_database = ur.path[1:] or 'wst'
-    client = client = ArangoClient(
-        hosts=strip_url(database_conn_str),
-    )
-    sync_db = client.db(
-        _db_database,
-        username=_db_username,
-        password=_db_password,
-    )
+    if key_scheme is not None:
+        set_key_scheme(key_scheme)
+    # connected once per worker process, then reused for every file
+    sync_db = get_db(database_conn_str)
+    writer = get_bulk_writer(writes_in_flight)
     db = sync_db.begin_async_execution(return_result=True)
     # edge_fromrepo = db.graph(tree_models._graph_name).edge_collection('wst-fromrepo')
 
-    # always done for every file:
-    file_shake_256 = hashlib.shake_256() # WST hashes
-    _filepath = Path(file.path)
-    if file.mode in (git.GIT_FILEMODE_BLOB, git.GIT_FILEMODE_BLOB_EXECUTABLE):
-        # for normal files
-        with open(file.path, 'rb') as f:
-            while (data := f.read(_HASH_CHUNK_READ_SIZE_BYTES)):
-                file_shake_256.update(data)
-        lang = get_TSABL_for_file(file.path)
-        file.language = lang.lang if lang else None
-        file.error = "WST_NO_LANGUAGE" if not lang else None
-        file.content_hash = file_shake_256.hexdigest(64) # 128 hex chars
-    elif file.mode == git.GIT_FILEMODE_LINK:
-        lang = None
-        file.language = None
-        file.error = "WST_IS_LINK"
-        # we will not parse it, instead, store the link
-        if not _filepath.is_symlink():
-            raise LocalCopyOutOfSync(f"{file.path} is not a link but should be!")
-        target = Path(os.readlink(_filepath))
-        file.symlink = {
-            'target': str(target),
-        }
-        abspath = _filepath.resolve(strict=False)
+    t_start = time.time()
+    lang, content = prepare_file(file, repo_path, work_dir)
+    if budget is not None and lang is not None:
         try:
-            relpath = abspath.relative_to(Path('.').resolve())
-            file.symlink['relative'] = str(relpath)
-        except ValueError as e:
-            # link target probably not within our repo dir
-            file.symlink['relative'] = None
-        file_shake_256.update(str(target).encode())
-        file.content_hash = file_shake_256.hexdigest(64)
-    else:
-        raise UnhandledGitFileMode(f"{file.path} mode is {oct(file.mode)}")
+            budget.check_size(len(content))
+        except BudgetExceeded as e:
+            # no WSTCodeTree will be generated
+            file.error = e.code
+            lang = None
+            if quarantine:
+                quarantine.add(file, e.code, budget)
 
     try:
         file.insert_in_db(db)
@@ -174,10 +249,16 @@ def _process_file(
         if e.http_code == 409:
             # already exists: get it
             preexisting_file = WSTFile.get(db, file._key)
+            if preexisting_file.git_oid != file.git_oid:
+                raise KeyCollisionError(f"WSTFile {file._key}: blobs {file.git_oid} and {preexisting_file.git_oid} have the same content hash")
             if preexisting_file != file:
                 log.debug(f"existing file: {preexisting_file}")
                 log.debug(f"new file: {file}")
-                if overwrite_errored_docs and preexisting_file.error:
+                if file.error in budget_error_codes and not preexisting_file.error:
+                    # collected before without a budget, keep the full one
+                    (wst_commit / preexisting_file).insert_in_db(db, overwrite=overwrite_errored_docs)
+                    return preexisting_file
+                elif overwrite_errored_docs and preexisting_file.error:
                     log.warn(f"Overwriting errored WSTFile, prior error: {preexisting_file.error}, new error: {file.error}")
                     file.update_in_db(db)
                     (wst_commit / file).insert_in_db(db, overwrite=True) # commit -> file
@@ -198,15 +279,27 @@ def _process_file(
         # no WSTCodeTree will be generated
         return file
 
+    if parse_cache:
+        cache = get_parse_cache(parse_cache)
+        cache_args = (file.language, lang.get_version(), file.content_hash)
+        cache_options = text_cache_options(text_mode, text_hash, text_inline)
+        if (cached_key := cache.get(*cache_args, cache_options)) is not None:
+            # the CodeTree is already complete, skip the insert-or-compare
+            WST_Edge(file, f"{WSTCodeTree._collection}/{cached_key}").insert_in_db(db, overwrite=True)
+            if node_q:
+                node_q.put(('dedup_stats', 'WSTCodeTree', 1))
+            return file
+
     # otherwise, let the parsing begin!
     code_tree = WSTCodeTree(
         language=file.language,
-        lang_version=None, # TODO
+        lang_version=lang.get_version(),
         content_hash=file.content_hash,
         git_oid=file.git_oid,
         error=None,
     )
     # TODO don't step on another WST_CODETREE_UNFINISHED's feet
+    resuming = False
     try:
         code_tree.insert_in_db(db)
         (file / code_tree).insert_in_db(db)
@@ -214,11 +307,21 @@ def _process_file(
         if e.http_code == 409:
             # already exists: check that it's the same, and if so, all done here
             preexisting_ct = WSTCodeTree.get(db, code_tree._key)
+            if preexisting_ct.git_oid != code_tree.git_oid:
+                raise KeyCollisionError(f"WSTCodeTree {code_tree._key}: blobs {code_tree.git_oid} and {preexisting_ct.git_oid} have the same content hash")
+            if preexisting_ct.lang_version != code_tree.lang_version and not preexisting_ct.error:
+                # the key does not include the grammar version: the first
+                # completed CodeTree of this content stays, whichever version
+                log.debug(f"keeping {preexisting_ct._id} from lang_version {preexisting_ct.lang_version}")
+                code_tree.lang_version = preexisting_ct.lang_version
             if preexisting_ct != code_tree:
                 log.debug(f"existing CodeTree: {preexisting_ct}")
                 log.debug(f"calculated CodeTree: {code_tree}")
                 if overwrite_errored_docs and preexisting_ct.error:
                     log.warn(f"Overwriting errored WSTCodeTree, prior error: {preexisting_ct.error}, new error: {preexisting_ct.error}")
+                    # nodes of the earlier attempt (e.g. interrupted, still
+                    # WST_CODETREE_UNFINISHED) have the same keys, keep them
+                    resuming = True
                     code_tree.update_in_db(db)
                     (file / code_tree).insert_in_db(db, overwrite=True) # file -> CT
                     # # need to remove potential previous root-node from CT
@@ -242,71 +345,114 @@ def _process_file(
     code_tree.error = "WST_CODETREE_UNFINISHED"
     code_tree.update_in_db(db)
 
-    tree = lang.parse_file(file.path)
+    # bail if we can't decode text, checked once for the whole file so that
+    # node texts can be decoded without further checks, only if any are kept
+    if text_mode != "none":
+        try:
+            content.decode()
+        except UnicodeDecodeError as e:
+            log.warn(f"{file}: failed to decode content")
+            code_tree.error = "UnicodeDecodeError"
+            code_tree.update_in_db(db)
+            return file # ends process
+
+    def over_budget(e: BudgetExceeded):
+        """Record the partial CodeTree, nodes already inserted stay orphaned"""
+        code_tree.error = e.code
+        code_tree.update_in_db(db)
+        if quarantine:
+            quarantine.add(file, e.code, budget)
+        return file
+    try:
+        tree = lang.parse_bytes(
+            content, timeout_micros=budget.parse_timeout_micros if budget else None
+        )
+        ft = flatten_tree(tree, budget.max_nodes if budget else None)
+    except BudgetExceeded as e:
+        return over_budget(e)
+    del tree
+    has_text = text_node_filter(ft, text_mode)
+    if text_hash == "merkle" and text_mode != "none":
+        scheme = get_key_scheme()
+        text_digests = merkle_digests(ft, content, scheme.digest_bytes, scheme.hash_algorithm)
+    else:
+        text_digests = None
 
-    t_start = time.time()
     t_notified = False
-    cursor = tree.walk()
-    # memoization of WSTTexts
-    known_exists_text_ids = set()
+    def same_text(known: tuple, sb: int, eb: int) -> bool:
+        """Key collision check of a repeated WSTText key, only run on repeats"""
+        ksb, keb = known
+        if keb - ksb != eb - sb:
+            return False
+        if text_digests is not None:
+            # the key is the merkle digest of the text, nothing to hash again
+            return True
+        return content[ksb:keb] == content[sb:eb]
+
+    # memoization of WSTTexts, key -> (start_byte, end_byte) of its first node
+    known_texts = {}
     memoiz_stats = [0, 0]
-    # iteration loop
-    preorder = 0
-    order_to_id = {}
-    parent_stack = []
+    node_id_prefix = f"{WSTNode._collection}/{code_tree._key}-"
+    kinds = ft.kinds
     batch_writes = []
+    written = [] # futures of this file's bulk writes
     try:
         # definitions: nn = new node, nt = new text, nc = node count
-        while cursor.node is not None:
-            cur_node = cursor.node
+        for preorder in range(len(ft)):
             nn = WSTNode(
                 _key=f"{code_tree._key}-{preorder}",
-                named=cur_node.is_named,
-                type=cur_node.type,
+                named=bool(ft.named[preorder]),
+                type=kinds[ft.kind[preorder]],
                 preorder=preorder,
+                x1=ft.start_row[preorder],
+                y1=ft.start_col[preorder],
+                x2=ft.end_row[preorder],
+                y2=ft.end_col[preorder],
+                start_byte=ft.start_byte[preorder],
+                end_byte=ft.end_byte[preorder],
             )
-            (nn.x1,nn.y1) = cur_node.start_point
-            (nn.x2,nn.y2) = cur_node.end_point
-            parentorder = parent_stack[-1] if parent_stack else None
-
-            # bail if we can't decode text
-            try:
-                text = cur_node.text.tobytes().decode()
-                textlength = len(text)
-            except UnicodeDecodeError as e:
-                log.warn(f"{file}: failed to decode content")
-                code_tree.error = "UnicodeDecodeError"
-                code_tree.update_in_db(db)
-                return file # ends process
+            parentorder = ft.parent[preorder]
 
             # nn.insert_in_db(bdb)
             batch_writes.append(nn)
-            order_to_id[nn.preorder] = nn._id
-            if parentorder is not None:
+            if parentorder >= 0:
                 # parent node -> child
-                batch_writes.append(WST_Edge(order_to_id[parentorder], nn))
+                batch_writes.append(WST_Edge(f"{node_id_prefix}{parentorder}", nn))
             else:
-                # if it is none, this is the root node, link it
+                # root node, link it
                 batch_writes.append(code_tree / nn)
 
             # text storage (deduplication)
-            nt = WSTText(
-                length=textlength,
-                text=text,
-            )
-            nt._genkey()
-            if nt._id not in known_exists_text_ids:
-                batch_writes.append(nt)
-                known_exists_text_ids.add(nt._id)
-                memoiz_stats[1] += 1
-            else:
-                memoiz_stats[0] += 1
-            # link node -> text
-            batch_writes.append(nn / nt)
+            if has_text(preorder):
+                sb, eb = ft.start_byte[preorder], ft.end_byte[preorder]
+                if text_inline and eb - sb <= text_inline:
+                    # short text: on the node itself, no WSTText nor edge
+                    nn.text = content[sb:eb].decode()
+                else:
+                    text = content[sb:eb].decode()
+                    nt = WSTText(
+                        length=len(text),
+                        text=text,
+                    )
+                    nt._genkey(text_digests[preorder] if text_digests else None)
+                    known = known_texts.get(nt._key)
+                    if known is None:
+                        batch_writes.append(nt)
+                        known_texts[nt._key] = (sb, eb)
+                        memoiz_stats[1] += 1
+                    elif not same_text(known, sb, eb):
+                        raise KeyCollisionError(f"WSTText {nt._key} of {file.path}: two different texts")
+                    else:
+                        memoiz_stats[0] += 1
+                    # link node -> text
+                    batch_writes.append(nn / nt)
 
             if len(batch_writes) >= batch_write_size:
                 # log.debug(f"batch insert {len(batch_writes)}...")
-                batch_insert_WSTNode(sync_db, batch_writes)
+                written.append(writer.submit(
+                    bulk_insert_documents, sync_db, batch_writes, resuming,
+                    docs=len(batch_writes),
+                ))
                 # progress reporting: desired to evaluate node insertion performance
                 if node_q:
                     node_q.put(len(batch_writes))
@@ -314,47 +460,44 @@ def _process_file(
                     log.warn(f"{file.path}: processing taking longer than expected, preorder at {preorder}")
                     t_notified = True
                 batch_writes = []
+                if budget is not None:
+                    budget.check_time(t_start)
 
-            preorder += 1
-
-            # now determine where to move to next:
-            next_child = cursor.goto_first_child()
-            if next_child == True:
-                parent_stack.append(nn.preorder)
-                continue # cur_node to next_child
-            next_sibling = cursor.goto_next_sibling()
-            if next_sibling == True:
-                continue # cur_node to next_sibling
-            # go up parents
-            while cursor.goto_next_sibling() == False:
-                goto_parent = cursor.goto_parent()
-                if goto_parent:
-                    parent_stack.pop()
-                else:
-                    # we are done iterating
-                    if len(parent_stack) != 0:
-                        log.err(f"Bad tree iteration detected! Recorded more parents than ascended.")
-                    if batch_writes:
-                        batch_insert_WSTNode(sync_db, batch_writes)
-                        if node_q:
-                            node_q.put(len(batch_writes))
-                    # NOTE successful end of processing
-                    # log.debug(f"{file.path} added {preorder} nodes")
-                    if node_q:
-                        node_q.put((
-                            "cache_stats",
-                            {
-                                "text_lfu_hit": memoiz_stats[0],
-                                "text_lfu_miss": memoiz_stats[1],
-                            }
-                        ))
-                    # unset error: CodeTree is completed successfully
-                    code_tree.error = None
-                    code_tree.update_in_db(db)
-                    return file # end process / everything went smoothly
+        if batch_writes:
+            written.append(writer.submit(
+                bulk_insert_documents, sync_db, batch_writes, resuming,
+                docs=len(batch_writes),
+            ))
+            if node_q:
+                node_q.put(len(batch_writes))
+        # NOTE successful end of processing
+        # log.debug(f"{file.path} added {len(ft)} nodes")
+        if node_q:
+            node_q.put((
+                "cache_stats",
+                {
+                    "text_lfu_hit": memoiz_stats[0],
+                    "text_lfu_miss": memoiz_stats[1],
+                }
+            ))
+        def completed():
+            # unset error: CodeTree is completed successfully
+            code_tree.error = None
+            code_tree.update_in_db(sync_db)
+            if parse_cache:
+                cache.put(*cache_args, code_tree._key, cache_options)
+        def failed(e: Exception):
+            code_tree.error = str(e)
+            code_tree.update_in_db(sync_db)
+            log.err(f"{file.path}: writing WSTNodes failed: {e}")
+        # only once all of its nodes are in
+        writer.then(written, completed, on_error=failed)
+        return file # end process / everything went smoothly
     except BrokenPipeError as e:
         log.warn(f"caught {type(e)}: {e}")
         os._exit(1)
+    except BudgetExceeded as e:
+        return over_budget(e)
     except Exception as e:
         code_tree.error = str(e)
         code_tree.update_in_db(db)
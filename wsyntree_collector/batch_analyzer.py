@@ -3,6 +3,10 @@ The batch analysis is used for creating the official datasets
 
 Input consists of a list of repos and specific commits to analyze.
 All results are written to one db.
+
+Repo jobs run as threads of this process, and all of them share one warm
+pool of file worker processes (see worker_pool), which lives for the whole
+batch instead of being started again for every repo.
 """
 
 import sys
@@ -16,18 +20,24 @@ from multiprocessing import Queue, Manager
 import concurrent.futures as futures
 
 import pygit2 as git
-from arango import ArangoClient
 from tqdm import tqdm
-from pebble import ProcessPool
+from pebble import ThreadPool
 
 from wsyntree import log, multiprogress
 from wsyntree.exceptions import *
 from wsyntree.wrap_tree_sitter import TreeSitterAutoBuiltLanguage, TreeSitterCursorIterator
 from wsyntree.utils import strip_url, desensitize_url
+from wsyntree.arango_conn import connect_db
+from wsyntree.constants import wsyntree_text_modes, wsyntree_text_hash_methods
+from wsyntree.key_scheme import add_key_scheme_args, key_scheme_from_args
 from wsyntree.tree_models import WSTRepository
 
 from .arango_collector import WST_ArangoTreeCollector
 from .arango_collector_worker import _tqdm_node_receiver
+from .parse_cache import default_parse_cache_path
+from .worker_pool import file_worker_pool
+from .budget import add_budget_args, budget_from_args
+from .db_writer import DEFAULT_MAX_IN_FLIGHT
 
 
 def set_batch_analyze_args(cmd_batch):
@@ -40,7 +50,7 @@ def set_batch_analyze_args(cmd_batch):
     cmd_batch.add_argument(
         "-w", "--workers",
         type=int,
-        help="Number of workers for a single repo job",
+        help="Number of file workers per repo job, the shared pool has jobs * workers processes",
         default=8
     )
     cmd_batch.add_argument(
@@ -54,13 +64,66 @@ def set_batch_analyze_args(cmd_batch):
         action="store_true",
         help="Ignores error of \"repo document already exists in the database\""
     )
+    cmd_batch.add_argument(
+        "--text-mode",
+        choices=wsyntree_text_modes,
+        help="Which nodes to store text for, others keep only their byte range",
+        default="full",
+    )
+    cmd_batch.add_argument(
+        "--text-hash",
+        choices=wsyntree_text_hash_methods,
+        help="How to hash node texts for WSTText keys, merkle hashes every byte once",
+        default="full",
+    )
+    cmd_batch.add_argument(
+        "--text-inline",
+        type=int,
+        metavar="BYTES",
+        help="Store texts of at most this many bytes on their WSTNode, only longer texts get a WSTText (default 0: all do)",
+        default=0,
+    )
+    add_key_scheme_args(cmd_batch)
+    cmd_batch.add_argument(
+        "--no-checkout", "--odb",
+        dest="use_odb",
+        action="store_true",
+        help="Read files from the git object database (bare clone) instead of a checkout",
+    )
+    cmd_batch.add_argument(
+        "--parse-cache",
+        type=Path,
+        nargs="?",
+        const=default_parse_cache_path(),
+        help="Skip parsing blobs already completed by any run using this cache (default path if no value given)",
+        default=None,
+    )
+    cmd_batch.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue repos an earlier run did not complete, keeping their finished files and nodes",
+    )
+    cmd_batch.add_argument(
+        "--writes-in-flight",
+        type=int,
+        help="Bulk writes each file worker keeps queued while parsing on, keep below the --db pool_size",
+        default=DEFAULT_MAX_IN_FLIGHT,
+    )
+    add_budget_args(cmd_batch)
 
 def repo_worker(
         repo_dict: dict,
         node_q = None,
+        resume: bool = False,
         **kwargs, # passed to WST_ArangoTreeCollector constructor
     ):
-    """Setup and run one repo's analysis job"""
+    """Setup and run one repo's analysis job
+
+    Runs in a thread of the batch process, pass the shared file worker pool
+    as the executor kwarg.
+
+    resume: continue the repo if an earlier run did not complete it
+    """
     collector = WST_ArangoTreeCollector(
         repo_dict['url'],
         commit_sha=repo_dict.get('commit', repo_dict.get('sha')),
@@ -74,10 +137,12 @@ def repo_worker(
 
     # check if exists already
     if repo := WSTRepository.get(collector._db, collector._current_commit_hash):
-        raise RepoExistsError(f"Repo document already exists: {repo.__dict__}")
+        if not resume or repo.wst_status == "completed":
+            raise RepoExistsError(f"Repo document already exists: {repo.__dict__}")
+        log.info(f"resuming {collector}, status was {repo.wst_status}")
 
     try:
-        collector.collect_all(node_q)
+        collector.collect_all(node_q, overwrite_incomplete=resume)
     except Exception as e:
         # log.err(f"Failed to analyze {collector}: {type(e)}: {e}")
         raise e
@@ -95,9 +160,8 @@ def batch_analyze(args):
         log.err(f"Failed to read repo list file")
         raise
 
-    client = ArangoClient(hosts=strip_url(args.db))
-    p = urlparse(args.db)
-    db = client.db(p.path[1:], username=p.username, password=p.password)
+    db = connect_db(args.db)
+    key_scheme = key_scheme_from_args(args)
     batch_id = uuid.uuid4().hex
     log.info(f"Batch ID {batch_id}")
     _mp_manager = Manager()
@@ -112,7 +176,8 @@ def batch_analyze(args):
         en_manager = multiprogress.get_manager()
         node_receiver = _tqdm_node_receiver(node_q, en_manager_proxy)
 
-        with ProcessPool(max_workers=args.jobs) as executor:
+        with file_worker_pool(args.jobs * args.workers) as file_executor, \
+                ThreadPool(max_workers=args.jobs) as executor:
             ret_futures = []
             all_repos_sched_cntr = en_manager.counter(
                 desc="adding repo jobs", total=len(repolist), unit='repos'
@@ -121,7 +186,23 @@ def batch_analyze(args):
                 ret_futures.append(executor.schedule(
                     repo_worker,
                     (repo, node_q),
-                    {'workers': args.workers, 'database_conn': args.db}
+                    {
+                        'workers': args.workers,
+                        'resume': args.resume,
+                        'executor': file_executor,
+                        'en_manager': en_manager,
+                        'database_conn': args.db,
+                        'text_mode': args.text_mode,
+                        'text_hash': args.text_hash,
+                        'text_inline': args.text_inline,
+                        'key_scheme': key_scheme,
+                        'use_odb': args.use_odb,
+                        'parse_cache': args.parse_cache,
+                        'budget': budget_from_args(args),
+                        'quarantine': args.quarantine,
+                        'only_quarantined': args.only_quarantined,
+                        'writes_in_flight': args.writes_in_flight,
+                    }
                 ))
                 all_repos_sched_cntr.update()
             all_repos_sched_cntr.close()
@@ -150,11 +231,13 @@ def batch_analyze(args):
                     all_repos_cntr.update()
             except KeyboardInterrupt as e:
                 log.warn(f"stopping batch worker pool...")
-                executor.stop()
                 for rf in ret_futures:
                     rf.cancel()
+                file_executor.stop()
+                executor.stop()
                 log.warn(f"waiting for already started jobs to finish...")
                 executor.join()
+                file_executor.join()
     finally:
         try:
             node_q.put(None)
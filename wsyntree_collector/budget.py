@@ -0,0 +1,181 @@
+"""
+Per-file processing limits, and quarantine of the files going over them
+
+A single minified bundle or generated parser table can otherwise keep a
+worker busy for hours. A file over its FileBudget is not collected (fully):
+its WSTFile.error or WSTCodeTree.error is set to one of budget_error_codes,
+and it is recorded in the Quarantine, to be reprocessed later with bigger
+budgets (see --only-quarantined).
+"""
+
+from pathlib import Path
+from typing import Iterable, Set, Tuple
+import time
+
+import orjson
+import filelock
+
+from wsyntree import log
+from wsyntree.exceptions import BudgetExceeded
+from wsyntree.tree_models import WSTFile
+
+budget_error_codes = (
+    "WST_FILE_TOO_LARGE", # WSTFile.error, no WSTCodeTree is made
+    "WST_PARSE_TIMEOUT", # WSTCodeTree.error
+    "WST_TOO_MANY_NODES", # WSTCodeTree.error
+    "WST_TIME_BUDGET", # WSTCodeTree.error
+)
+
+
+class FileBudget():
+    """Limits for processing one file, None for no limit
+
+    max_bytes: files larger than this are not parsed
+    parse_timeout: seconds tree-sitter may spend parsing
+    max_nodes: trees with more nodes than this are not collected
+    max_seconds: wall-clock seconds for the whole file, including writing
+    """
+    __slots__ = [
+        "max_bytes",
+        "parse_timeout",
+        "max_nodes",
+        "max_seconds",
+    ]
+
+    def __init__(
+            self,
+            max_bytes: int = None,
+            parse_timeout: float = None,
+            max_nodes: int = None,
+            max_seconds: float = None,
+        ):
+        self.max_bytes = max_bytes
+        self.parse_timeout = parse_timeout
+        self.max_nodes = max_nodes
+        self.max_seconds = max_seconds
+
+    def __repr__(self):
+        return f"FileBudget<{self.as_dict()}>"
+
+    def __bool__(self):
+        return any(getattr(self, s) is not None for s in self.__slots__)
+
+    def as_dict(self) -> dict:
+        return {s: getattr(self, s) for s in self.__slots__}
+
+    @property
+    def parse_timeout_micros(self) -> int:
+        if self.parse_timeout is None:
+            return None
+        return int(self.parse_timeout * 1e6)
+
+    def check_size(self, size: int):
+        if self.max_bytes is not None and size > self.max_bytes:
+            raise BudgetExceeded("WST_FILE_TOO_LARGE", f"{size} bytes is over {self.max_bytes}")
+
+    def check_time(self, t_start: float):
+        if self.max_seconds is not None and time.time() - t_start > self.max_seconds:
+            raise BudgetExceeded("WST_TIME_BUDGET", f"processing took over {self.max_seconds}s")
+
+class Quarantine():
+    """Append-only JSONL record of files that went over their budget
+
+    Safe to share between processes: every entry is appended under a lock.
+    """
+    def __init__(self, path: Path, repo_url: str = None):
+        """repo_url: repo of the files added by this instance"""
+        self.path = Path(path)
+        self.repo_url = repo_url
+
+    def __repr__(self):
+        return f"Quarantine<{self.path}, {self.repo_url}>"
+
+    def add(self, file: WSTFile, error: str, budget: FileBudget = None):
+        entry = {
+            "repo_url": self.repo_url,
+            "path": file.path,
+            "mode": file.mode,
+            "git_oid": file.git_oid,
+            "size": file.size,
+            "error": error,
+            "budget": budget.as_dict() if budget else None,
+            "time": int(time.time()),
+        }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with filelock.FileLock(f"{self.path}.lock", timeout=60):
+            with self.path.open('ab') as f:
+                f.write(orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE))
+        log.warn(f"quarantined {file.path} of {self.repo_url}: {error}")
+
+    def entries(self) -> Iterable[dict]:
+        if not self.path.exists():
+            return
+        with self.path.open('rb') as f:
+            for line in f:
+                if line.strip():
+                    yield orjson.loads(line)
+
+    def file_keys(self, repo_url: str) -> Set[Tuple[str, int, str]]:
+        """(path, mode, git_oid) of every quarantined file of a repo"""
+        return {
+            (e["path"], e["mode"], e["git_oid"])
+            for e in self.entries() if e["repo_url"] == repo_url
+        }
+
+def only_files(files: Iterable, keys: Set[Tuple[str, int, str]]) -> Iterable:
+    """Filter file tasks (WSTFiles or lists of them) to those in keys"""
+    for f in files:
+        if isinstance(f, list):
+            f = [v for v in f if (v.path, v.mode, v.git_oid) in keys]
+            if f:
+                yield f
+        elif (f.path, f.mode, f.git_oid) in keys:
+            yield f
+
+def add_budget_args(parser):
+    """Add the per-file budget and quarantine options to a command"""
+    parser.add_argument(
+        "--max-file-bytes",
+        type=int,
+        help="Do not parse files larger than this",
+        default=None,
+    )
+    parser.add_argument(
+        "--parse-timeout",
+        type=float,
+        help="Seconds tree-sitter may spend parsing one file",
+        default=None,
+    )
+    parser.add_argument(
+        "--max-nodes",
+        type=int,
+        help="Do not collect trees with more nodes than this",
+        default=None,
+    )
+    parser.add_argument(
+        "--max-file-seconds",
+        type=float,
+        help="Wall-clock seconds allowed for processing one file",
+        default=None,
+    )
+    parser.add_argument(
+        "--quarantine",
+        type=Path,
+        help="Record files going over a budget to this JSONL file",
+        default=None,
+    )
+    parser.add_argument(
+        "--only-quarantined",
+        type=Path,
+        help="Only process this repo's files recorded in this quarantine file, e.g. to retry with bigger budgets",
+        default=None,
+    )
+
+def budget_from_args(args) -> FileBudget:
+    budget = FileBudget(
+        max_bytes=args.max_file_bytes,
+        parse_timeout=args.parse_timeout,
+        max_nodes=args.max_nodes,
+        max_seconds=args.max_file_seconds,
+    )
+    return budget if budget else None
@@ -1,2 +1,2 @@
-
 from . import file
+from . import langs
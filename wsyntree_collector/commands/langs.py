@@ -0,0 +1,88 @@
+
+from pathlib import Path
+
+from wsyntree import log
+from wsyntree.constants import wsyntree_langs
+from wsyntree.wrap_tree_sitter import TreeSitterAutoBuiltLanguage
+from wsyntree.grammar_bundle import (
+    default_bundle_dir, find_grammar_source, build_grammar_bundle, get_grammar_bundle,
+)
+
+_vendor_dir = Path(__file__).resolve().parents[2] / "vendor"
+
+def set_args(parser):
+    subcmds = parser.add_subparsers(title="Manage tree-sitter grammars")
+
+    cmd_build = subcmds.add_parser(
+        'build', help="Build all grammars into one prebuilt bundle")
+    cmd_build.set_defaults(func=build)
+    cmd_build.add_argument(
+        "langs",
+        nargs="*",
+        help="Languages to include, default: all",
+        default=list(wsyntree_langs.keys()),
+    )
+    cmd_build.add_argument(
+        "-s", "--source-dir",
+        type=Path,
+        action="append",
+        help="Directory containing grammar repos (tree-sitter-<lang>), can be repeated, default: vendor/",
+        default=None,
+    )
+    cmd_build.add_argument(
+        "-o", "--output",
+        type=Path,
+        help="Bundle directory to write",
+        default=default_bundle_dir(),
+    )
+    cmd_build.add_argument(
+        "-j", "--jobs",
+        type=int,
+        help="Number of compiler processes, default: os.cpu_count()",
+        default=None,
+    )
+    cmd_build.add_argument(
+        "--fetch",
+        action="store_true",
+        help="Clone the grammar repos that are not available locally",
+    )
+
+    cmd_list = subcmds.add_parser(
+        'list', aliases=['ls'], help="Show the languages in the grammar bundle")
+    cmd_list.set_defaults(func=list_bundle)
+    cmd_list.add_argument(
+        "-b", "--bundle",
+        type=Path,
+        help="Bundle directory",
+        default=default_bundle_dir(),
+    )
+
+def build(args):
+    source_dirs = args.source_dir or ([_vendor_dir] if _vendor_dir.exists() else [])
+    sources = {}
+    missing = []
+    for lang in args.langs:
+        if lang not in wsyntree_langs:
+            raise ValueError(f"unknown language {lang}, known: {list(wsyntree_langs.keys())}")
+        source = find_grammar_source(lang, source_dirs)
+        if source is None and args.fetch:
+            log.info(f"fetching grammar for {lang} ...")
+            source = TreeSitterAutoBuiltLanguage(lang).get_source_dir()
+        if source is None:
+            missing.append(lang)
+            continue
+        log.debug(f"{lang} grammar from {source}")
+        sources[lang] = source
+    if missing:
+        raise FileNotFoundError(f"no local grammar source for {missing}, use --source-dir or --fetch")
+
+    bundle = build_grammar_bundle(args.output, sources, workers=args.jobs)
+    log.info(f"wrote {bundle}")
+
+def list_bundle(args):
+    bundle = get_grammar_bundle(args.bundle)
+    if bundle is None:
+        log.warn(f"no grammar bundle in {args.bundle}")
+        return
+    for lang, info in bundle.languages.items():
+        log.info(f"{lang}: commit {info['commit']}, ABI {info['abi']}")
@@ -0,0 +1,141 @@
+"""
+Asynchronous database write stage of the file workers
+
+Workers hand every finished batch of documents to the process' BulkWriter
+and go on generating the next batch, while writer threads send the bulk
+requests: parsing and database round trips overlap instead of alternating.
+
+At most max_in_flight requests are queued or running: when that many are,
+submitting waits for the oldest one (backpressure), which bounds memory.
+Work that must only happen once a file's documents are in (completing its
+WSTCodeTree) is chained with then(), and drain() waits for everything.
+"""
+
+from typing import Callable, List
+import collections
+import concurrent.futures as futures
+import functools
+import os
+import threading
+import time
+
+from pebble import ThreadPool
+
+from wsyntree import log
+
+DEFAULT_MAX_IN_FLIGHT = 4
+
+
+class BulkWriter():
+    """Bounded pool of threads sending write requests, with stats"""
+    def __init__(self, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self._pool = ThreadPool(max_workers=max_in_flight)
+        self._pending = collections.deque()
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+        # failed requests since the last drain(), in order
+        self._failed = []
+        # requests whose failure was handed to a then() on_error instead
+        self._handled = set()
+
+    def __repr__(self):
+        return f"BulkWriter<{len(self._pending)}/{self.max_in_flight} in flight>"
+
+    def _reset_stats(self):
+        self._stats = {
+            "requests": 0,
+            "docs": 0,
+            "latency": 0.0, # summed seconds of all requests
+            "max_latency": 0.0,
+            "stalled": 0.0, # seconds submitters waited on backpressure
+        }
+
+    def _timed(self, fn: Callable, docs: int, *args):
+        t = time.time()
+        r = fn(*args)
+        t = time.time() - t
+        with self._stats_lock:
+            self._stats["requests"] += 1
+            self._stats["docs"] += docs
+            self._stats["latency"] += t
+            self._stats["max_latency"] = max(self._stats["max_latency"], t)
+        return r
+
+    def _schedule(self, fn: Callable, args: tuple) -> futures.Future:
+        while self._pending and self._pending[0].done():
+            self._record_error(self._pending.popleft())
+        if len(self._pending) >= self.max_in_flight:
+            t = time.time()
+            while len(self._pending) >= self.max_in_flight:
+                f = self._pending.popleft()
+                futures.wait([f])
+                self._record_error(f)
+            with self._stats_lock:
+                self._stats["stalled"] += time.time() - t
+        f = self._pool.schedule(fn, args)
+        self._pending.append(f)
+        return f
+
+    def _record_error(self, f: futures.Future):
+        if not f.cancelled() and f.exception() is not None:
+            self._failed.append(f)
+
+    def submit(self, fn: Callable, *args, docs: int = 0) -> futures.Future:
+        """Schedule fn(*args), waiting while max_in_flight are pending
+
+        docs: number of documents written, for the stats
+        """
+        return self._schedule(self._timed, (fn, docs) + args)
+
+    def then(self, after: List[futures.Future], fn: Callable, on_error: Callable = None) -> futures.Future:
+        """Schedule fn() to run once all of after succeeded
+
+        on_error(e): called instead if any of them (or fn) failed, which
+            handles the failure: drain() does not raise it
+        """
+        def _chained():
+            try:
+                for f in after:
+                    f.result()
+                return fn()
+            except Exception as e:
+                if on_error is None:
+                    raise
+                on_error(e)
+        if on_error is not None:
+            self._handled.update(after)
+        # the futures of after were scheduled first: they are already
+        # running (or done) by the time a thread runs this
+        return self._schedule(_chained, ())
+
+    def drain(self):
+        """Wait for every pending request, raises the first error since the last drain
+
+        Failures handled by an on_error of then() are not raised.
+        """
+        futures.wait(self._pending)
+        for f in self._pending:
+            self._record_error(f)
+        self._pending.clear()
+        unhandled = [f for f in self._failed if f not in self._handled]
+        self._failed = []
+        self._handled = set()
+        if unhandled:
+            raise unhandled[0].exception()
+
+    def take_stats(self) -> dict:
+        """Stats since the previous call"""
+        with self._stats_lock:
+            stats = self._stats
+            self._reset_stats()
+        return stats
+
+@functools.lru_cache(maxsize=None)
+def _get_process_writer(max_in_flight: int, pid: int) -> BulkWriter:
+    log.debug(f"process {pid} starting BulkWriter with {max_in_flight} in flight")
+    return BulkWriter(max_in_flight)
+
+def get_bulk_writer(max_in_flight: int = DEFAULT_MAX_IN_FLIGHT) -> BulkWriter:
+    """The current process' BulkWriter, started once"""
+    return _get_process_writer(max_in_flight, os.getpid())
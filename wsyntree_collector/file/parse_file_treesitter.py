@@ -1,5 +1,4 @@
 
-from itertools import chain
 from pathlib import Path
 
 # from dask import dataframe as dd
@@ -9,7 +8,9 @@ import networkx as nx
 
 from wsyntree import log
 from wsyntree.utils import dotdict
-from wsyntree.wrap_tree_sitter import TreeSitterAutoBuiltLanguage, TreeSitterCursorIterator
+from wsyntree.wrap_tree_sitter import (
+    TreeSitterAutoBuiltLanguage, TreeSitterCursorIterator, flatten_tree,
+)
 
 # def build_dask_dataframe_for_file(lang: TreeSitterAutoBuiltLanguage, file: str):
 #     tree = lang.parse_file(file)
@@ -41,53 +42,53 @@ def build_networkx_graph(
         include_text: bool = False,
         node_name_prefix="",
     ):
-    tree = lang.parse_file(file)
-    cur = tree.walk()
-
-    if only_named_nodes:
-        cursor = TreeSitterCursorIterator(cur, nodefilter=lambda x: x.is_named)
-    else:
-        cursor = TreeSitterCursorIterator(cur)
+    with open(file, 'rb') as f:
+        content = f.read()
+    tree = lang.parse_bytes(content)
+    ft = flatten_tree(tree)
 
     G = nx.DiGraph(lang=lang.lang)
 
-    parent_stack = []
-    ts_id_to_preorder = {}
+    def _node_name(preorder):
+        return node_name_prefix + str(preorder) if node_name_prefix else preorder
 
-    root = cursor.peek()
-    # ts_id_to_preorder[root.id] = 0
+    # when filtering, unnamed nodes are skipped and their children are
+    # attached to the nearest included ancestor instead
+    included_parent = {}
 
-    for cur_node in chain([root], cursor):
-        preorder = cursor._preorder
+    for preorder in ft.preorder:
+        parent_order = ft.parent[preorder]
+        parent_order = included_parent.get(parent_order, parent_order)
+        if only_named_nodes and not ft.named[preorder]:
+            included_parent[preorder] = parent_order
+            continue
 
         nn = dotdict({
-            # preorder=preorder,
-            "id": cur_node.id,
-            "named": cur_node.is_named,
-            "type": cur_node.type,
+            "preorder": preorder,
+            "named": bool(ft.named[preorder]),
+            "type": ft.type(preorder),
+            "x1": ft.start_row[preorder],
+            "y1": ft.start_col[preorder],
+            "x2": ft.end_row[preorder],
+            "y2": ft.end_col[preorder],
         })
-        (nn.x1,nn.y1) = cur_node.start_point
-        (nn.x2,nn.y2) = cur_node.end_point
-
-        ts_id_to_preorder[cur_node.id] = preorder
-        parent_order = parent_stack[-1] if parent_stack else None
 
         if include_text:
             try:
-                nn.text = cur_node.text.decode()
+                nn.text = content[ft.start_byte[preorder]:ft.end_byte[preorder]].decode()
             except:
                 log.warn(f"Cannot decode text.")
 
         log.debug(f"adding node {preorder}: {nn}")
         # insert node and it's data
-        G.add_node(node_name_prefix + str(preorder), **nn)
+        G.add_node(_node_name(preorder), **nn)
 
         # add the edge
-        if cur_node.parent is not None:
-            log.debug(f"connecting node {preorder}, to id {cur_node.parent.id}")
+        if parent_order >= 0:
+            log.debug(f"connecting node {preorder}, to parent {parent_order}")
             G.add_edge(
-                ts_id_to_preorder[cur_node.parent.id],
-                preorder
+                _node_name(parent_order),
+                _node_name(preorder)
             )
 
     return G
@@ -0,0 +1,81 @@
+
+from pathlib import Path
+import os
+import posixpath
+
+import pygit2 as git
+
+from wsyntree import log
+from wsyntree.exceptions import *
+from wsyntree.utils import open_git_repo
+from wsyntree.key_scheme import get_key_scheme
+from wsyntree.tree_models import WSTFile
+from wsyntree.wrap_tree_sitter import get_TSABL_for_file
+
+
+def read_file_content(file: WSTFile, repo_path: str = None, work_dir: str = None) -> bytes:
+    """Read the content of a WSTFile exactly once
+
+    repo_path: if set, read the blob from this repo's object database by
+        the file's git_oid, otherwise read from the checkout
+    work_dir: the checkout of the commit being analyzed, default: the
+        current working directory
+
+    For links the content is the link target.
+    """
+    if repo_path is not None:
+        return open_git_repo(repo_path)[file.git_oid].data
+    path = Path(work_dir or '.') / file.path
+    if file.mode == git.GIT_FILEMODE_LINK:
+        if not path.is_symlink():
+            raise LocalCopyOutOfSync(f"{file.path} is not a link but should be!")
+        return os.readlink(path).encode()
+    with open(path, 'rb') as f:
+        return f.read()
+
+def prepare_file(file: WSTFile, repo_path: str = None, work_dir: str = None):
+    """Fill in the content dependent fields of an incomplete WSTFile
+
+    Sets content_hash, language, error and symlink.
+    repo_path and work_dir: where the content is read from, see read_file_content
+
+    Returns (TreeSitterAutoBuiltLanguage or None, file content bytes)
+    """
+    content = read_file_content(file, repo_path, work_dir)
+    # always done for every file:
+    file.content_hash = get_key_scheme().content_hash(content)
+    if file.mode in (git.GIT_FILEMODE_BLOB, git.GIT_FILEMODE_BLOB_EXECUTABLE):
+        # for normal files
+        lang = get_TSABL_for_file(file.path, content)
+        file.language = lang.lang if lang else None
+        file.error = "WST_NO_LANGUAGE" if not lang else None
+    elif file.mode == git.GIT_FILEMODE_LINK:
+        lang = None
+        file.language = None
+        file.error = "WST_IS_LINK"
+        # we will not parse it, instead, store the link
+        target = content.decode(errors='surrogateescape')
+        file.symlink = {
+            'target': target,
+        }
+        if repo_path is not None:
+            # no checkout to resolve against, resolve within the repo tree
+            relpath = posixpath.normpath(
+                posixpath.join(posixpath.dirname(file.path), target)
+            )
+            if posixpath.isabs(relpath) or relpath == '..' or relpath.startswith('../'):
+                # link target not within our repo dir
+                relpath = None
+            file.symlink['relative'] = relpath
+        else:
+            root = Path(work_dir or '.')
+            abspath = (root / file.path).resolve(strict=False)
+            try:
+                relpath = abspath.relative_to(root.resolve())
+                file.symlink['relative'] = str(relpath)
+            except ValueError as e:
+                # link target probably not within our repo dir
+                file.symlink['relative'] = None
+    else:
+        raise UnhandledGitFileMode(f"{file.path} mode is {oct(file.mode)}")
+    return lang, content
@@ -0,0 +1,99 @@
+"""
+The local clone of a collector's repo, and the files of its target commit
+"""
+
+from pathlib import Path
+import functools
+
+import pygit2 as git
+
+from wsyntree import log
+from wsyntree.localstorage import LocalCache
+from wsyntree.tree_models import WSTFile
+from wsyntree.utils import iter_git_tree_files, git_object_size
+
+file_modes = (git.GIT_FILEMODE_BLOB, git.GIT_FILEMODE_BLOB_EXECUTABLE, git.GIT_FILEMODE_LINK)
+
+
+class GitRepoSource():
+    """Collector mixin: clone repo_url and list the files to collect
+
+    Uses the collector's repo_url, _url_path, _target_commit and _use_odb.
+    """
+
+    @functools.cached_property
+    def _local_repo_path(self):
+        cachedir = LocalCache.get_local_cache_dir() / 'collector_repos'
+        if not cachedir.exists():
+            cachedir.mkdir(mode=0o770, exist_ok=True)
+            log.debug(f"created dir {cachedir}")
+        return cachedir.joinpath(self._url_path)
+
+    def _get_git_repo(self):
+        repodir = self._local_repo_path
+        if not (repodir / '.git').exists() and not (repodir / 'HEAD').exists():
+            repodir.mkdir(mode=0o770, parents=True, exist_ok=True)
+            log.info(f"cloning repo to {repodir} ...")
+            return git.clone_repository(
+                self.repo_url,
+                repodir.resolve(),
+                bare=self._use_odb,
+            )
+        repo = git.Repository(git.discover_repository(repodir.resolve()))
+        if repo.is_bare and not self._use_odb:
+            # left by a run with use_odb: there is no checkout to read from
+            log.warn(f"{repodir} is a bare clone, reading files from its object database instead")
+            self._use_odb = True
+        return repo
+
+    @property
+    def _current_commit(self) -> git.Commit:
+        try:
+            if self._use_odb and self._target_commit:
+                # nothing is checked out, HEAD does not move
+                return self._get_git_repo().revparse_single(self._target_commit).peel(git.Commit)
+            return self._get_git_repo().revparse_single('HEAD')
+        except KeyError as e:
+            log.error(f"repo in {self._local_repo_path} might not have HEAD?")
+
+    @property
+    def _current_commit_hash(self) -> str:
+        return str(self._current_commit.id)
+
+    def _count_files(self):
+        if self._use_odb:
+            return None # unknown until the tree is walked
+        index = self._get_git_repo().index
+        index.read()
+        return len(index)
+
+    def _iter_files(self):
+        """Iterate incomplete WSTFiles for every file in the target commit"""
+        repo = self._get_git_repo()
+        if self._use_odb:
+            for path, mode, oid in iter_git_tree_files(repo, self._current_commit.tree):
+                if not mode in file_modes:
+                    continue
+                yield WSTFile(
+                    path=path,
+                    mode=mode,
+                    size=git_object_size(repo, oid),
+                    git_oid=str(oid),
+                )
+            return
+        index = repo.index
+        index.read()
+        for gobj in index:
+            if not gobj.mode in file_modes:
+                continue
+            _file = Path(repo.workdir) / gobj.path
+            # check size of file first:
+            _fstat = _file.lstat()
+
+            yield WSTFile(
+                # _key=f"{nr.commit}-{gobj.hex}-{sha1hex(gobj.path)}",
+                path=gobj.path,
+                mode=gobj.mode,
+                size=_fstat.st_size,
+                git_oid=str(gobj.id),
+            )
@@ -0,0 +1,145 @@
+"""
+Collection of many commits from a repo's history at once
+
+Consecutive selected commits are diffed (tree to tree, so unchanged
+subtrees are never walked) to find every distinct file version: the same
+(path, mode, blob) present in many commits is only processed once, and then
+linked to every commit it is present in.
+"""
+
+from typing import Dict, Iterable, List, Tuple
+
+import pygit2 as git
+
+from wsyntree import log
+from wsyntree.utils import iter_git_tree_files, git_object_size
+from wsyntree.tree_models import WSTFile
+
+# longest chain of versions of one path processed in one task
+CHAIN_MAX_VERSIONS = 64
+
+_collected_modes = (
+    git.GIT_FILEMODE_BLOB,
+    git.GIT_FILEMODE_BLOB_EXECUTABLE,
+    git.GIT_FILEMODE_LINK,
+)
+
+
+def select_commits(repo: git.Repository, commit_range: str, every_nth: int = 1) -> List[git.Commit]:
+    """Commits to collect, oldest first
+
+    commit_range: "A..B" for the commits after A up to B, or a single
+        revision for its whole history, following first parents only
+    every_nth: keep only every nth commit, counting back from the newest
+        (which is always kept)
+    """
+    if every_nth < 1:
+        raise ValueError(f"every_nth must be at least 1")
+    if '..' in commit_range:
+        start, end = commit_range.split('..', 1)
+    else:
+        start, end = None, commit_range
+    tip = repo.revparse_single(end or 'HEAD').peel(git.Commit)
+    walker = repo.walk(tip.id, git.GIT_SORT_TOPOLOGICAL)
+    walker.simplify_first_parent()
+    if start:
+        walker.hide(repo.revparse_single(start).peel(git.Commit).id)
+    commits = list(walker)[::every_nth]
+    commits.reverse()
+    log.debug(f"selected {len(commits)} commits from {commit_range}")
+    return commits
+
+class FileVersion():
+    """One distinct file version and the commits it is present in"""
+    __slots__ = [
+        "path",
+        "mode",
+        "oid",
+        # [start, end) index ranges into the list of selected commits
+        "spans",
+    ]
+
+    def __init__(self, path: str, mode: int, oid: str):
+        self.path = path
+        self.mode = mode
+        self.oid = oid
+        self.spans = []
+
+    def __repr__(self):
+        return f"FileVersion<{self.path} {oct(self.mode)} {self.oid} {self.spans}>"
+
+    @property
+    def key(self) -> Tuple[str, int, str]:
+        return (self.path, self.mode, self.oid)
+
+    def commit_indexes(self) -> Iterable[int]:
+        for start, end in self.spans:
+            yield from range(start, end)
+
+    def make_file(self, repo: git.Repository) -> WSTFile:
+        """Incomplete WSTFile for this version, for process_file"""
+        return WSTFile(
+            path=self.path,
+            mode=self.mode,
+            size=git_object_size(repo, self.oid),
+            git_oid=self.oid,
+        )
+
+def _iter_tree_changes(repo: git.Repository, old_tree, new_tree):
+    """Yields (removed (path, mode, oid) or None, added (path, mode, oid) or None)"""
+    if old_tree is None:
+        for path, mode, oid in iter_git_tree_files(repo, new_tree):
+            yield None, (path, mode, str(oid))
+        return
+    for delta in old_tree.diff_to_tree(new_tree).deltas:
+        old = new = None
+        if delta.status != git.GIT_DELTA_ADDED:
+            old = (delta.old_file.path, delta.old_file.mode, str(delta.old_file.id))
+        if delta.status != git.GIT_DELTA_DELETED:
+            new = (delta.new_file.path, delta.new_file.mode, str(delta.new_file.id))
+        yield old, new
+
+def plan_history(repo: git.Repository, commits: List[git.Commit]) -> Dict[tuple, FileVersion]:
+    """Find every distinct file version in the selected commits
+
+    Returns FileVersions by (path, mode, oid), in order of first appearance.
+    """
+    versions = {}
+    current = {} # path -> FileVersion, open span
+    old_tree = None
+    for i, commit in enumerate(commits):
+        changes = list(_iter_tree_changes(repo, old_tree, commit.tree))
+        # all removals first: one path can be both removed and added
+        for old, new in changes:
+            if old is not None and (fv := current.get(old[0])) is not None:
+                fv.spans[-1][1] = i
+                del current[old[0]]
+        for old, new in changes:
+            if new is not None and new[1] in _collected_modes:
+                fv = versions.get(new)
+                if fv is None:
+                    fv = versions[new] = FileVersion(*new)
+                fv.spans.append([i, None])
+                current[new[0]] = fv
+        old_tree = commit.tree
+    for fv in current.values():
+        fv.spans[-1][1] = len(commits)
+    log.debug(f"{len(versions)} file versions in {len(commits)} commits")
+    return versions
+
+def file_chains(
+        repo: git.Repository,
+        versions: Dict[tuple, FileVersion],
+        max_versions: int = CHAIN_MAX_VERSIONS,
+    ) -> Iterable[List[WSTFile]]:
+    """Group the versions of each path, in order, into lists of WSTFiles
+
+    Each chain is processed as one task, so that every version can be
+    reparsed incrementally from the previous one.
+    """
+    by_path = {}
+    for fv in versions.values():
+        by_path.setdefault(fv.path, []).append(fv)
+    for path_versions in by_path.values():
+        for i in range(0, len(path_versions), max_versions):
+            yield [fv.make_file(repo) for fv in path_versions[i:i+max_versions]]
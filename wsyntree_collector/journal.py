@@ -0,0 +1,135 @@
+"""
+Crash-safe journal of a collection's JSONL output, to resume it
+
+The writer periodically flushes and fsyncs every output file, then appends
+one checkpoint line to the journal: the files completed since the previous
+checkpoint (path, mode, blob, content hash) and the size of every output
+file at that point.
+
+To resume, every output file is truncated back to the sizes of the last
+complete checkpoint, which drops partial records, and the files recorded as
+completed are skipped.
+
+Workers stream the documents of a file in batches before its WSTFile is
+written, so a checkpoint can include some documents of files that were not
+completed yet. A resumed run processes these files again and writes their
+documents a second time: resumed output has duplicate lines (same keys, same
+content) and must be imported ignoring duplicates, as import_jsonl_to_arango
+does (on_duplicate="ignore").
+"""
+
+from pathlib import Path
+from typing import Dict, Iterable, Set, Tuple
+import os
+import time
+
+import orjson
+
+from wsyntree import log
+from wsyntree.tree_models import WSTFile
+
+from .jsonl_frames import is_output_file, truncate_file, remove_file
+
+# not named .jsonl, so it is never taken for a collection file
+JOURNAL_NAME = "checkpoints.journal"
+# checkpoint at least this often
+CHECKPOINT_SECONDS = 30
+CHECKPOINT_FILES = 1000
+
+
+class CollectionJournal():
+    def __init__(self, directory: Path):
+        self.dir = Path(directory)
+        self.path = self.dir / JOURNAL_NAME
+        self._f = None
+        self._pending = []
+        self._last_checkpoint = time.time()
+
+    def __repr__(self):
+        return f"CollectionJournal<{self.path}>"
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def file_completed(self, file: WSTFile):
+        """Record a file whose documents have all been given to the writer"""
+        self._pending.append({
+            "path": file.path,
+            "mode": file.mode,
+            "git_oid": file.git_oid,
+            "content_hash": file.content_hash,
+        })
+
+    def checkpoint_due(self) -> bool:
+        if not self._pending:
+            return False
+        return (
+            len(self._pending) >= CHECKPOINT_FILES
+            or time.time() - self._last_checkpoint >= CHECKPOINT_SECONDS
+        )
+
+    def checkpoint(self, sizes: Dict[str, int]):
+        """Append a checkpoint, sizes must already be durable on disk"""
+        if self._f is None:
+            self._f = self.path.open('ab')
+        self._f.write(orjson.dumps(
+            {"time": int(time.time()), "files": self._pending, "sizes": sizes},
+            option=orjson.OPT_APPEND_NEWLINE,
+        ))
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._pending = []
+        self._last_checkpoint = time.time()
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def _checkpoints(self) -> Iterable[dict]:
+        with self.path.open('rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # interrupted while appending, never completed
+                    break
+                yield orjson.loads(line)
+
+    def restore(self) -> Set[Tuple[str, int, str]]:
+        """Roll the output dir back to the last checkpoint
+
+        Documents of files not yet completed may remain, see module docs.
+        Returns the (path, mode, git_oid) of every completed file.
+        """
+        completed = set()
+        sizes = {}
+        checkpoints = 0
+        valid_size = 0
+        if self.exists():
+            for cp in self._checkpoints():
+                for f in cp["files"]:
+                    completed.add((f["path"], f["mode"], f["git_oid"]))
+                sizes = cp["sizes"]
+                checkpoints += 1
+            with self.path.open('rb') as f:
+                valid_size = sum(len(l) for l in f if l.endswith(b"\n"))
+            os.truncate(self.path, valid_size)
+        for p in self.dir.iterdir():
+            if not is_output_file(p):
+                continue
+            if p.name in sizes:
+                truncate_file(p, sizes[p.name])
+            else:
+                # created after the last checkpoint
+                remove_file(p)
+        log.info(f"resuming from {checkpoints} checkpoints in {self.path}, {len(completed)} files already completed")
+        return completed
+
+def skip_files(files: Iterable, keys: Set[Tuple[str, int, str]]) -> Iterable:
+    """Filter file tasks (WSTFiles or lists of them) to those not in keys"""
+    for f in files:
+        if isinstance(f, list):
+            f = [v for v in f if (v.path, v.mode, v.git_oid) not in keys]
+            if f:
+                yield f
+        elif (f.path, f.mode, f.git_oid) not in keys:
+            yield f
@@ -0,0 +1,320 @@
+"""
+Batch analysis of many repos to JSONL file output
+
+Every repo in the list feeds its file tasks into one FairTaskScheduler on a
+single pool of file workers: the pool stays busy no matter how the repo
+sizes are distributed, and huge repos do not starve the small ones.
+
+Each repo still gets its own output dir ({output}/{repo path}/{commit}) and
+its own writer process, as with `analyze`.
+"""
+
+import os
+import json
+import uuid
+import multiprocessing
+from collections import deque
+from pathlib import Path
+
+from pebble import ThreadPool
+
+from wsyntree import log, multiprogress
+from wsyntree.constants import wsyntree_text_modes, wsyntree_text_hash_methods
+from wsyntree.key_scheme import KeyScheme, add_key_scheme_args, key_scheme_from_args
+
+from .jsonl_collector import WST_JSONLCollector
+from .jsonl_worker import process_files
+from .jsonl_writer import write_from_queue
+from .jsonl_frames import compression_methods
+from .journal import CollectionJournal
+from .parse_cache import default_parse_cache_path
+from .scheduling import FairTaskScheduler
+from .worker_pool import file_worker_pool
+from .budget import add_budget_args, budget_from_args
+from .text_dedup import (
+    add_text_dedup_args, check_text_dedup_args, text_dedup_from_args,
+    text_dedup_stats,
+)
+
+
+def set_jsonl_batch_args(cmd):
+    cmd.set_defaults(func=jsonl_batch_analyze, check_args=check_text_dedup_args)
+    cmd.add_argument(
+        "repo_list_file",
+        type=str,
+        help="File containing a list of repos and respective commits to analyze"
+    )
+    cmd.add_argument(
+        "-w", "--workers",
+        type=int,
+        help="Number of file workers, shared by all repos, default: os.cpu_count()",
+        default=os.cpu_count(),
+    )
+    cmd.add_argument(
+        "-j", "--jobs",
+        type=int,
+        help="Number of repos being collected (or cloned) at one time, each has a writer process",
+        default=4,
+    )
+    cmd.add_argument(
+        "-o", "--output-dir",
+        type=Path,
+        help="Write each repo's output to {output dir}/{repo path}/{commit}",
+        default=Path("output"),
+    )
+    cmd.add_argument(
+        "--skip-exists", "--skip-existing",
+        action="store_true",
+        help="Skip repos whose output dir already exists and contains data",
+    )
+    cmd.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Delete any existing files in a repo's output dir before starting it",
+    )
+    cmd.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue interrupted repos from the last checkpoint in their output dirs",
+    )
+    cmd.add_argument(
+        "--text-mode",
+        choices=wsyntree_text_modes,
+        help="Which nodes to store text for, others keep only their byte range",
+        default="full",
+    )
+    cmd.add_argument(
+        "--text-hash",
+        choices=wsyntree_text_hash_methods,
+        help="How to hash node texts for WSTText keys, merkle hashes every byte once",
+        default="full",
+    )
+    cmd.add_argument(
+        "--text-inline",
+        type=int,
+        metavar="BYTES",
+        help="Store texts of at most this many bytes on their WSTNode, only longer texts get a WSTText (default 0: all do)",
+        default=0,
+    )
+    add_key_scheme_args(cmd)
+    cmd.add_argument(
+        "--compact-graph",
+        action="store_true",
+        help="Store each node's parent and text key instead of writing the node edges, see materialize-edges",
+    )
+    cmd.add_argument(
+        "--no-checkout", "--odb",
+        dest="use_odb",
+        action="store_true",
+        help="Read files from the git object database (bare clone) instead of a checkout",
+    )
+    cmd.add_argument(
+        "--parse-cache",
+        type=Path,
+        nargs="?",
+        const=default_parse_cache_path(),
+        help="Skip parsing blobs already completed by any run using this cache (default path if no value given)",
+        default=None,
+    )
+    cmd.add_argument(
+        "--compress",
+        choices=[c for c in compression_methods if c],
+        help="Write compressed output, one seekable frame per flush (zstd requires `zstandard`)",
+        default=None,
+    )
+    add_budget_args(cmd)
+    add_text_dedup_args(cmd)
+
+class _RepoJob():
+    """One repo of the batch being collected"""
+    __slots__ = [
+        "repo_dict",
+        "collector",
+        "export_q",
+        "writer",
+        "cntr",
+    ]
+
+    def __init__(self, repo_dict, collector, export_q, writer, cntr):
+        self.repo_dict = repo_dict
+        self.collector = collector
+        self.export_q = export_q
+        self.writer = writer
+        self.cntr = cntr
+
+def _export_completed(completed: list, jobs: dict, scheduler: FairTaskScheduler, finish_job):
+    """Export the results of completed tasks, (stream key, future) from scheduler.wait()
+
+    A job failing to export is cancelled and finished: its other completed
+    tasks, possibly later in `completed`, are skipped.
+    """
+    for i, f in completed:
+        job = jobs.get(i)
+        if job is None:
+            continue
+        try:
+            job.cntr.update(job.collector.export_completed(f.result()))
+        except Exception as e:
+            log.err(f"{job.collector} failed: {type(e)}: {e}")
+            scheduler.cancel(i)
+            finish_job(jobs.pop(i), "error")
+
+def _setup_repo(repo_dict: dict, args, export_q, en_manager, text_dedup, node_q, key_scheme: KeyScheme) -> WST_JSONLCollector:
+    """Clone (and check out) one repo, runs in a setup thread"""
+    collector = WST_JSONLCollector(
+        repo_dict['url'],
+        export_q=export_q,
+        workers=args.workers,
+        commit_sha=repo_dict.get('commit', repo_dict.get('sha')),
+        en_manager=en_manager,
+        text_mode=args.text_mode,
+        text_hash=args.text_hash,
+        text_inline=args.text_inline,
+        key_scheme=key_scheme,
+        compact_graph=args.compact_graph,
+        use_odb=args.use_odb,
+        parse_cache=args.parse_cache,
+        budget=budget_from_args(args),
+        quarantine=args.quarantine,
+        only_quarantined=args.only_quarantined,
+        text_dedup=text_dedup,
+        node_q=node_q,
+    )
+    collector.setup()
+    return collector
+
+def jsonl_batch_analyze(args):
+    repo_list_file = Path(args.repo_list_file)
+    if not repo_list_file.exists():
+        log.err(f"Input file not found: {args.repo_list_file}")
+    try:
+        with repo_list_file.open('r') as f:
+            repolist = json.load(f)
+    except Exception as e:
+        log.err(f"Failed to read repo list file")
+        raise
+
+    key_scheme = key_scheme_from_args(args)
+    batch_id = uuid.uuid4().hex
+    log.info(f"Batch ID {batch_id}")
+    log.debug(f"checking {len(repolist)} items in repo list")
+
+    multiprogress.main_proc_setup()
+    multiprogress.start_server_thread()
+    en_manager_proxy = multiprogress.get_manager_proxy()
+    en_manager = multiprogress.get_manager()
+
+    results = {"completed": 0, "skipped": 0, "error": 0, "cancelled": 0}
+    todo = deque(enumerate(repolist))
+    setups = {} # future -> (index, repo_dict, export_q)
+    jobs = {} # index -> _RepoJob
+    closing_writers = []
+    all_repos_cntr = en_manager.counter(
+        desc="repos in batch", total=len(repolist), unit='repos',
+        autorefresh=True
+    )
+
+    def start_job(i: int, repo_dict: dict, collector: WST_JSONLCollector, export_q):
+        output_path = args.output_dir / collector._url_path / collector.get_commit_hash()
+        has_output = output_path.exists() and any(output_path.glob("*.jsonl*"))
+        if args.resume and output_path.exists():
+            collector.skip_completed(CollectionJournal(output_path).restore())
+        elif has_output and args.skip_exists:
+            log.warn(f"Skipping {collector}: output dir {output_path} already exists")
+            return "skipped"
+        elif has_output and not args.overwrite:
+            log.error(f"Output already exists: {output_path}, to overwrite use --overwrite")
+            return "error"
+        writer = write_from_queue(
+            export_q,
+            en_manager_proxy,
+            output_path,
+            cleanup_on_complete=True,
+            delete_existing=args.overwrite and not args.resume,
+            compression=args.compress,
+            journal=True,
+            compact=args.compact_graph,
+        )
+        try:
+            tasks, total_files = collector.start_collection()
+            task_args, task_kwargs = collector.task_args()
+        except Exception:
+            export_q.put(None)
+            closing_writers.append(writer)
+            raise
+        scheduler.add(i, process_files, tasks, task_args, task_kwargs)
+        cntr = en_manager.counter(
+            desc=f"processing {collector._url_path}",
+            total=total_files, unit="files",
+            leave=False, autorefresh=True
+        )
+        jobs[i] = _RepoJob(repo_dict, collector, export_q, writer, cntr)
+        log.debug(f"started {collector}")
+        return None
+
+    def finish_job(job: _RepoJob, status: str):
+        job.collector.finish_collection(status, wst_extra={
+            "wst_batch": batch_id,
+            **job.repo_dict
+        })
+        job.export_q.put(None)
+        # the writer drains the queue on its own, don't hold up scheduling
+        closing_writers.append(job.writer)
+        job.cntr.close()
+        log.info(f"{job.collector._url_path} {status}")
+        results[status] += 1
+        all_repos_cntr.update()
+
+    # leaves last: only persisted once every writer is done
+    with text_dedup_from_args(args) as text_dedup, \
+            multiprocessing.Manager() as mp_manager, \
+            text_dedup_stats(text_dedup, mp_manager) as node_q, \
+            file_worker_pool(args.workers) as executor, \
+            ThreadPool(max_workers=args.jobs) as setup_pool:
+        scheduler = FairTaskScheduler(executor, args.workers * 4)
+        try:
+            while todo or setups or jobs:
+                # clone ahead in the background, so the pool never waits on git
+                while todo and len(setups) + len(jobs) < args.jobs:
+                    i, repo_dict = todo.popleft()
+                    export_q = mp_manager.Queue(200)
+                    f = setup_pool.schedule(_setup_repo, (repo_dict, args, export_q, en_manager, text_dedup, node_q, key_scheme))
+                    setups[f] = (i, repo_dict, export_q)
+                for f in [f for f in setups if f.done()]:
+                    i, repo_dict, export_q = setups.pop(f)
+                    try:
+                        status = start_job(i, repo_dict, f.result(), export_q)
+                    except Exception as e:
+                        log.err(f"Failed to set up {repo_dict.get('url')}: {type(e)}: {e}")
+                        status = "error"
+                    if status is not None:
+                        results[status] += 1
+                        all_repos_cntr.update()
+
+                scheduler.fill()
+                _export_completed(scheduler.wait(also=setups.keys()), jobs, scheduler, finish_job)
+                for i in scheduler.finished():
+                    failed = scheduler.errors.pop(i, None)
+                    finish_job(jobs.pop(i), "error" if failed else "completed")
+                for w in [w for w in closing_writers if w.done()]:
+                    closing_writers.remove(w)
+                    w.result() # raises if the writer failed
+            if text_dedup is not None:
+                # failed files' texts were still written
+                text_dedup.mark_completed()
+        except KeyboardInterrupt as e:
+            log.warn(f"stopping batch worker pool...")
+            scheduler.cancel()
+            for f in setups:
+                f.cancel()
+            executor.stop()
+            executor.join()
+            for job in jobs.values():
+                finish_job(job, "cancelled")
+            raise e
+        finally:
+            log.debug(f"waiting for {len(closing_writers)} writers to finish...")
+            for w in closing_writers:
+                w.result()
+            all_repos_cntr.close()
+            log.info(f"batch {batch_id} done: {results}")
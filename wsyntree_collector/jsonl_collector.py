@@ -9,6 +9,7 @@ from multiprocessing import Queue, Manager
 import concurrent.futures as futures
 import os
 import time
+from contextlib import nullcontext
 
 import pygit2 as git
 from pebble import ProcessPool, ThreadPool
@@ -18,14 +19,24 @@ from wsyntree import log, tree_models, multiprogress
 from wsyntree.exceptions import *
 from wsyntree.tree_models import * # __all__
 from wsyntree.localstorage import LocalCache
+from wsyntree.constants import wsyntree_text_modes, wsyntree_text_hash_methods
+from wsyntree.key_scheme import KeyScheme, get_key_scheme, set_key_scheme
 from wsyntree.utils import (
-    list_all_git_files, pushd, strip_url, sha1hex, chunkiter
+    list_all_git_files, pushd, strip_url, sha1hex, chunkiter,
 )
 # from .arango_collector_worker import _tqdm_node_receiver
-from .jsonl_worker import process_file
+from .jsonl_worker import process_files
+from .jsonl_writer import WST_ShardWriter
+from .scheduling import size_ordered_tasks, BoundedTaskScheduler
+from .budget import FileBudget, Quarantine, only_files
+from .git_repo import GitRepoSource
+from .text_dedup import TextDedupFilter
+from .journal import skip_files
+from .worker_pool import file_worker_pool
+from .history import select_commits, plan_history, file_chains
 
 
-class WST_JSONLCollector():
+class WST_JSONLCollector(GitRepoSource):
     def __init__(
             self,
             repo_url: str,
@@ -35,11 +46,49 @@ class WST_JSONLCollector():
             workers: int = None,
             commit_sha: str = None,
             en_manager = None,
+            text_mode: str = "full",
+            text_hash: str = "full",
+            text_inline: int = 0,
+            key_scheme: KeyScheme = None,
+            compact_graph: bool = False,
+            use_odb: bool = False,
+            parse_cache: Path = None,
+            budget: FileBudget = None,
+            quarantine: Path = None,
+            only_quarantined: Path = None,
+            text_dedup: TextDedupFilter = None,
+            node_q = None,
+            commit_range: str = None,
+            every_nth_commit: int = 1,
+            incremental_reparse: bool = True,
         ):
         """
         export_q: Queue to write completed documents to
         commit_sha: full sha1 hex commit, optional, if present will checkout
         workers: number of file processes in parallel
+        text_mode: which nodes get a WSTText, see constants.wsyntree_text_modes
+        text_hash: WSTText key hashing, see constants.wsyntree_text_hash_methods
+        text_inline: store texts of at most this many bytes on their WSTNode
+            instead of in a WSTText, 0 to never
+        key_scheme: document key format, default: the current process' one,
+            see key_scheme
+        compact_graph: write no structural edges, the WSTNodes store what
+            they are derived from, see materialize_edges
+        use_odb: never check out, read files from the git object database
+            (the local clone is made bare)
+        parse_cache: path of a ParseCache shared across runs, None to disable
+        budget: per-file limits, see budget.FileBudget
+        quarantine: record files going over their budget to this file
+        only_quarantined: only process this repo's files in this quarantine file
+        text_dedup: skip texts already written by this run (or earlier ones),
+            the filter may be shared with other collectors
+        node_q: stats channel of the file workers, e.g. of
+            text_dedup.text_dedup_stats
+        commit_range: collect many commits, see history.select_commits,
+            implies use_odb, and commit_sha must not be set
+        every_nth_commit: with commit_range, only collect every nth commit
+        incremental_reparse: with commit_range, parse every version of a file
+            incrementally from its previous version
         """
         self.repo_url = repo_url
 
@@ -58,6 +107,36 @@ class WST_JSONLCollector():
         self._export_q = export_q
 
         self._target_commit = commit_sha
+        self._commit_range = commit_range
+        self._every_nth_commit = every_nth_commit
+        self._incremental_reparse = incremental_reparse
+        if commit_range is not None:
+            if commit_sha is not None:
+                raise ValueError(f"commit_sha cannot be used with a commit_range")
+            # newest commit of the range
+            self._target_commit = commit_range.split('..')[-1] or 'HEAD'
+            use_odb = True
+        if text_mode not in wsyntree_text_modes:
+            raise ValueError(f"text_mode must be one of {wsyntree_text_modes}")
+        self._text_mode = text_mode
+        if text_hash not in wsyntree_text_hash_methods:
+            raise ValueError(f"text_hash must be one of {wsyntree_text_hash_methods}")
+        self._text_hash = text_hash
+        if text_inline < 0:
+            raise ValueError(f"text_inline must not be negative")
+        self._text_inline = text_inline
+        self._key_scheme = key_scheme or get_key_scheme()
+        self._compact_graph = compact_graph
+        self._use_odb = use_odb
+        self._parse_cache = str(parse_cache) if parse_cache else None
+        self._budget = budget
+        self._quarantine = Quarantine(quarantine, repo_url) if quarantine else None
+        self._only_quarantined = Quarantine(only_quarantined) if only_quarantined else None
+        self._text_dedup = text_dedup
+        self._node_q = node_q
+        self._completed_files = None
+        self._shard_dir = None
+        self._shard_compression = None
         self._tree_repo = None
 
         self._worker_count = workers or os.cpu_count()
@@ -66,31 +145,18 @@ class WST_JSONLCollector():
 
     ### NOTE private control functions:
 
-    def _get_git_repo(self):
-        repodir = self._local_repo_path
-        if not (repodir / '.git').exists():
-            repodir.mkdir(mode=0o770, parents=True, exist_ok=True)
-            log.info(f"cloning repo to {repodir} ...")
-            return git.clone_repository(
-                self.repo_url,
-                repodir.resolve()
-            )
-        else:
-            repopath=git.discover_repository(
-                repodir.resolve()
-            )
-            return git.Repository(repopath)
-
-    @property
-    def _current_commit(self) -> git.Commit:
-        try:
-            return self._get_git_repo().revparse_single('HEAD')
-        except KeyError as e:
-            log.error(f"repo in {self._local_repo_path} might not have HEAD?")
 
-    @property
-    def _current_commit_hash(self) -> str:
-        return self._current_commit.hex
+    def _select_files(self, files):
+        """Only the quarantined files of this repo, with only_quarantined,
+        and none of the files already completed, see skip_completed
+        """
+        if self._completed_files:
+            files = skip_files(files, self._completed_files)
+        if self._only_quarantined is None:
+            return files
+        keys = self._only_quarantined.file_keys(self.repo_url)
+        log.info(f"only processing {len(keys)} quarantined files of {self.repo_url}")
+        return only_files(files, keys)
 
     ### NOTE immutable properties
 
@@ -100,21 +166,40 @@ class WST_JSONLCollector():
         return f"WST_ArangoTreeCollector<{repo_url}@{hash}>"
     __str__ = __repr__
 
-    @functools.cached_property
-    def _local_repo_path(self):
-        cachedir = LocalCache.get_local_cache_dir() / 'collector_repos'
-        if not cachedir.exists():
-            cachedir.mkdir(mode=0o770, exist_ok=True)
-            log.debug(f"created dir {cachedir}")
-        return cachedir.joinpath(self._url_path)
-
     ### NOTE public control functions
 
+    def use_shard_output(self, directory: Path, compression: str = None):
+        """Write output shards to directory instead of using the export queue
+
+        Every worker process appends to its own files, the collector's own
+        documents go to the 'main' shard. Returns the main shard writer,
+        close it and then call jsonl_writer.finalize_shards after collect_all.
+        """
+        self._shard_dir = str(directory)
+        self._shard_compression = compression
+        self._export_q = WST_ShardWriter(
+            directory, "main", compression=compression, compact=self._compact_graph,
+        )
+        return self._export_q
+
+    def skip_completed(self, completed_files):
+        """Resume: do not process these (path, mode, git_oid) files again
+
+        See journal.CollectionJournal.restore
+        """
+        self._completed_files = completed_files
+
     def get_commit_hash(self):
         return self._current_commit_hash
 
-    def collect_all(self, existing_node_q = None):
-        """Creates every node down the tree for this repo"""
+    def start_collection(self):
+        """Export the repo's commits and plan the files to process
+
+        Returns (tasks, total number of files), every task is a list of
+        WSTFiles to run process_files on, with the arguments of task_args().
+        See collect_all for the whole collection.
+        """
+        set_key_scheme(self._key_scheme)
         # create the main Repos
         self._tree_repo = WSTRepository(
             type='git',
@@ -125,93 +210,129 @@ class WST_JSONLCollector():
         )
         self._tree_repo._genkey()
 
-        _cc = self._current_commit
-        self._wst_commit = WSTCommit(
-            _key=_cc.hex,
-            commit_time=_cc.commit_time,
-            commit_time_offset=_cc.commit_time_offset,
-            parent_ids=[str(i) for i in _cc.parent_ids],
-            tree_id=str(_cc.tree_id),
+        if self._commit_range is None:
+            commits = [self._current_commit]
+        else:
+            commits = select_commits(
+                self._get_git_repo(), self._commit_range, self._every_nth_commit
+            )
+        wst_commits = [
+            WSTCommit(
+                _key=_cc.hex,
+                commit_time=_cc.commit_time,
+                commit_time_offset=_cc.commit_time_offset,
+                parent_ids=[str(i) for i in _cc.parent_ids],
+                tree_id=str(_cc.tree_id),
+            ) for _cc in commits
+        ]
+        self._wst_commit = wst_commits[-1]
+
+        for wst_commit in wst_commits:
+            rel_repo_commit = self._tree_repo / wst_commit
+            self._export_q.put([
+                wst_commit,
+                rel_repo_commit,
+            ])
+
+        if self._commit_range is None:
+            files = self._iter_files()
+            total_files = self._count_files()
+            self._file_commits = lambda f: wst_commits
+        else:
+            # every distinct file version once, linked to all its commits
+            repo = self._get_git_repo()
+            versions = plan_history(repo, commits)
+            if self._incremental_reparse:
+                files = file_chains(repo, versions)
+            else:
+                files = (fv.make_file(repo) for fv in versions.values())
+            total_files = len(versions)
+            self._file_commits = lambda f: [
+                wst_commits[i] for i in versions[(f.path, f.mode, f.git_oid)].commit_indexes()
+            ]
+        return size_ordered_tasks(self._select_files(files)), total_files
+
+    def task_args(self):
+        """(args, kwargs) of process_files after the task, for this collection"""
+        return (
+            (None if self._shard_dir else self._export_q,),
+            {
+                'shard_dir': self._shard_dir,
+                'shard_compression': self._shard_compression,
+                'en_manager': self.en_manager_proxy,
+                'text_mode': self._text_mode,
+                'text_hash': self._text_hash,
+                'text_inline': self._text_inline,
+                'key_scheme': self._key_scheme,
+                'compact_graph': self._compact_graph,
+                'repo_path': self._get_git_repo().path if self._use_odb else None,
+                'work_dir': None if self._use_odb else str(self._local_repo_path.resolve()),
+                'parse_cache': self._parse_cache,
+                'budget': self._budget,
+                'quarantine': self._quarantine,
+                'text_dedup': self._text_dedup,
+                'node_q': self._node_q,
+                'incremental': self._commit_range is not None and self._incremental_reparse,
+            }
         )
 
-        rel_repo_commit = self._tree_repo / self._wst_commit
-        self._export_q.put([
-            self._wst_commit,
-            rel_repo_commit,
-        ])
+    def export_completed(self, completed_files) -> int:
+        """Export the WSTFiles returned by a task, linked to their commits"""
+        for completed_file in completed_files:
+            if not hasattr(completed_file, '_key'):
+                completed_file._genkey()
+            self._export_q.put([
+                completed_file,
+                *(c / completed_file for c in self._file_commits(completed_file)),
+            ])
+        return len(completed_files)
+
+    def finish_collection(self, status: str, wst_extra: dict = None):
+        """Export the WSTRepository with its final wst_status
 
-        index = self._get_git_repo().index
-        index.read()
+        wst_extra: e.g. the repo dict of a batch input document
+        """
+        self._tree_repo.wst_status = status
+        if wst_extra is not None:
+            self._tree_repo.wst_extra = wst_extra
+        self._export_q.put(self._tree_repo)
+
+    def collect_all(self, existing_node_q = None) -> str:
+        """Creates every node down the tree for this repo, returns the final wst_status"""
+        tasks, total_files = self.start_collection()
+        task_args, task_kwargs = self.task_args()
+        status = "error"
 
         # file-level processing
-        with pushd(self._local_repo_path), Manager() as self._mp_manager:
-            with ProcessPool(max_workers=self._worker_count) as executor:
-                self._stoppable = executor
-                log.info(f"scanning git for files ...")
-                ret_futures = []
-                cntr_add_jobs = self.en_manager.counter(
-                    desc=f"scanning files for {self._url_path}",
-                    total=len(index), autorefresh=True, leave=False
+        with file_worker_pool(self._worker_count) as executor:
+            self._stoppable = executor
+            log.info(f"processing files with {self._worker_count} workers ...")
+            scheduler = BoundedTaskScheduler(executor, self._worker_count * 4)
+            try:
+                cntr_files_processed = self.en_manager.counter(
+                    desc=f"processing {self._url_path}",
+                    total=total_files, unit="files",
+                    leave=False, autorefresh=True
                 )
-                for gobj in index:
-                    if not gobj.mode in (git.GIT_FILEMODE_BLOB, git.GIT_FILEMODE_BLOB_EXECUTABLE, git.GIT_FILEMODE_LINK):
-                        continue
-                    _file = Path(gobj.path)
-                    # check size of file first:
-                    _fstat = _file.lstat()
-
-                    nf = WSTFile(
-                        # _key=f"{nr.commit}-{gobj.hex}-{sha1hex(gobj.path)}",
-                        path=gobj.path,
-                        mode=gobj.mode,
-                        size=_fstat.st_size,
-                        git_oid=gobj.hex,
-                    )
-                    # file_paths.append(p)
-                    ret_futures.append(executor.schedule(
-                        process_file,
-                        (nf, self._export_q),
-                        {'en_manager': self.en_manager_proxy}
-                    ))
-                    cntr_add_jobs.update()
-                cntr_add_jobs.close(clear=True)
-                log.info(f"processing files with {self._worker_count} workers ...")
-                try:
-                    cntr_files_processed = self.en_manager.counter(
-                        desc=f"processing {self._url_path}",
-                        total=len(ret_futures), unit="files",
-                        leave=False, autorefresh=True
-                    )
-                    for r in futures.as_completed(ret_futures):
-                        completed_file = r.result()
-                        if not hasattr(completed_file, '_key'):
-                            completed_file._genkey()
-                        self._export_q.put([
-                            completed_file,
-                            self._wst_commit / completed_file,
-                        ])
-                        cntr_files_processed.update()
-                    # after all results returned
-                    self._tree_repo.wst_status = "completed"
-                    # self._tree_repo.update_in_db(self._db)
-                    log.info(f"{self._url_path} marked completed.")
-                except KeyboardInterrupt as e:
-                    log.warn(f"stopping collection ...")
-                    for rf in ret_futures:
-                        rf.cancel()
-                    executor.close()
-                    executor.join(5)
-                    executor.stop()
-                    # raise e
-                    self._tree_repo.wst_status = "cancelled"
-                    # self._tree_repo.update_in_db(self._db)
-                    log.info(f"{self._tree_repo.url} wst_status marked as cancelled")
-                except Exception as e:
-                    self._tree_repo.wst_status = "error"
-                    raise e
-                finally:
-                    cntr_files_processed.close()
-                    self._export_q.put(self._tree_repo)
+                completed = scheduler.run(process_files, tasks, task_args, task_kwargs)
+                for r in completed:
+                    cntr_files_processed.update(self.export_completed(r.result()))
+                # after all results returned
+                status = "completed"
+                log.info(f"{self._url_path} marked completed.")
+            except KeyboardInterrupt as e:
+                log.warn(f"stopping collection ...")
+                scheduler.cancel()
+                executor.close()
+                executor.join(5)
+                executor.stop()
+                # raise e
+                status = "cancelled"
+                log.info(f"{self._tree_repo.url} wst_status marked as cancelled")
+            finally:
+                cntr_files_processed.close()
+                self.finish_collection(status)
+        return status
 
     def setup(self):
         """Clone the repo, create working directories, etc."""
@@ -224,6 +345,10 @@ class WST_JSONLCollector():
             except Exception as e:
                 log.error(f"Failed to repair repository: {type(e)}: {e}")
                 raise e
+        if self._use_odb:
+            # files are read straight from the object database
+            log.debug(f"{self} will be read without a checkout")
+            return
         # to _target_commit if set
         if self._target_commit and self._target_commit != self._current_commit_hash:
             log.info(f"Checking out commit {self._target_commit}...")
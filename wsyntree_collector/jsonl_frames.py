@@ -0,0 +1,224 @@
+"""
+Compressed, seekable JSONL output files
+
+Every flush of the writer becomes one independent compressed frame (a gzip
+member or a zstd frame) that only contains whole lines, so the files stay
+valid for any ordinary gzip / zstd reader. Each compressed file has a small
+sidecar index ("{file}.idx") of fixed-size records, one per frame:
+(compressed offset, compressed size, uncompressed offset, uncompressed size)
+which lets readers seek to and decompress any single frame.
+
+zstd requires the optional `zstandard` package.
+"""
+
+from pathlib import Path
+from typing import Iterable, List, NamedTuple
+import gzip
+import os
+import shutil
+import struct
+
+import orjson
+
+from wsyntree import log
+
+
+compression_methods = (None, "gzip", "zstd")
+_suffixes = {
+    None: "",
+    "gzip": ".gz",
+    "zstd": ".zst",
+}
+INDEX_SUFFIX = ".idx"
+_index_record = struct.Struct("<QQQQ")
+
+
+class Frame(NamedTuple):
+    offset: int
+    size: int
+    raw_offset: int
+    raw_size: int
+
+def compression_suffix(compression: str) -> str:
+    if compression not in _suffixes:
+        raise ValueError(f"compression must be one of {compression_methods}")
+    return _suffixes[compression]
+
+def compression_of(path: Path) -> str:
+    """Compression method of an output file, by file name"""
+    for method, suffix in _suffixes.items():
+        if suffix and str(path).endswith(suffix):
+            return method
+    return None
+
+def index_path(path: Path) -> Path:
+    return Path(f"{path}{INDEX_SUFFIX}")
+
+def _get_zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("zstd output requires the `zstandard` package") from e
+    return zstandard
+
+class FrameWriter():
+    """Append-only file writing one compressed frame per write()
+
+    Used in place of the file object of a WST_FileExporter collection.
+    threads: compression threads for each frame (zstd only)
+    """
+    def __init__(self, path: Path, compression: str = None, threads: int = 0, level: int = None):
+        self.path = Path(path)
+        self.compression = compression
+        compression_suffix(compression) # validate
+        if compression == "zstd":
+            zstandard = _get_zstandard()
+            self._zctx = zstandard.ZstdCompressor(level=level or 3, threads=threads)
+        elif threads:
+            log.debug(f"{compression} compression is single threaded per frame")
+        self._level = level
+        self._f = self.path.open('ab')
+        self._index = None
+        self._offset = self._f.tell()
+        self._raw_offset = 0
+        if compression is not None:
+            self._index = index_path(self.path).open('ab')
+            frames = read_frame_index(self.path)
+            if frames:
+                last = frames[-1]
+                self._raw_offset = last.raw_offset + last.raw_size
+                if last.offset + last.size != self._offset:
+                    raise RuntimeError(f"{self.path} does not match its frame index")
+
+    def __repr__(self):
+        return f"FrameWriter<{self.path}, {self.compression}>"
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.compression == "gzip":
+            return gzip.compress(data, compresslevel=self._level or 6, mtime=0)
+        return self._zctx.compress(data)
+
+    def write(self, data: bytes):
+        if self.compression is None:
+            self._f.write(data)
+            return
+        if not data:
+            # no empty frames
+            return
+        frame = self._compress(data)
+        self._f.write(frame)
+        self._index.write(_index_record.pack(
+            self._offset, len(frame), self._raw_offset, len(data)
+        ))
+        self._offset += len(frame)
+        self._raw_offset += len(data)
+
+    def flush(self):
+        self._f.flush()
+        if self._index is not None:
+            self._index.flush()
+
+    def fsync(self):
+        """Flush through to the disk"""
+        self.flush()
+        os.fsync(self._f.fileno())
+        if self._index is not None:
+            os.fsync(self._index.fileno())
+
+    @property
+    def size(self) -> int:
+        """Bytes written to the file so far, always at a frame boundary"""
+        return self._offset if self.compression is not None else self._f.tell()
+
+    def close(self):
+        self._f.close()
+        if self._index is not None:
+            self._index.close()
+
+def read_frame_index(path: Path) -> List[Frame]:
+    """Frames of a compressed output file, empty if there is no index"""
+    ipath = index_path(path)
+    if not ipath.exists():
+        return []
+    data = ipath.read_bytes()
+    return [Frame(*rec) for rec in _index_record.iter_unpack(data)]
+
+def read_frame(path: Path, frame: Frame) -> bytes:
+    """Decompress a single frame of a compressed output file"""
+    with open(path, 'rb') as f:
+        f.seek(frame.offset)
+        data = f.read(frame.size)
+    compression = compression_of(path)
+    if compression == "gzip":
+        return gzip.decompress(data)
+    elif compression == "zstd":
+        return _get_zstandard().ZstdDecompressor().decompress(
+            data, max_output_size=frame.raw_size
+        )
+    return data
+
+def open_jsonl(path: Path):
+    """Open any (possibly compressed) output file for reading decompressed bytes"""
+    compression = compression_of(path)
+    if compression == "gzip":
+        return gzip.open(path, 'rb')
+    elif compression == "zstd":
+        zstandard = _get_zstandard()
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(path, 'rb'), read_across_frames=True, closefd=True,
+        )
+    return open(path, 'rb')
+
+def iter_documents(path: Path) -> Iterable[dict]:
+    """Iterate the documents of any (possibly compressed) output file"""
+    with open_jsonl(path) as f:
+        pending = b""
+        while chunk := f.read(2 ** 20):
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                if line:
+                    yield orjson.loads(line)
+        if pending:
+            yield orjson.loads(pending)
+
+def is_output_file(path: Path) -> bool:
+    """If path is a collection file (not an index or something else)"""
+    name = Path(path).name
+    return any(name.endswith(f".jsonl{s}") for s in _suffixes.values())
+
+def append_file(src: Path, dst: Path):
+    """Append one output file (and its frame index) to another"""
+    src, dst = Path(src), Path(dst)
+    frames = read_frame_index(src)
+    dst_frames = read_frame_index(dst)
+    offset = dst.stat().st_size if dst.exists() else 0
+    raw_offset = dst_frames[-1].raw_offset + dst_frames[-1].raw_size if dst_frames else 0
+    with src.open('rb') as f, dst.open('ab') as out:
+        shutil.copyfileobj(f, out, 2 ** 20)
+    if compression_of(src) is not None:
+        with index_path(dst).open('ab') as out:
+            for fr in frames:
+                out.write(_index_record.pack(
+                    fr.offset + offset, fr.size, fr.raw_offset + raw_offset, fr.raw_size
+                ))
+
+def truncate_file(path: Path, size: int):
+    """Cut an output file (and its frame index) back to size bytes
+
+    size must be at a frame boundary, e.g. a FrameWriter.size seen before.
+    """
+    path = Path(path)
+    if not path.exists():
+        return
+    if path.stat().st_size > size:
+        os.truncate(path, size)
+    frames = read_frame_index(path)
+    keep = sum(1 for fr in frames if fr.offset + fr.size <= size)
+    if keep < len(frames):
+        os.truncate(index_path(path), keep * _index_record.size)
+
+def remove_file(path: Path):
+    """Remove an output file and its frame index"""
+    Path(path).unlink(missing_ok=True)
+    index_path(path).unlink(missing_ok=True)
@@ -25,11 +25,21 @@ from wsyntree import log, tree_models
 from wsyntree.exceptions import *
 from wsyntree.utils import dotdict, strip_url, sha1hex, sha512hex
 from wsyntree.tree_models import * # __all__
-from wsyntree.wrap_tree_sitter import get_TSABL_for_file
+from wsyntree.key_scheme import KeyScheme, get_key_scheme, set_key_scheme
+from wsyntree.wrap_tree_sitter import (
+    get_TSABL_for_file, flatten_tree, text_node_filter, merkle_digests,
+    content_edit,
+)
 
-from wsyntree_collector.jsonl_writer import WST_FileExporter as WSTFE
-
-_HASH_CHUNK_READ_SIZE_BYTES = 2 ** 16 # 64 KiB
+from wsyntree_collector.jsonl_writer import (
+    WST_FileExporter as WSTFE, get_shard_writer, serialize_documents,
+)
+from wsyntree_collector.file.prepare import prepare_file
+from wsyntree_collector.parse_cache import (
+    get_parse_cache, text_cache_options, ParseCacheEntry,
+)
+from wsyntree_collector.budget import FileBudget, Quarantine
+from wsyntree_collector.text_dedup import TextDedupFilter
 
 
 def process_file(*args, **kwargs):
@@ -40,73 +50,164 @@ def process_file(*args, **kwargs):
         log.trace(log.debug, traceback.format_exc())
         raise e
 
+class ReparseState():
+    """The last parsed version of a file, to reparse the next one incrementally"""
+    __slots__ = [
+        "path",
+        "language",
+        "content",
+        "tree",
+        # (start_byte, end_byte) -> WSTText key, None unless text_hash is full
+        "text_keys",
+    ]
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.path = self.language = self.content = self.tree = self.text_keys = None
+
+    def take(self, path: str, language: str):
+        """Get (content, tree, text_keys) if the state is for this file, always clears"""
+        prev = None
+        if self.tree is not None and self.path == path and self.language == language:
+            prev = (self.content, self.tree, self.text_keys)
+        self.clear()
+        return prev
+
+def reused_text_key(text_keys: dict, sb: int, eb: int, edit_start: int, edit_new_end: int, edit_shift: int):
+    """WSTText key of the previous version's text at the bytes sb:eb of the new one
+
+    Only texts entirely before the edit, or after its new end (shifted by
+    edit_shift), are unchanged. Returns None for any other text.
+    """
+    if eb <= edit_start:
+        return text_keys.get((sb, eb))
+    if sb >= edit_new_end:
+        return text_keys.get((sb - edit_shift, eb - edit_shift))
+    return None
+
+def process_files(
+        files, export_q, *args,
+        shard_dir: str = None, shard_compression: str = None,
+        incremental: bool = False,
+        **kwargs
+    ):
+    """Run process_file for each of a batch of files, returns the list of results
+
+    shard_dir: if set, export_q is ignored and this process writes its
+        documents to its own shard in shard_dir, see jsonl_writer.get_shard_writer
+    shard_compression: compression of the shard files
+    incremental: files are consecutive versions of the same path (see
+        history.file_chains), reparse each from the previous one's tree
+    """
+    if incremental:
+        kwargs['reparse_state'] = ReparseState()
+    if shard_dir is None:
+        return [process_file(f, export_q, *args, **kwargs) for f in files]
+    shard = get_shard_writer(shard_dir, shard_compression)
+    try:
+        return [process_file(f, shard, *args, **kwargs) for f in files]
+    finally:
+        # the rest is written by later tasks, or when the worker exits
+        shard.flush_if_needed()
+
 def _process_file(
         file: WSTFile,
         export_q,
         *,
         node_q = None,
         en_manager = None,
+        repo_path: str = None,
+        work_dir: str = None,
+        text_mode: str = "full",
+        text_hash: str = "full",
+        text_inline: int = 0,
+        key_scheme: KeyScheme = None,
+        compact_graph: bool = False,
+        parse_cache: str = None,
+        reparse_state: ReparseState = None,
+        budget: FileBudget = None,
+        quarantine: Quarantine = None,
+        text_dedup: TextDedupFilter = None,
         batch_write_size=10000,
     ):
     """Given an incomplete WSTFile,
     Creates a WSTCodeTree, WSTNodes, and WSTTexts for it
 
-    Process working directory should already be within checked out repository
+    Unless repo_path or work_dir is given, process working directory should
+    already be within checked out repository
 
-    node_q: push integers for counting number of added syntax nodes
+    node_q: push integers for counting number of added syntax nodes, and
+        stats tuples, e.g. those of text_dedup.text_dedup_stats
     en_manager: Enlighten Manager compatible API to get Counters from
+    repo_path: read file content from this repo's object database instead
+    work_dir: read file content from this checkout instead
+    text_mode: which nodes get a WSTText, one of constants.wsyntree_text_modes
+    text_hash: how WSTText keys are hashed, one of constants.wsyntree_text_hash_methods
+    text_inline: texts of at most this many bytes are stored on their WSTNode,
+        only longer ones get a WSTText, 0 for none
+    key_scheme: make keys and content hashes with this KeyScheme, default:
+        the process' current one
+    compact_graph: store the parent preorder and text key on every WSTNode
+        instead of writing the node -> child, text and root node edges, and
+        leave out null fields, see materialize_edges
+    parse_cache: path of a ParseCache, skip parsing blobs already recorded there
+    reparse_state: reparse incrementally from, and update, this ReparseState
+    budget: limits for this file, going over sets the WSTFile or WSTCodeTree
+        error to the budget error code instead of failing
+    quarantine: record files going over their budget here
+    text_dedup: skip WSTTexts any worker sharing this filter already wrote
     batch_write_size: when number of items in memory reaches this, write them all
 
     Returns the WSTFile, linked to it's new CodeTree
     """
 
-    # always done for every file:
-    file_shake_256 = hashlib.shake_256() # WST hashes
-    _filepath = Path(file.path)
-    if file.mode in (git.GIT_FILEMODE_BLOB, git.GIT_FILEMODE_BLOB_EXECUTABLE):
-        # for normal files
-        with open(file.path, 'rb') as f:
-            while (data := f.read(_HASH_CHUNK_READ_SIZE_BYTES)):
-                file_shake_256.update(data)
-        lang = get_TSABL_for_file(file.path)
-        file.language = lang.lang if lang else None
-        file.error = "WST_NO_LANGUAGE" if not lang else None
-        file.content_hash = file_shake_256.hexdigest(64) # 128 hex chars
-    elif file.mode == git.GIT_FILEMODE_LINK:
-        lang = None
-        file.language = None
-        file.error = "WST_IS_LINK"
-        # we will not parse it, instead, store the link
-        if not _filepath.is_symlink():
-            raise LocalCopyOutOfSync(f"{file.path} is not a link but should be!")
-        target = Path(os.readlink(_filepath))
-        file.symlink = {
-            'target': str(target),
-        }
-        abspath = _filepath.resolve(strict=False)
+    if key_scheme is not None:
+        set_key_scheme(key_scheme)
+    t_start = time.time()
+    lang, content = prepare_file(file, repo_path, work_dir)
+    if budget is not None and lang is not None:
         try:
-            relpath = abspath.relative_to(Path('.').resolve())
-            file.symlink['relative'] = str(relpath)
-        except ValueError as e:
-            # link target probably not within our repo dir
-            file.symlink['relative'] = None
-        file_shake_256.update(str(target).encode())
-        file.content_hash = file_shake_256.hexdigest(64)
-    else:
-        raise UnhandledGitFileMode(f"{file.path} mode is {oct(file.mode)}")
+            budget.check_size(len(content))
+        except BudgetExceeded as e:
+            # no WSTCodeTree will be generated
+            file.error = e.code
+            lang = None
+            if quarantine:
+                quarantine.add(file, e.code, budget)
 
     # TODO these go at end
     # export_q.put(file)
     # export_q.put(wst_commit / file) # commit -> file
 
+    previous = None
+    if reparse_state is not None:
+        previous = reparse_state.take(file.path, file.language)
+
     if lang is None:
         # no WSTCodeTree will be generated
         return file
 
+    if parse_cache:
+        cache = get_parse_cache(parse_cache)
+        cache_args = (file.language, lang.get_version(), file.content_hash)
+        cache_options = text_cache_options(text_mode, text_hash, text_inline, compact_graph)
+        if (cached_key := cache.get(*cache_args, cache_options)) is not None:
+            # the CodeTree is already complete, only link it
+            if not hasattr(file, '_key'):
+                file._genkey()
+            export_q.put(serialize_documents([
+                WST_Edge(file, f"{WSTCodeTree._collection}/{cached_key}")
+            ], compact_graph))
+            if node_q:
+                node_q.put(('dedup_stats', 'WSTCodeTree', 1))
+            return file
+
     # otherwise, let the parsing begin!
     code_tree = WSTCodeTree(
         language=file.language,
-        lang_version=None, # TODO
+        lang_version=lang.get_version(),
         content_hash=file.content_hash,
         git_oid=file.git_oid,
         error=None,
@@ -116,118 +217,195 @@ def _process_file(
     # export_q.put(code_tree)
     # export_q.put(file / code_tree)
 
-    tree = lang.parse_file(file.path)
+    # bail if we can't decode text, checked once for the whole file so that
+    # node texts can be decoded without further checks, only if any are kept
+    if text_mode != "none":
+        try:
+            content.decode()
+        except UnicodeDecodeError as e:
+            log.warn(f"{file}: failed to decode content")
+            code_tree.error = "UnicodeDecodeError"
+            export_q.put(serialize_documents([code_tree], compact_graph))
+            return file # ends process
 
-    t_start = time.time()
-    t_notified = False
-    cursor = tree.walk()
-    # memoization of WSTTexts
-    known_exists_text_ids = set()
+    def over_budget(e: BudgetExceeded):
+        """Record the partial CodeTree, nodes already written stay orphaned"""
+        code_tree.error = e.code
+        export_q.put(serialize_documents([code_tree], compact_graph))
+        if quarantine:
+            quarantine.add(file, e.code, budget)
+        return file
+    timeout_micros = budget.parse_timeout_micros if budget else None
+    edit = None
+    reuse_text_keys = None
+    try:
+        if previous is not None:
+            prev_content, tree, prev_text_keys = previous
+            edit = content_edit(prev_content, content)
+            if edit is not None:
+                tree.edit(**edit)
+                tree = lang.parse_bytes(content, tree, timeout_micros)
+            # text keys only depend on the text, reuse them outside of the edit
+            reuse_text_keys = prev_text_keys
+            del previous, prev_content
+        else:
+            tree = lang.parse_bytes(content, timeout_micros=timeout_micros)
+        ft = flatten_tree(tree, budget.max_nodes if budget else None)
+    except BudgetExceeded as e:
+        return over_budget(e)
+    if edit is not None:
+        edit_start, edit_new_end = edit['start_byte'], edit['new_end_byte']
+        edit_shift = edit['new_end_byte'] - edit['old_end_byte']
+    else:
+        # unchanged: every text is before the "edit"
+        edit_start = edit_new_end = len(content)
+        edit_shift = 0
+    if reparse_state is None:
+        del tree
+    new_text_keys = {} if reparse_state is not None and text_hash == "full" else None
+    has_text = text_node_filter(ft, text_mode)
+    if text_hash == "merkle" and text_mode != "none":
+        scheme = get_key_scheme()
+        text_digests = merkle_digests(ft, content, scheme.digest_bytes, scheme.hash_algorithm)
+    else:
+        text_digests = None
+
+    def same_text(known: tuple, sb: int, eb: int) -> bool:
+        """Key collision check of a repeated WSTText key, only run on repeats"""
+        ksb, keb = known
+        if keb - ksb != eb - sb:
+            return False
+        if text_digests is not None:
+            # the key is the merkle digest of the text, nothing to hash again
+            return True
+        return content[ksb:keb] == content[sb:eb]
+
+    # memoization of WSTTexts, key -> (start_byte, end_byte) of its first node
+    known_texts = {}
     memoiz_stats = [0, 0]
-    # iteration loop
-    preorder = 0
-    order_to_id = {}
-    parent_stack = []
+    node_id_prefix = f"{WSTNode._collection}/{code_tree._key}-"
+    kinds = ft.kinds
     batch_writes = []
     try:
         # definitions: nn = new node, nt = new text, nc = node count
-        while cursor.node is not None:
-            cur_node = cursor.node
+        for preorder in range(len(ft)):
             nn = WSTNode(
                 _key=f"{code_tree._key}-{preorder}",
-                named=cur_node.is_named,
-                type=cur_node.type,
+                named=bool(ft.named[preorder]),
+                type=kinds[ft.kind[preorder]],
                 preorder=preorder,
+                x1=ft.start_row[preorder],
+                y1=ft.start_col[preorder],
+                x2=ft.end_row[preorder],
+                y2=ft.end_col[preorder],
+                start_byte=ft.start_byte[preorder],
+                end_byte=ft.end_byte[preorder],
             )
-            (nn.x1,nn.y1) = cur_node.start_point
-            (nn.x2,nn.y2) = cur_node.end_point
-            parentorder = parent_stack[-1] if parent_stack else None
-
-            # bail if we can't decode text
-            try:
-                text = cur_node.text.tobytes().decode()
-                textlength = len(text)
-            except UnicodeDecodeError as e:
-                log.warn(f"{file}: failed to decode content")
-                code_tree.error = "UnicodeDecodeError"
-                batch_writes.append(code_tree)
-                return file # ends process
+            parentorder = ft.parent[preorder]
 
             batch_writes.append(nn)
-            order_to_id[nn.preorder] = nn._id
-            if parentorder is not None:
+            if compact_graph:
+                # the edges are derived from this, see materialize_edges
+                nn.parent = parentorder
+            elif parentorder >= 0:
                 # parent node -> child
-                batch_writes.append(WST_Edge(order_to_id[parentorder], nn))
+                batch_writes.append(WST_Edge(f"{node_id_prefix}{parentorder}", nn))
             else:
-                # if it is none, this is the root node, link it
+                # root node, link it
                 batch_writes.append(code_tree / nn)
 
             # text storage (deduplication)
-            nt = WSTText(
-                length=textlength,
-                text=text,
-            )
-            nt._genkey()
-            if nt._id not in known_exists_text_ids:
-                batch_writes.append(nt)
-                known_exists_text_ids.add(nt._id)
-                memoiz_stats[1] += 1
-            else:
-                memoiz_stats[0] += 1
-            # link node -> text
-            batch_writes.append(nn / nt)
+            if has_text(preorder):
+                sb, eb = ft.start_byte[preorder], ft.end_byte[preorder]
+                if text_inline and eb - sb <= text_inline:
+                    # short text: on the node itself, no WSTText nor edge
+                    nn.text = content[sb:eb].decode()
+                else:
+                    text_key = None
+                    if reuse_text_keys is not None:
+                        text_key = reused_text_key(
+                            reuse_text_keys, sb, eb, edit_start, edit_new_end, edit_shift,
+                        )
+                    if text_key is not None:
+                        # unchanged text, already written with the previous version
+                        memoiz_stats[0] += 1
+                        if compact_graph:
+                            nn.text_key = text_key
+                        else:
+                            batch_writes.append(WST_Edge(nn, f"{WSTText._collection}/{text_key}"))
+                    else:
+                        text = content[sb:eb].decode()
+                        nt = WSTText(
+                            length=len(text),
+                            text=text,
+                        )
+                        text_key = nt._genkey(text_digests[preorder] if text_digests else None)
+                        known = known_texts.get(text_key)
+                        if known is None:
+                            batch_writes.append(nt)
+                            known_texts[text_key] = (sb, eb)
+                            memoiz_stats[1] += 1
+                        elif not same_text(known, sb, eb):
+                            raise KeyCollisionError(f"WSTText {text_key} of {file.path}: two different texts")
+                        else:
+                            memoiz_stats[0] += 1
+                        # link node -> text
+                        if compact_graph:
+                            nn.text_key = text_key
+                        else:
+                            batch_writes.append(nn / nt)
+                    if new_text_keys is not None:
+                        new_text_keys[(sb, eb)] = text_key
 
             if len(batch_writes) >= batch_write_size:
-                export_q.put(batch_writes)
+                if text_dedup is not None:
+                    batch_writes = text_dedup.filter_documents(batch_writes, node_q)
+                export_q.put(serialize_documents(batch_writes, compact_graph))
                 batch_writes = []
+                if budget is not None:
+                    budget.check_time(t_start)
 
-            preorder += 1
-
-            # now determine where to move to next:
-            next_child = cursor.goto_first_child()
-            if next_child == True:
-                parent_stack.append(nn.preorder)
-                continue # cur_node to next_child
-            next_sibling = cursor.goto_next_sibling()
-            if next_sibling == True:
-                continue # cur_node to next_sibling
-            # go up parents
-            while cursor.goto_next_sibling() == False:
-                goto_parent = cursor.goto_parent()
-                if goto_parent:
-                    parent_stack.pop()
-                else:
-                    # we are done iterating
-                    if len(parent_stack) != 0:
-                        log.err(f"Bad tree iteration detected! Recorded more parents than ascended.")
-                    # NOTE successful end of processing
-                    # log.debug(f"{file.path} added {preorder} nodes")
-                    if node_q:
-                        node_q.put((
-                            "cache_stats",
-                            {
-                                "text_lfu_hit": memoiz_stats[0],
-                                "text_lfu_miss": memoiz_stats[1],
-                            }
-                        ))
-                    # unset error: CodeTree is completed successfully
-                    code_tree.error = None
-                    batch_writes.append(code_tree)
-                    if not hasattr(file, '_key'):
-                        file._genkey()
-                    if not hasattr(code_tree, '_key'):
-                        code_tree._genkey()
-                    batch_writes.append(file / code_tree)
-                    if batch_writes:
-                        export_q.put(batch_writes)
-                        batch_writes = []
-                    return file # end process / everything went smoothly
+        # NOTE successful end of processing
+        # log.debug(f"{file.path} added {len(ft)} nodes")
+        if node_q:
+            node_q.put((
+                "cache_stats",
+                {
+                    "text_lfu_hit": memoiz_stats[0],
+                    "text_lfu_miss": memoiz_stats[1],
+                }
+            ))
+        # unset error: CodeTree is completed successfully
+        code_tree.error = None
+        batch_writes.append(code_tree)
+        if not hasattr(file, '_key'):
+            file._genkey()
+        if not hasattr(code_tree, '_key'):
+            code_tree._genkey()
+        batch_writes.append(file / code_tree)
+        if text_dedup is not None:
+            batch_writes = text_dedup.filter_documents(batch_writes, node_q)
+        if batch_writes:
+            export_q.put(serialize_documents(batch_writes, compact_graph))
+            batch_writes = []
+        if parse_cache:
+            # recorded by the writer, once the documents above are durable
+            export_q.put(ParseCacheEntry(parse_cache, *cache_args, code_tree._key, cache_options))
+        if reparse_state is not None:
+            reparse_state.path = file.path
+            reparse_state.language = file.language
+            reparse_state.content = content
+            reparse_state.tree = tree
+            reparse_state.text_keys = new_text_keys
+        return file # end process / everything went smoothly
     except BrokenPipeError as e:
         log.warn(f"caught {type(e)}: {e}")
         os._exit(1)
+    except BudgetExceeded as e:
+        return over_budget(e)
     except Exception as e:
         code_tree.error = str(e)
-        export_q.put(code_tree)
+        export_q.put(serialize_documents([code_tree], compact_graph))
         log.err(f"WSTNode generation failed: {e}")
         raise e
     # finally:
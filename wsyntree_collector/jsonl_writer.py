@@ -6,6 +6,8 @@ from typing import Union, List
 import json
 from contextlib import contextmanager
 import cProfile
+import functools
+import multiprocessing.util
 
 import orjson
 import filelock
@@ -15,7 +17,104 @@ from wsyntree import log, tree_models, multiprogress
 from wsyntree.exceptions import *
 from wsyntree.utils import dotdict, strip_url, sha1hex, sha512hex
 from wsyntree.tree_models import * # __all__
+from wsyntree.key_scheme import KeyScheme, get_key_scheme
 
+from .jsonl_frames import (
+    FrameWriter, compression_suffix, append_file, remove_file,
+)
+from .journal import CollectionJournal
+from .parse_cache import ParseCacheEntry
+
+
+KEY_SCHEME_NAME = "key_scheme.json"
+
+def read_key_scheme(directory: Path) -> KeyScheme:
+    """The KeyScheme recorded in an output dir, None if there is none"""
+    path = Path(directory) / KEY_SCHEME_NAME
+    if not path.exists():
+        return None
+    return KeyScheme(**orjson.loads(path.read_bytes()))
+
+def record_key_scheme(directory: Path, scheme: KeyScheme = None, replace: bool = False):
+    """Record the KeyScheme (default: the current one) of an output dir's documents
+
+    Raises ValueError if the dir already holds documents of another scheme,
+    unless replace.
+    """
+    directory = Path(directory)
+    scheme = scheme or get_key_scheme()
+    recorded = read_key_scheme(directory)
+    if recorded == scheme:
+        return
+    if recorded is not None and not replace:
+        raise ValueError(f"{directory} has documents of {recorded}, not {scheme}")
+    tmp = directory / f".{KEY_SCHEME_NAME}.{os.getpid()}"
+    tmp.write_bytes(orjson.dumps(
+        {"version": scheme.version, "digest_bytes": scheme.digest_bytes},
+        option=orjson.OPT_APPEND_NEWLINE,
+    ))
+    os.replace(tmp, directory / KEY_SCHEME_NAME)
+
+def collection_file_kinds():
+    """Iterate (collection name, 'vert' or 'edge') of every collection"""
+    for collname in tree_models._db_collections:
+        yield collname, "vert"
+    for collname in tree_models._db_edgecollections:
+        yield collname, "edge"
+
+def collection_filename(collname: str, kind: str, shard: str = None, compression: str = None) -> str:
+    suffix = compression_suffix(compression)
+    if shard is None:
+        return f"{collname}.{kind}.jsonl{suffix}"
+    return f"{collname}.{shard}.{kind}.jsonl{suffix}"
+
+def dump_document(doc: Union[WST_Document, WST_Edge], compact: bool = False) -> bytes:
+    """One JSONL line of a document
+
+    compact: leave out _id (it is _collection/_key) and unset fields (null)
+    """
+    d = doc.__dict__
+    if compact:
+        d = {k: v for k, v in d.items() if v is not None and k != "_id"}
+    return orjson.dumps(
+        d, option=orjson.OPT_SORT_KEYS | orjson.OPT_APPEND_NEWLINE
+    )
+
+class WST_SerializedBatch():
+    """Documents already encoded to JSONL, grouped per collection
+
+    Built by workers, so the writer only has to append bytes and the data
+    crossing processes is a few byte strings instead of many pickled objects.
+    """
+    __slots__ = [
+        "collections", # collection name -> bytes
+        "count", # number of documents
+    ]
+
+    def __init__(self, collections: dict, count: int):
+        self.collections = collections
+        self.count = count
+
+    def __repr__(self):
+        return f"WST_SerializedBatch<{self.count} documents, {list(self.collections.keys())}>"
+
+def serialize_documents(docs: List[Union[WST_Document, WST_Edge]], compact: bool = False) -> WST_SerializedBatch:
+    """Encode documents for an export queue, generating missing keys
+
+    compact: see dump_document
+    """
+    collections = {}
+    for doc in docs:
+        if isinstance(doc, WST_Document) and not hasattr(doc, '_key'):
+            doc._genkey()
+        buf = collections.get(doc._collection)
+        if buf is None:
+            buf = collections[doc._collection] = bytearray()
+        buf += dump_document(doc, compact)
+    return WST_SerializedBatch(
+        {k: bytes(v) for k, v in collections.items()},
+        len(docs),
+    )
 
 class WST_FileExporter():
     def __init__(
@@ -23,21 +122,49 @@ class WST_FileExporter():
             directory: Path,
             delete_existing: bool = False,
             en_manager = None,
+            shard: str = None,
+            compression: str = None,
+            compression_threads: int = 0,
+            journal: bool = False,
+            compact: bool = False,
         ):
+        """
+        shard: write to this shard's own files ({collname}.{shard}.*.jsonl)
+            instead of the shared per-collection files
+        compression: None, "gzip" or "zstd", every flush is written as a
+            seekable frame, see jsonl_frames
+        compression_threads: threads used to compress each frame (zstd only)
+        journal: checkpoint completed files and output sizes to the
+            directory's CollectionJournal, so the collection can be resumed
+        compact: write documents given as objects compact, see dump_document
+
+        The current key scheme is recorded in the directory, see
+        record_key_scheme.
+        """
         if isinstance(directory, str):
             directory = Path(directory)
         self.dir = directory.resolve()
         self.dir.mkdir(parents=True, exist_ok=True)
+        self.shard = shard
+        self.compression = compression
+        self.compact = compact
+        self._compression_threads = compression_threads
         self._coll_files = {}
 
-        for collname in tree_models._db_collections:
-            self._coll_files[collname] = self.dir / f"{collname}.vert.jsonl"
-        for collname in tree_models._db_edgecollections:
-            self._coll_files[collname] = self.dir / f"{collname}.edge.jsonl"
+        for collname, kind in collection_file_kinds():
+            self._coll_files[collname] = self.dir / collection_filename(
+                collname, kind, shard, compression
+            )
 
+        self.journal = CollectionJournal(self.dir) if journal else None
+        # ParseCacheEntries to record after the next checkpoint
+        self._pending_cache_entries = []
         if delete_existing:
             for cf in self._coll_files.values():
-                cf.unlink(missing_ok=True)
+                remove_file(cf)
+            if self.journal is not None:
+                self.journal.path.unlink(missing_ok=True)
+        record_key_scheme(self.dir, replace=delete_existing)
 
         self._in_context = False
         self._open_files = {}
@@ -46,7 +173,8 @@ class WST_FileExporter():
 
         self._locks = {}
         for collname, cf in self._coll_files.items():
-            self._locks[collname] = filelock.FileLock(self.dir / f"{collname}.lock")
+            lockname = f"{collname}.lock" if shard is None else f"{collname}.{shard}.lock"
+            self._locks[collname] = filelock.FileLock(self.dir / lockname)
             # self._pending_lines[collname] = []
             self._pending_bytes[collname] = bytearray()
 
@@ -59,9 +187,7 @@ class WST_FileExporter():
         modified_collections = set()
         for doc in docs:
             # self._pending_lines[doc._collection].append(json.dumps(doc.__dict__, sort_keys=True) + '\n')
-            self._pending_bytes[doc._collection] += orjson.dumps(
-                doc.__dict__, option=orjson.OPT_SORT_KEYS | orjson.OPT_APPEND_NEWLINE
-            )
+            self._pending_bytes[doc._collection] += dump_document(doc, self.compact)
             modified_collections.add(doc._collection)
         for collname in modified_collections:
             self._flush_if_needed(collname)
@@ -73,11 +199,51 @@ class WST_FileExporter():
         # f.write(json.dumps(doc.__dict__, sort_keys=True))
         # f.write('\n')
         # self._pending_lines[doc._collection].append(json.dumps(doc.__dict__, sort_keys=True) + '\n')
-        self._pending_bytes[doc._collection] += orjson.dumps(
-            doc.__dict__, option=orjson.OPT_SORT_KEYS | orjson.OPT_APPEND_NEWLINE
-        )
+        self._pending_bytes[doc._collection] += dump_document(doc, self.compact)
         self._flush_if_needed(doc._collection)
 
+    def write_serialized(self, batch: WST_SerializedBatch):
+        """Append documents already encoded by serialize_documents"""
+        for collname, data in batch.collections.items():
+            self._pending_bytes[collname] += data
+            self._flush_if_needed(collname)
+
+    def write_incoming(self, incoming) -> int:
+        """Write anything sent through an export queue, returns number of documents"""
+        if isinstance(incoming, WST_SerializedBatch):
+            self.write_serialized(incoming)
+            return incoming.count
+        elif isinstance(incoming, list):
+            for doc in incoming:
+                if isinstance(doc, WST_Document) and not hasattr(doc, '_key'):
+                    doc._genkey()
+            self.write_many_documents(incoming)
+            if self.journal is not None:
+                for doc in incoming:
+                    if isinstance(doc, WSTFile):
+                        # sent after all of the file's other documents
+                        self.journal.file_completed(doc)
+                if self.journal.checkpoint_due():
+                    self.checkpoint()
+            return len(incoming)
+        elif isinstance(incoming, WST_Document):
+            doc = incoming
+            if not hasattr(doc, '_key'):
+                doc._genkey()
+            self.write_document(doc)
+            return 1
+        elif isinstance(incoming, WST_Edge):
+            doc = incoming
+            self.write_document(doc)
+            return 1
+        elif isinstance(incoming, ParseCacheEntry):
+            # the CodeTree's documents may still be pending, or be truncated
+            # by a resume: recorded by the next persist() or checkpoint()
+            self._pending_cache_entries.append(incoming)
+            return 0
+        else:
+            raise RuntimeError(f"Invalid write input: {incoming}")
+
     def cleanup(self):
         """Cleans up the output dir, removing extras like lockfiles
 
@@ -103,9 +269,54 @@ class WST_FileExporter():
             except filelock.Timeout as e:
                 log.error(f"Could not acquire output lock for {collname}")
                 raise e
-            self._open_files[collname] = cf.open('ab')
+            self._open_files[collname] = FrameWriter(
+                cf, self.compression, self._compression_threads
+            )
+
+    def sync(self):
+        """Write out everything pending, through to the OS"""
+        self._flush()
+        for f in self._open_files.values():
+            f.flush()
+
+    def checkpoint(self):
+        """Write out everything pending to disk, then record a journal checkpoint
+
+        ParseCacheEntries received before it are recorded after it.
+        """
+        self._flush()
+        sizes = {}
+        for collname, f in self._open_files.items():
+            f.fsync()
+            sizes[self._coll_files[collname].name] = f.size
+        self.journal.checkpoint(sizes)
+        self._record_cache_entries()
+
+    def persist(self):
+        """Write out everything pending, through to the disk if ParseCacheEntries
+        were received, and then record them
+
+        Without a journal, cache entries are only recorded by this.
+        """
+        if not self._pending_cache_entries:
+            self.sync()
+            return
+        self._flush()
+        for f in self._open_files.values():
+            f.fsync()
+        self._record_cache_entries()
+
+    def _record_cache_entries(self):
+        for entry in self._pending_cache_entries:
+            entry.put()
+        self._pending_cache_entries = []
 
     def _close_all(self):
+        if self.journal is not None:
+            self.checkpoint()
+            self.journal.close()
+        else:
+            self.persist()
         self._flush()
         for collname, cf in self._coll_files.items():
             self._open_files[collname].close()
@@ -156,26 +367,7 @@ def write_from_queue(q, en_manager, *args, cleanup_on_complete=False, **kwargs):
     try:
         self._open_all_append()
         while (incoming := q.get()) is not None:
-            if isinstance(incoming, list):
-                for doc in incoming:
-                    def get_docs():
-                        if isinstance(doc, WST_Document) and not hasattr(doc, '_key'):
-                            doc._genkey()
-                        yield doc
-                    self.write_many_documents(get_docs())
-                cntr.update(len(incoming))
-            elif isinstance(incoming, WST_Document):
-                doc = incoming
-                if not hasattr(doc, '_key'):
-                    doc._genkey()
-                self.write_document(doc)
-                cntr.update(1)
-            elif isinstance(incoming, WST_Edge):
-                doc = incoming
-                self.write_document(doc)
-                cntr.update(1)
-            else:
-                raise RuntimeError(f"Invalid write input: {incoming}")
+            cntr.update(self.write_incoming(incoming))
     except Exception as e:
         log.error(f"{type(e)}: {e}")
         raise e
@@ -183,3 +375,90 @@ def write_from_queue(q, en_manager, *args, cleanup_on_complete=False, **kwargs):
         self._close_all()
         if cleanup_on_complete:
             self.cleanup()
+
+# pending bytes of a shard writer written as one frame by flush_if_needed
+SHARD_FLUSH_BYTES = 2 ** 22 # 4 MiB
+
+class WST_ShardWriter():
+    """Export queue compatible writer of one process' own output shard
+
+    Used in place of an export queue: documents put here are written by the
+    calling process directly, instead of crossing to a writer process.
+    """
+    def __init__(self, directory: Path, shard: str, flush_bytes: int = SHARD_FLUSH_BYTES, **exporter_kwargs):
+        self.exporter = WST_FileExporter(directory, shard=shard, **exporter_kwargs)
+        self.exporter._open_all_append()
+        self.flush_bytes = flush_bytes
+        self.documents = 0
+
+    def __repr__(self):
+        return f"WST_ShardWriter<{self.exporter.dir}, {self.exporter.shard}>"
+
+    def put(self, incoming):
+        self.documents += self.exporter.write_incoming(incoming)
+
+    def flush(self):
+        self.exporter.persist()
+
+    def flush_if_needed(self):
+        """Flush once at least flush_bytes are pending, so frames are not tiny"""
+        if sum(map(len, self.exporter._pending_bytes.values())) >= self.flush_bytes:
+            self.flush()
+
+    def close(self):
+        self.exporter._close_all()
+
+@functools.lru_cache(maxsize=None)
+def _get_process_shard_writer(directory: str, pid: int, compression: str) -> WST_ShardWriter:
+    writer = WST_ShardWriter(directory, f"p{pid}", compression=compression)
+    # write out the rest when the process exits, also when a pebble pool stops it
+    multiprocessing.util.Finalize(writer, writer.close, exitpriority=10)
+    return writer
+
+def get_shard_writer(directory: str, compression: str = None) -> WST_ShardWriter:
+    """Get the shard writer of the current process for an output dir
+
+    Its documents are written in frames of SHARD_FLUSH_BYTES, the last ones
+    when the process exits: finalize shards only after their processes ended.
+    """
+    return _get_process_shard_writer(str(directory), os.getpid(), compression)
+
+_MANIFEST_NAME = "manifest.json"
+
+def finalize_shards(directory: Path, merge: bool = False, compression: str = None) -> dict:
+    """Finish a sharded output dir: remove lockfiles and write the manifest
+
+    merge: concatenate every collection's shards into the single
+        {collname}.{vert,edge}.jsonl file, and remove the shards
+
+    WARN: Don't call this until all shard writers are done.
+    """
+    directory = Path(directory)
+    for lockpath in directory.glob("*.lock"):
+        lockpath.unlink()
+    manifest = {
+        "format": "wst-jsonl",
+        "sharded": not merge,
+        "compression": compression,
+        "collections": {},
+    }
+    for collname, kind in collection_file_kinds():
+        shards = sorted(
+            p for p in directory.glob(collection_filename(collname, kind, "*", compression))
+        )
+        if merge:
+            target = directory / collection_filename(collname, kind, None, compression)
+            for shardpath in shards:
+                append_file(shardpath, target)
+                remove_file(shardpath)
+            shards = [target]
+        manifest["collections"][collname] = {
+            "kind": kind,
+            "files": [
+                {"name": p.name, "size": p.stat().st_size} for p in shards if p.exists()
+            ],
+        }
+    with (directory / _MANIFEST_NAME).open('wb') as f:
+        f.write(orjson.dumps(manifest, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE))
+    log.debug(f"wrote manifest for {directory}, merged: {merge}")
+    return manifest
@@ -0,0 +1,142 @@
+"""
+Structural edges of compact graph output
+
+With --compact-graph the file workers write no WSTNode -> child node,
+WSTCodeTree -> root node or WSTNode -> WSTText edges: each one is a function
+of its WSTNode's key, parent and text_key. materialize-edges generates them
+into the output dirs, only for the backends that traverse them (e.g. before
+importing into ArangoDB).
+
+They are the same edges, and keys, as the collector writes without
+--compact-graph: the key scheme of each output dir is the one recorded in
+it by the collector (see jsonl_writer.record_key_scheme).
+Nodes of output collected without --compact-graph are skipped.
+"""
+
+from pathlib import Path
+from typing import Iterable, List
+import os
+import time
+
+from pebble import ProcessPool
+
+from wsyntree import log
+from wsyntree.tree_models import WST_Edge, WSTNode, WSTCodeTree, WSTText
+from wsyntree.key_scheme import KeyScheme, set_key_scheme
+
+from .jsonl_frames import (
+    FrameWriter, compression_of, iter_documents, is_output_file, remove_file,
+)
+from .jsonl_writer import collection_filename, dump_document, read_key_scheme
+
+# uncompressed bytes of edges per frame
+FLUSH_BYTES = 2 ** 23 # 8 MiB
+MATERIALIZED_SHARD = "materialized"
+
+
+def node_files(directory: Path) -> List[Path]:
+    """WSTNode collection files (and shards) of an output dir"""
+    return sorted(
+        p for p in Path(directory).iterdir()
+        if is_output_file(p) and p.name.split('.')[0] == WSTNode._collection
+    )
+
+def node_edges(node: dict) -> List[WST_Edge]:
+    """Structural edges of one compact WSTNode document"""
+    parent = node.get("parent")
+    if parent is None:
+        return []
+    key = node["_key"]
+    node_id = f"{WSTNode._collection}/{key}"
+    # node keys are "{codetree key}-{preorder}"
+    codetree_key = key.rsplit('-', 1)[0]
+    if parent >= 0:
+        edges = [WST_Edge(f"{WSTNode._collection}/{codetree_key}-{parent}", node_id)]
+    else:
+        edges = [WST_Edge(f"{WSTCodeTree._collection}/{codetree_key}", node_id)]
+    if (text_key := node.get("text_key")) is not None:
+        edges.append(WST_Edge(node_id, f"{WSTText._collection}/{text_key}"))
+    return edges
+
+def materialize_file(path: Path, key_scheme: KeyScheme, flush_bytes: int = FLUSH_BYTES) -> int:
+    """Write the edges of one node file next to it, returns the number of edges
+
+    The edge files of a node shard are named after it, and replaced.
+    """
+    set_key_scheme(key_scheme)
+    path = Path(path)
+    compression = compression_of(path)
+    parts = path.name.split('.')
+    # "{collname}.{kind}.jsonl" or "{collname}.{shard}.{kind}.jsonl"
+    shard = MATERIALIZED_SHARD if parts[2].startswith("jsonl") else f"{parts[1]}-{MATERIALIZED_SHARD}"
+    writers = {}
+    pending = {}
+    n_edges = 0
+
+    def write(collname: str):
+        if (w := writers.get(collname)) is None:
+            target = path.parent / collection_filename(collname, "edge", shard, compression)
+            remove_file(target)
+            w = writers[collname] = FrameWriter(target, compression)
+        w.write(bytes(pending[collname]))
+        pending[collname] = bytearray()
+
+    try:
+        for node in iter_documents(path):
+            for edge in node_edges(node):
+                buf = pending.get(edge._collection)
+                if buf is None:
+                    buf = pending[edge._collection] = bytearray()
+                buf += dump_document(edge)
+                n_edges += 1
+                if len(buf) >= flush_bytes:
+                    write(edge._collection)
+        for collname, buf in pending.items():
+            if buf:
+                write(collname)
+    finally:
+        for w in writers.values():
+            w.close()
+    return n_edges
+
+def materialize_dirs(dirs: Iterable[Path], workers: int = None) -> int:
+    """Materialize the edges of every node file of output dirs, returns the number of edges
+
+    Raises FileNotFoundError if a dir has no key scheme recorded.
+    """
+    files = []
+    for d in dirs:
+        key_scheme = read_key_scheme(d)
+        if key_scheme is None:
+            raise FileNotFoundError(f"no key scheme recorded in {d}, is it a collection output dir?")
+        files.extend((p, key_scheme) for p in node_files(d))
+    log.info(f"materializing edges of {len(files)} node files ...")
+    t_start = time.time()
+    n_edges = 0
+    with ProcessPool(max_workers=workers or os.cpu_count()) as pool:
+        futures = [pool.schedule(materialize_file, f) for f in files]
+        for (p, _ks), f in zip(files, futures):
+            n = f.result()
+            log.debug(f"{p}: {n} edges")
+            n_edges += n
+    elapsed = time.time() - t_start
+    log.info(f"materialized {n_edges} edges in {elapsed:.1f}s")
+    return n_edges
+
+def set_materialize_edges_args(cmd):
+    cmd.set_defaults(func=materialize_edges)
+    cmd.add_argument(
+        "output_dir",
+        nargs="+",
+        type=Path,
+        help="Output directories collected with --compact-graph",
+    )
+    cmd.add_argument(
+        "-w", "--workers",
+        type=int,
+        help="Number of node files processed in parallel, default: os.cpu_count()",
+        default=os.cpu_count(),
+    )
+
+def materialize_edges(args):
+    materialize_dirs(args.output_dir, args.workers)
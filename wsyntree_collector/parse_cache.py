@@ -0,0 +1,112 @@
+"""
+Persistent, content-addressed record of completed WSTCodeTrees
+
+Shared by every run (and every repo) using the same cache file, so a blob
+that was already parsed (vendored copies, forks, earlier runs) only needs
+the WSTFile -> WSTCodeTree edge to be emitted again.
+
+Entries assume all runs sharing a cache end up in the same database.
+"""
+
+from pathlib import Path
+from typing import NamedTuple
+import functools
+import os
+import sqlite3
+import threading
+import time
+
+from wsyntree import log
+from wsyntree.key_scheme import MERKLE_FORMAT
+from wsyntree.localstorage import LocalCache
+
+
+def default_parse_cache_path() -> Path:
+    return LocalCache.get_local_cache_dir() / "parse_cache.sqlite3"
+
+class ParseCache():
+    def __init__(self, path: Path = None):
+        self.path = Path(path or default_parse_cache_path())
+        self._conns = {} # (pid, thread) -> connection
+
+    def __repr__(self):
+        return f"ParseCache<{self.path}>"
+
+    def _get_conn(self) -> sqlite3.Connection:
+        # sqlite connections must not be shared across a fork, or threads
+        # (completions run in the db writer threads, see db_writer)
+        owner = (os.getpid(), threading.get_ident())
+        if (conn := self._conns.get(owner)) is not None:
+            return conn
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path), timeout=60, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS codetrees (
+            language TEXT NOT NULL,
+            lang_version TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            options TEXT NOT NULL,
+            codetree_key TEXT NOT NULL,
+            created INTEGER NOT NULL,
+            PRIMARY KEY (language, lang_version, content_hash, options)
+        ) WITHOUT ROWID""")
+        self._conns[owner] = conn
+        return conn
+
+    def get(self, language: str, lang_version: str, content_hash: str, options: str = ""):
+        """Key of the completed WSTCodeTree, or None if it was never recorded"""
+        row = self._get_conn().execute(
+            "SELECT codetree_key FROM codetrees WHERE language=? AND lang_version=? AND content_hash=? AND options=?",
+            (language, lang_version, content_hash, options),
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, language: str, lang_version: str, content_hash: str, codetree_key: str, options: str = ""):
+        """Record a completed WSTCodeTree"""
+        self._get_conn().execute(
+            "INSERT OR IGNORE INTO codetrees VALUES (?, ?, ?, ?, ?, ?)",
+            (language, lang_version, content_hash, options, codetree_key, int(time.time())),
+        )
+
+    def __len__(self):
+        return self._get_conn().execute("SELECT COUNT(*) FROM codetrees").fetchone()[0]
+
+def text_cache_options(text_mode: str, text_hash: str, text_inline: int = 0, compact_graph: bool = False) -> str:
+    """The options string of CodeTrees collected with these text options"""
+    options = f"{text_mode}/{text_hash}"
+    if text_hash == "merkle":
+        # the keys of its WSTTexts depend on the merkle format
+        options += str(MERKLE_FORMAT)
+    if text_inline:
+        options += f"/inline{text_inline}"
+    if compact_graph:
+        # no structural edges were written
+        options += "/compact"
+    return options
+
+@functools.lru_cache(maxsize=None)
+def get_parse_cache(path: str) -> ParseCache:
+    """Per-process ParseCache instance for a path"""
+    return ParseCache(path)
+
+class ParseCacheEntry(NamedTuple):
+    """A completed WSTCodeTree to record once its documents are written
+
+    Sent through the export queue after the CodeTree's documents, the
+    writer records it (see WST_FileExporter.write_incoming), only after
+    its next journal checkpoint, or persist() without one: an entry must never
+    outlive the documents it stands for.
+    """
+    cache_path: str
+    language: str
+    lang_version: str
+    content_hash: str
+    codetree_key: str
+    options: str
+
+    def put(self):
+        get_parse_cache(self.cache_path).put(
+            self.language, self.lang_version, self.content_hash,
+            self.codetree_key, self.options,
+        )
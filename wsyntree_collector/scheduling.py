@@ -0,0 +1,273 @@
+"""
+Streaming, size-aware scheduling of file tasks onto a worker pool
+
+Files are grouped into tasks while the repo is still being enumerated:
+large files go first (so one huge generated file does not start last and
+dominate wall time), tiny files are packed together (so per-task overhead
+does not dominate), and only a bounded number of futures exist at once.
+
+Batches of repos share one pool through FairTaskScheduler.
+"""
+
+from collections import deque
+from typing import Iterable, List, Union
+import concurrent.futures as futures
+import queue
+import threading
+
+from wsyntree import log
+from wsyntree.utils import chunkiter
+from wsyntree.tree_models import WSTFile
+
+# files are sorted by size within windows of this many files
+SORT_WINDOW_FILES = 2 ** 15
+# files smaller than this are packed together into one task
+SMALL_FILE_BYTES = 2 ** 14 # 16 KiB
+# limits for a packed task
+TASK_BATCH_BYTES = 2 ** 18 # 256 KiB
+TASK_BATCH_FILES = 64
+
+
+def _task_size(item) -> int:
+    if isinstance(item, list):
+        return sum(f.size or 0 for f in item)
+    return item.size or 0
+
+def size_ordered_tasks(
+        files: Iterable[Union[WSTFile, List[WSTFile]]],
+        *,
+        window: int = SORT_WINDOW_FILES,
+        small_file_bytes: int = SMALL_FILE_BYTES,
+        batch_bytes: int = TASK_BATCH_BYTES,
+        batch_files: int = TASK_BATCH_FILES,
+    ) -> Iterable[List[WSTFile]]:
+    """Group WSTFiles into tasks (lists of WSTFiles), largest files first
+
+    Reads `window` files from the input at a time, so enumeration is never
+    held in memory entirely, and the descending size order is per window.
+
+    An input item may also be a list of WSTFiles that has to stay together
+    in order (see history.file_chains), sized by its total.
+    """
+    for chunk in chunkiter(files, window):
+        chunk = sorted(chunk, key=_task_size, reverse=True)
+        batch = []
+        batch_size = 0
+        for f in chunk:
+            size = _task_size(f)
+            if size >= small_file_bytes:
+                yield f if isinstance(f, list) else [f]
+                continue
+            if isinstance(f, list):
+                batch.extend(f)
+            else:
+                batch.append(f)
+            batch_size += size
+            if len(batch) >= batch_files or batch_size >= batch_bytes:
+                yield batch
+                batch = []
+                batch_size = 0
+        if batch:
+            yield batch
+
+class BoundedTaskScheduler():
+    """Schedule tasks onto a pebble pool with a bounded number of futures"""
+    def __init__(self, executor, max_pending: int):
+        self.executor = executor
+        self.max_pending = max_pending
+        self.pending = set()
+        self.scheduled = 0
+
+    def run(self, fn, tasks: Iterable, args: tuple = (), kwargs: dict = None):
+        """Schedule fn(task, *args, **kwargs) for every task
+
+        Consumes `tasks` lazily, only as futures complete.
+        Yields completed futures in completion order.
+        """
+        for task in tasks:
+            self.pending.add(self.executor.schedule(fn, (task, *args), kwargs or {}))
+            self.scheduled += 1
+            while len(self.pending) >= self.max_pending:
+                yield from self._wait()
+        while self.pending:
+            yield from self._wait()
+
+    def _wait(self):
+        done, self.pending = futures.wait(
+            self.pending, return_when=futures.FIRST_COMPLETED
+        )
+        return done
+
+    def cancel(self):
+        for f in self.pending:
+            f.cancel()
+
+# markers of _StreamTasks.get
+_NOT_READY = object()
+_END = object()
+
+class _StreamTasks():
+    """Tasks of one stream, generated ahead by a thread into a bounded queue
+
+    Enumerating a repo's files (and sizing them) is slow: it must not hold
+    up the scheduling of the other streams.
+    """
+    def __init__(self, tasks: Iterable, maxsize: int, on_ready):
+        self._q = queue.Queue(maxsize)
+        self._stopped = threading.Event()
+        self._on_ready = on_ready
+        # exception raised while generating the tasks
+        self.error = None
+        self._thread = threading.Thread(target=self._run, args=(tasks,), daemon=True)
+        self._thread.start()
+
+    def _run(self, tasks: Iterable):
+        try:
+            for task in tasks:
+                if not self._put(task):
+                    return
+        except Exception as e:
+            self.error = e
+        self._put(_END)
+
+    def _put(self, item) -> bool:
+        while not self._stopped.is_set():
+            try:
+                self._q.put(item, timeout=0.5)
+            except queue.Full:
+                continue
+            self._on_ready()
+            return True
+        return False
+
+    def get(self):
+        """The next task, _NOT_READY if it is still being generated, or _END"""
+        try:
+            return self._q.get_nowait()
+        except queue.Empty:
+            return _NOT_READY
+
+    def stop(self):
+        self._stopped.set()
+
+class FairTaskScheduler():
+    """Schedule the tasks of many streams (e.g. repos) onto one shared pool
+
+    Streams take turns, one task at a time, whenever a slot is free, so a
+    huge repo never starves the small ones and no core idles while any
+    stream still has tasks. Streams can be added while others are running.
+
+    The tasks of every stream are generated in a thread of their own, up to
+    `prefetch` ahead, so fill() never waits on a stream's enumeration.
+    """
+    def __init__(self, executor, max_pending: int, prefetch: int = None):
+        self.executor = executor
+        self.max_pending = max_pending
+        self.prefetch = prefetch or max_pending
+        # key -> [fn, _StreamTasks, args, kwargs]
+        self.streams = {}
+        # keys of the streams with tasks left, the next one to serve first
+        self.turns = deque()
+        # done once a stream has a new task ready, see fill and wait
+        self._ready_lock = threading.Lock()
+        self._ready = futures.Future()
+        self.pending = {} # future -> stream key
+        self.pending_per_stream = {}
+        self.exhausted = set()
+        # key -> exception raised while generating the stream's tasks
+        self.errors = {}
+
+    def __bool__(self):
+        return bool(self.streams)
+
+    def add(self, key, fn, tasks: Iterable, args: tuple = (), kwargs: dict = None):
+        """Add a stream: fn(task, *args, **kwargs) for every task"""
+        if key in self.streams:
+            raise ValueError(f"stream {key} already scheduled")
+        self.pending_per_stream[key] = 0
+        self.streams[key] = [fn, _StreamTasks(tasks, self.prefetch, self._set_ready), args, kwargs or {}]
+        self.turns.append(key)
+
+    def _set_ready(self):
+        with self._ready_lock:
+            if not self._ready.done():
+                self._ready.set_result(None)
+
+    def fill(self):
+        """Schedule the tasks ready, taking turns between streams, until no slot is free
+
+        Turns carry over between calls: the stream after the last one served
+        goes first.
+        """
+        with self._ready_lock:
+            # tasks generated from now on wake up wait()
+            if self._ready.done():
+                self._ready = futures.Future()
+        idle = 0 # streams in a row without a task ready
+        while len(self.pending) < self.max_pending and idle < len(self.turns):
+            key = self.turns[0]
+            self.turns.rotate(-1)
+            fn, tasks, args, kwargs = self.streams[key]
+            task = tasks.get()
+            if task is _NOT_READY:
+                idle += 1
+                continue
+            if task is _END:
+                self.turns.pop()
+                self.exhausted.add(key)
+                if tasks.error is not None:
+                    e = tasks.error
+                    log.err(f"failed to generate tasks of {key}: {type(e)}: {e}")
+                    self.errors[key] = e
+                continue
+            self.pending[self.executor.schedule(fn, (task, *args), kwargs)] = key
+            self.pending_per_stream[key] += 1
+            idle = 0
+
+    def wait(self, also: Iterable[futures.Future] = (), timeout: float = None):
+        """Wait for any task (or any of `also`) to complete
+
+        Also returns early when a stream got new tasks ready for fill().
+        Returns the completed tasks as a list of (stream key, future).
+        """
+        waiting = set(self.pending.keys()).union(also)
+        if self.turns:
+            waiting.add(self._ready)
+        if not waiting:
+            return []
+        done, _ = futures.wait(
+            waiting, timeout=timeout, return_when=futures.FIRST_COMPLETED
+        )
+        completed = []
+        for f in done:
+            key = self.pending.pop(f, None)
+            if key is not None:
+                self.pending_per_stream[key] -= 1
+                completed.append((key, f))
+        return completed
+
+    def finished(self) -> List:
+        """Remove and return the keys of streams with every task completed"""
+        keys = [
+            k for k in self.exhausted if self.pending_per_stream[k] == 0
+        ]
+        for k in keys:
+            self._remove(k)
+        return keys
+
+    def cancel(self, key = None):
+        """Cancel the pending tasks of one stream, or of all, and drop them"""
+        for f, k in list(self.pending.items()):
+            if key is None or k == key:
+                f.cancel()
+                del self.pending[f]
+        for k in ([key] if key is not None else list(self.streams.keys())):
+            self._remove(k)
+
+    def _remove(self, key):
+        if (stream := self.streams.pop(key, None)) is not None:
+            stream[1].stop()
+        if key in self.turns:
+            self.turns.remove(key)
+        self.pending_per_stream.pop(key, None)
+        self.exhausted.discard(key)
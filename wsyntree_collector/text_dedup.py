@@ -0,0 +1,297 @@
+"""
+WSTText deduplication shared by every file worker of a run
+
+Without it, each worker only knows the texts of the file it is processing,
+so tokens like `(` or `self` are written once per file, and only collapsed
+when importing. A TextDedupFilter is an exact set of the WSTText keys any
+worker has already written: a file-backed hash table of 16 byte key
+fingerprints, mmapped by every worker, in shards each guarded by a lock on
+its byte range. A key is only skipped if its fingerprint was already
+claimed, so the only false positives are fingerprint collisions (2^-128).
+
+Claiming a text means writing it: the output of every run sharing a filter
+must end up in the same database. A run-scoped filter lives in a temporary
+file; a persisted filter is copied in at the start and only saved back
+after a completed run, so an interrupted run never records texts it did
+not write.
+
+Workers must not claim from many threads, the locks are per process.
+"""
+
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Iterable, List, Set, Tuple
+import fcntl
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+from pebble import concurrent
+
+from wsyntree import log
+from wsyntree.tree_models import WSTText
+
+SHARDS = 64
+DEFAULT_SLOTS = 2 ** 24 # 256 MiB, sparse until used
+# shards stop taking new keys when this full, dedup is then partial
+MAX_LOAD = 0.8
+# seconds between logs of the stats workers report, see text_dedup_stats
+STATS_INTERVAL = 60.0
+
+_FINGERPRINT_SIZE = 16
+_EMPTY = bytes(_FINGERPRINT_SIZE)
+# used, hits, misses, rejected (could not be recorded: shard full)
+_header = struct.Struct("<QQQQ")
+
+
+def _fingerprint(key: str) -> bytes:
+    fp = hashlib.blake2b(key.encode(), digest_size=_FINGERPRINT_SIZE).digest()
+    return fp if fp != _EMPTY else b"\x01" + fp[1:]
+
+class TextDedupFilter():
+    """Exact, process-shared set of claimed WSTText keys, see module docs
+
+    Picklable: workers reopen the table file on first use.
+    """
+    def __init__(self, path: Path, persist_path: Path = None):
+        """path: an existing table file, see create()"""
+        self.path = Path(path)
+        self.persist_path = Path(persist_path) if persist_path else None
+        size = self.path.stat().st_size
+        self._shard_bytes = size // SHARDS
+        self._shard_slots = (self._shard_bytes - _header.size) // _FINGERPRINT_SIZE
+        self._max_used = int(self._shard_slots * MAX_LOAD)
+        self._fd = None
+        self._mm = None
+        self._pid = None
+        self._completed = False
+
+    def __repr__(self):
+        return f"TextDedupFilter<{self.path}, persist {self.persist_path}>"
+
+    def __getstate__(self):
+        return {"path": self.path, "persist_path": self.persist_path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["persist_path"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.log_stats()
+        self.close(save=self._completed and exc_type is None)
+
+    def mark_completed(self):
+        """Every text claimed is written: persist the filter when leaving the context"""
+        self._completed = True
+
+    @classmethod
+    def create(cls, persist_path: Path = None, slots: int = DEFAULT_SLOTS, dir: Path = None):
+        """New table in a temporary file, loaded from persist_path if it exists
+
+        dir: where to make the temporary file, default /dev/shm if present
+        """
+        if dir is None and os.path.isdir("/dev/shm"):
+            dir = "/dev/shm"
+        fd, path = tempfile.mkstemp(prefix="wst-text-dedup-", dir=dir)
+        os.close(fd)
+        if persist_path is not None and Path(persist_path).exists():
+            shutil.copyfile(persist_path, path)
+            log.info(f"loaded text dedup filter from {persist_path}")
+        else:
+            shard_slots = -(-slots // SHARDS)
+            os.truncate(path, SHARDS * (_header.size + shard_slots * _FINGERPRINT_SIZE))
+        f = cls(path, persist_path)
+        f._reset_stats()
+        return f
+
+    def _reset_stats(self):
+        """Zero the counters, so stats are of this run only"""
+        _fd, mm = self._open()
+        for shard in range(SHARDS):
+            start = shard * self._shard_bytes
+            used = _header.unpack_from(mm, start)[0]
+            _header.pack_into(mm, start, used, 0, 0, 0)
+
+    def _open(self):
+        # mmaps and lock ownership must not be shared across a fork
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR)
+            self._mm = mmap.mmap(self._fd, self._shard_bytes * SHARDS)
+            self._pid = os.getpid()
+        return self._fd, self._mm
+
+    def claim(self, keys: Iterable[str]) -> Set[str]:
+        """Record keys, returns those no worker had claimed before"""
+        return self._claim(keys)[0]
+
+    def _claim(self, keys: Iterable[str]) -> Tuple[Set[str], int, int, int]:
+        """claim, also returns its number of hits, misses and rejected keys"""
+        counts = [0, 0, 0]
+        by_shard = {}
+        for key in keys:
+            fp = _fingerprint(key)
+            by_shard.setdefault(fp[0] % SHARDS, []).append((key, fp))
+        fd, mm = self._open()
+        claimed = set()
+        for shard, items in by_shard.items():
+            start = shard * self._shard_bytes
+            base = start + _header.size
+            fcntl.lockf(fd, fcntl.LOCK_EX, self._shard_bytes, start)
+            try:
+                used, hits, misses, rejected = _header.unpack_from(mm, start)
+                before = (hits, misses, rejected)
+                for key, fp in items:
+                    i = int.from_bytes(fp[1:9], 'little') % self._shard_slots
+                    while True:
+                        off = base + i * _FINGERPRINT_SIZE
+                        slot = mm[off:off + _FINGERPRINT_SIZE]
+                        if slot == fp:
+                            hits += 1
+                            break
+                        if slot == _EMPTY:
+                            if used < self._max_used:
+                                mm[off:off + _FINGERPRINT_SIZE] = fp
+                                used += 1
+                                misses += 1
+                            else:
+                                rejected += 1
+                            claimed.add(key)
+                            break
+                        i = (i + 1) % self._shard_slots
+                _header.pack_into(mm, start, used, hits, misses, rejected)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, self._shard_bytes, start)
+            for i, (b, a) in enumerate(zip(before, (hits, misses, rejected))):
+                counts[i] += a - b
+        return (claimed, *counts)
+
+    def filter_documents(self, docs: List, node_q = None) -> List:
+        """Drop the WSTTexts of a batch of documents another worker already wrote
+
+        node_q: report the claim stats to, see text_dedup_stats
+        """
+        keys = [d._key for d in docs if isinstance(d, WSTText)]
+        if not keys:
+            return docs
+        claimed, hits, misses, rejected = self._claim(keys)
+        if node_q:
+            node_q.put(("text_dedup_stats", {"hits": hits, "misses": misses, "rejected": rejected}))
+        if len(claimed) == len(keys):
+            return docs
+        return [d for d in docs if not isinstance(d, WSTText) or d._key in claimed]
+
+    def stats(self) -> dict:
+        _fd, mm = self._open()
+        totals = [0, 0, 0, 0]
+        for shard in range(SHARDS):
+            for i, v in enumerate(_header.unpack_from(mm, shard * self._shard_bytes)):
+                totals[i] += v
+        used, hits, misses, rejected = totals
+        return {
+            "used": used,
+            "load": used / (self._shard_slots * SHARDS),
+            "hits": hits,
+            "misses": misses,
+            "rejected": rejected,
+            "hit_ratio": hits / ((hits + misses + rejected) or 1),
+        }
+
+    def log_stats(self):
+        s = self.stats()
+        log.info(" ".join([
+            f"text dedup: {s['hits']} duplicate texts skipped, {s['misses']} written",
+            f"(hit ratio {s['hit_ratio']:.3f}), table load {s['load']:.3f}",
+        ]))
+        if s["rejected"]:
+            log.warn(f"text dedup table full: {s['rejected']} texts not recorded, use more --text-dedup-slots")
+
+    def close(self, save: bool = False):
+        """Remove the table file, save: to persist_path first (if set)"""
+        if self._mm is not None:
+            self._mm.close()
+            os.close(self._fd)
+            self._mm = self._fd = self._pid = None
+        if save and self.persist_path is not None:
+            tmp = self.persist_path.with_name(f"{self.persist_path.name}.tmp")
+            self.persist_path.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(self.path, tmp)
+            os.replace(tmp, self.persist_path)
+            log.info(f"saved text dedup filter to {self.persist_path}")
+        self.path.unlink(missing_ok=True)
+
+@concurrent.thread
+def _receive_stats(node_q, interval: float) -> dict:
+    totals = {"hits": 0, "misses": 0, "rejected": 0}
+    t_logged = time.time()
+    while (msg := node_q.get()) is not None:
+        # other stats of the workers are not for us
+        if not (isinstance(msg, tuple) and msg[0] == "text_dedup_stats"):
+            continue
+        if msg[1]["rejected"] and not totals["rejected"]:
+            log.warn(f"text dedup table full, texts are no longer all deduplicated: use more --text-dedup-slots")
+        for k, v in msg[1].items():
+            totals[k] += v
+        if time.time() - t_logged >= interval:
+            t_logged = time.time()
+            log.info(" ".join([
+                f"text dedup so far: {totals['hits']} duplicate texts skipped,",
+                f"{totals['misses']} written, {totals['rejected']} not recorded",
+            ]))
+    return totals
+
+@contextmanager
+def text_dedup_stats(text_dedup: TextDedupFilter, mp_manager, interval: float = STATS_INTERVAL):
+    """Context of a stats channel (node_q) for the workers of a filter
+
+    Workers report the hits, misses and rejections of their claims to it,
+    logged every interval seconds. None if text_dedup is None.
+    """
+    if text_dedup is None:
+        yield None
+        return
+    node_q = mp_manager.Queue()
+    receiver = _receive_stats(node_q, interval)
+    try:
+        yield node_q
+    finally:
+        node_q.put(None)
+        log.debug(f"text dedup claims reported by workers: {receiver.result()}")
+
+def add_text_dedup_args(parser):
+    """Add the shared text deduplication options to a command"""
+    parser.add_argument(
+        "--text-dedup",
+        action="store_true",
+        help="Write each distinct text once per run, instead of once per file",
+    )
+    parser.add_argument(
+        "--text-dedup-file",
+        type=Path,
+        help="Keep the --text-dedup filter in this file across runs (all their output must go to the same database)",
+        default=None,
+    )
+    parser.add_argument(
+        "--text-dedup-slots",
+        type=int,
+        help="Distinct texts the --text-dedup filter can hold (16 bytes each), not used for an existing --text-dedup-file",
+        default=DEFAULT_SLOTS,
+    )
+
+def check_text_dedup_args(args):
+    """Error message of options conflicting with the text dedup options, or None"""
+    if getattr(args, "resume", False) and (args.text_dedup or args.text_dedup_file):
+        # a text may only be written in another output dir, or rolled back on resume
+        return "--resume is not supported with --text-dedup"
+    return None
+
+def text_dedup_from_args(args):
+    """Context of a new TextDedupFilter, or of None if not enabled"""
+    if not (args.text_dedup or args.text_dedup_file):
+        return nullcontext()
+    return TextDedupFilter.create(args.text_dedup_file, args.text_dedup_slots)
@@ -0,0 +1,33 @@
+"""
+Warm pools of file worker processes
+
+Every worker loads the tree-sitter languages and their parsers once, when
+the process starts, instead of on its first file of each language.
+
+A pool can be shared by many collectors (see batch_analyzer), so process
+startup and parser setup happen once per batch instead of once per repo.
+"""
+
+import os
+
+from pebble import ProcessPool
+
+from wsyntree import log
+from wsyntree.wrap_tree_sitter import preload_languages
+
+
+def init_worker(langs = None):
+    """ProcessPool initializer: preload languages in the new worker"""
+    loaded = preload_languages(langs)
+    log.debug(f"worker {os.getpid()} preloaded {len(loaded)} languages")
+
+def file_worker_pool(workers: int, langs = None) -> ProcessPool:
+    """ProcessPool of warm file workers, see init_worker
+
+    langs: languages to preload, default: every language already available
+    """
+    return ProcessPool(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(langs,),
+    )